@@ -1,16 +1,46 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List, Dict, Any
 from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from array import array
+import io
 import os
+import re
+import csv
+import html
+import zlib
+import hashlib
+import json
+import math
+import mmap
+import time
+import fcntl
+import glob
+import bisect
+import struct
+import logging
+import socket
+import threading
 from dotenv import load_dotenv
 import jwt
 from passlib.context import CryptContext
-from pymongo import MongoClient
+from pymongo import MongoClient, DeleteOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ExecutionTimeout
+from bson import json_util
+import numpy as np
+from scipy import sparse
 import uuid
+import ast
 from enum import Enum
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
 
 # Load environment variables
 load_dotenv()
@@ -214,6 +244,12 @@ class ArticleCreate(BaseModel):
     tags: Optional[List[str]] = []
     images: Optional[List[str]] = []
 
+class DuplicateCandidate(BaseModel):
+    id: str
+    title: str
+    wiki_id: Optional[str] = None
+    similarity: float
+
 class ArticleResponse(BaseModel):
     id: str
     title: str
@@ -228,6 +264,7 @@ class ArticleResponse(BaseModel):
     updated_at: datetime
     created_by: str
     updated_by: str
+    possible_duplicates: Optional[List[DuplicateCandidate]] = None
 
 class ArticleUpdate(BaseModel):
     title: Optional[str] = None
@@ -247,6 +284,67 @@ class ArticleVersion(BaseModel):
     updated_by: str
     change_notes: Optional[str] = None
 
+class ArticleSearchHit(BaseModel):
+    id: str
+    title: str
+    subcategory_id: Optional[str] = None
+    wiki_id: Optional[str] = None
+    visibility: ArticleVisibility
+    tags: List[str] = []
+    updated_at: Optional[datetime] = None
+    score: float
+    snippet: str  # HTML-escaped text with matches wrapped in <mark>
+
+class SearchHit(BaseModel):
+    type: str
+    id: str
+    title: str
+    score: float
+    snippet: str
+    wiki_id: Optional[str] = None
+    flow_id: Optional[str] = None
+    visibility: Optional[str] = None
+    tags: List[str] = []
+
+class SearchQueryStat(BaseModel):
+    query: str
+    searches: int
+    zero_result_searches: int
+    avg_results: float
+    avg_latency_ms: float
+    max_latency_ms: float
+
+class SearchQueryReport(BaseModel):
+    since: datetime
+    top_queries: List[SearchQueryStat]
+    zero_result_queries: List[SearchQueryStat]
+    slow_queries: List[SearchQueryStat]
+
+class Suggestion(BaseModel):
+    type: str  # 'article', 'tag', 'category', 'subcategory'
+    id: str
+    text: str
+    wiki_id: Optional[str] = None
+
+class RelatedArticle(BaseModel):
+    id: str
+    title: str
+    score: float
+
+class DuplicateCluster(BaseModel):
+    id: str
+    size: int
+    min_similarity: float
+    wiki_ids: List[str] = []
+    articles: List[DuplicateCandidate] = []
+
+class TagCount(BaseModel):
+    tag: str
+    article_count: int = 0
+    flow_count: int = 0
+    by_wiki: Dict[str, int] = {}
+    by_visibility: Dict[str, int] = {}
+
 # Flow models
 class FlowCreate(BaseModel):
     title: str
@@ -266,6 +364,16 @@ class FlowResponse(BaseModel):
     updated_at: datetime
     created_by: str
     updated_by: str
+    published_version: Optional[int] = None
+
+class FlowVersionResponse(BaseModel):
+    flow_id: str
+    version: int
+    title: str
+    draft_version: int
+    step_count: int
+    published_at: datetime
+    published_by: str
 
 class FlowStepCreate(BaseModel):
     flow_id: str
@@ -303,10 +411,13 @@ class FlowExecutionCreate(BaseModel):
 class FlowExecutionResponse(BaseModel):
     id: str
     flow_id: str
+    flow_version: Optional[int] = None  # Published version the execution is pinned to
     user_id: Optional[str] = None
     session_id: str
     status: FlowExecutionStatus
     current_step_id: Optional[str] = None
+    current_flow_id: Optional[str] = None  # Flow of current_step_id when inside a subflow
+    call_stack: List[Dict[str, Any]] = []
     answers: Dict[str, Any]
     session_data: Dict[str, Any]
     url_path: str  # For resumable sessions
@@ -319,6 +430,25 @@ class FlowStepAnswer(BaseModel):
     answer: Any  # Can be string, number, list, etc.
     metadata: Optional[Dict[str, Any]] = {}
 
+class FlowStepAnswerBatch(BaseModel):
+    answers: List[FlowStepAnswer]  # In the order the steps were answered
+
+class FlowStepAnalytics(BaseModel):
+    step_id: str
+    question_text: Optional[str] = None
+    step_order: Optional[int] = None
+    reached: int
+    answered: int
+    drop_off: int  # Reached but not answered
+    drop_off_rate: float
+    options: Dict[str, int]
+    median_seconds_to_answer: Optional[float] = None
+
+class FlowAnalyticsResponse(BaseModel):
+    flow_id: str
+    since: datetime
+    steps: List[FlowStepAnalytics]
+
 class FlowSummary(BaseModel):
     execution_id: str
     flow_title: str
@@ -385,42 +515,3892 @@ ROLE_PERMISSIONS = {
         AppPermission.WIKI_READ,
         AppPermission.FLOW_READ, AppPermission.FLOW_EXECUTE
     ]
-}
+}
+
+# Utility functions
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+def create_access_token(data: dict) -> str:
+    to_encode = data.copy()
+    expire = datetime.utcnow() + timedelta(minutes=JWT_ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+    return encoded_jwt
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    try:
+        payload = jwt.decode(credentials.credentials, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        user_id: str = payload.get("sub")
+        if user_id is None:
+            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    
+    user = db.users.find_one({"id": user_id})
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    return user
+
+def check_permission(user: dict, required_permission: AppPermission):
+    user_role = UserRole(user["role"])
+    user_permissions = ROLE_PERMISSIONS.get(user_role, [])
+    if required_permission not in user_permissions:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+
+ACCESSIBLE_WIKIS_TTL_SECONDS = 30
+_accessible_wikis_cache: Dict[str, tuple] = {}
+
+def get_accessible_wiki_ids(user_role: UserRole) -> Optional[frozenset]:
+    # None means the role can access every wiki. The result is cached briefly
+    # per role because hot read paths (typeahead, search) need it per request.
+    if user_role in [UserRole.ADMIN, UserRole.MANAGER]:
+        return None
+    cached = _accessible_wikis_cache.get(user_role.value)
+    if cached and time.monotonic() - cached[0] < ACCESSIBLE_WIKIS_TTL_SECONDS:
+        return cached[1]
+    accessible_wikis = db.wikis.find({
+        "$or": [
+            {"is_public": True},
+            {"allowed_roles": {"$in": [user_role.value]}}
+        ]
+    }, {"id": 1})
+    wiki_ids = frozenset(wiki["id"] for wiki in accessible_wikis)
+    _accessible_wikis_cache[user_role.value] = (time.monotonic(), wiki_ids)
+    return wiki_ids
+
+def get_searchable_visibility(user_role: UserRole) -> set:
+    # Article visibility levels a role may find through search
+    if user_role == UserRole.VIEWER:
+        return {ArticleVisibility.PUBLIC.value, ArticleVisibility.INTERNAL.value}
+    if user_role not in [UserRole.ADMIN, UserRole.MANAGER]:
+        return {v.value for v in ArticleVisibility if v != ArticleVisibility.PRIVATE}
+    return {v.value for v in ArticleVisibility}
+
+# Search index
+# Articles are indexed into an inverted index that lives in a memory-mapped
+# snapshot file shared by all workers through the page cache. Changes made
+# after the snapshot was written are appended to the search_index_changes
+# collection and replayed into a small in-memory overlay on top of it.
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "search_index"))
+SEARCH_SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("SEARCH_SNAPSHOT_INTERVAL_SECONDS", "300"))
+SEARCH_REPLAY_INTERVAL_SECONDS = float(os.getenv("SEARCH_REPLAY_INTERVAL_SECONDS", "2"))
+SEARCH_REPLAY_BATCH_SIZE = 1000
+SEARCH_CHANGE_GAP_GRACE_SECONDS = 5
+SEARCH_PREFIX_EXPANSION_LIMIT = 50
+SEARCH_MAX_TOKEN_LENGTH = 64
+SEARCH_SNIPPET_TOKENS = 30
+# Leading content tokens kept in article records to cut snippets from
+SEARCH_EXCERPT_TOKENS = 300
+SEARCH_DOC_TYPES = ["article", "category", "subcategory", "flow", "step"]
+SEARCH_QUERY_MAX_LENGTH = 256
+SEARCH_QUERY_MAX_CLAUSES = 12
+SEARCH_QUERY_MAX_DEPTH = 4
+SEARCH_QUERY_MIN_PREFIX_LENGTH = 2
+SEARCH_QUERY_MAX_POSTING_BYTES = 16 * 1024 * 1024
+SEARCH_QUERY_MAX_MATCHES = 1000
+SEARCH_QUERY_MAX_TIME_MS = int(os.getenv("SEARCH_QUERY_MAX_TIME_MS", "2000"))
+
+SEARCH_SNAPSHOT_MAGIC = b"WGSIDX\x00\x01"
+SEARCH_SNAPSHOT_FORMAT_VERSION = 4
+# magic, format version, reserved, last applied change seq, doc count, term count,
+# then the offsets of the doc data, doc offsets, postings data, term data,
+# term offsets and postings offsets sections and the end of file
+SEARCH_SNAPSHOT_HEADER = struct.Struct("<8sIIQQQ7Q")
+
+# Field weights used when scoring a term occurrence
+SEARCH_FIELD_WEIGHTS = {"title": 3, "tags": 2, "content": 1}
+
+SEARCH_TOKEN_RE = re.compile(r"[^\W_]+")
+HTML_TAG_RE = re.compile(r"<[^>]*>")
+
+logger = logging.getLogger(__name__)
+
+def strip_html(text: str) -> str:
+    return html.unescape(HTML_TAG_RE.sub(" ", text or ""))
+
+def tokenize(text: str) -> List[str]:
+    return [token.lower() for token in SEARCH_TOKEN_RE.findall(text or "") if len(token) <= SEARCH_MAX_TOKEN_LENGTH]
+
+def token_spans(text: str) -> List[tuple]:
+    # Character spans of the tokens produced by tokenize, in the same order
+    return [match.span() for match in SEARCH_TOKEN_RE.finditer(text or "") if match.end() - match.start() <= SEARCH_MAX_TOKEN_LENGTH]
+
+def encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(buf, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def article_search_fields(article: dict) -> List[tuple]:
+    # Fields in token stream order; positions run across fields so that
+    # title_length and content_start in the record tell them apart
+    return [
+        ("title", article.get("title", "")),
+        ("tags", " ".join(article.get("tags") or [])),
+        ("content", strip_html(article.get("content", "")))
+    ]
+
+def search_excerpt(text: str) -> str:
+    spans = token_spans(text)
+    return text[:spans[SEARCH_EXCERPT_TOKENS - 1][1]] if len(spans) > SEARCH_EXCERPT_TOKENS else text
+
+def search_doc_key(doc_type: str, doc_id: str) -> str:
+    # Articles are keyed by their bare id; other documents by type and id
+    return doc_id if doc_type == "article" else f"{doc_type}:{doc_id}"
+
+def search_fields(doc_type: str, doc: dict) -> List[tuple]:
+    # Every type maps onto the same title, tags and content fields
+    if doc_type == "article":
+        return article_search_fields(doc)
+    if doc_type in ("category", "subcategory"):
+        return [("title", doc.get("name", "")), ("tags", ""), ("content", doc.get("description") or "")]
+    if doc_type == "flow":
+        return [("title", doc.get("title", "")), ("tags", " ".join(doc.get("tags") or [])), ("content", doc.get("description") or "")]
+    return [("title", doc.get("question_text", "")), ("tags", ""), ("content", strip_html(doc.get("description") or ""))]
+
+def search_record(doc_type: str, doc: dict) -> dict:
+    # Records carry what result rendering and visibility checks need, so hits
+    # never have to be re-read. Short descriptions are kept for snippets;
+    # article bodies only up to SEARCH_EXCERPT_TOKENS, so matches further in
+    # get a snippet from the start of the article.
+    fields = search_fields(doc_type, doc)
+    title_length = len(tokenize(fields[0][1]))
+    record = {
+        "key": search_doc_key(doc_type, doc["id"]),
+        "type": doc_type,
+        "id": doc["id"],
+        "title": fields[0][1],
+        "title_length": title_length,
+        "content_start": title_length + len(tokenize(fields[1][1]))
+    }
+    if doc_type == "article":
+        updated_at = doc.get("updated_at")
+        record.update({
+            "wiki_id": doc.get("wiki_id"),
+            "subcategory_id": doc.get("subcategory_id"),
+            "visibility": doc.get("visibility"),
+            "created_by": doc.get("created_by"),
+            "tags": doc.get("tags") or [],
+            "view_count": doc.get("view_count", 0),
+            "updated_at": updated_at.isoformat() if isinstance(updated_at, datetime) else updated_at,
+            "content": search_excerpt(fields[2][1])
+        })
+    elif doc_type in ("category", "subcategory"):
+        record.update({"wiki_id": doc.get("wiki_id"), "category_id": doc.get("category_id"), "content": fields[2][1]})
+    elif doc_type == "flow":
+        record.update({
+            "visibility": doc.get("visibility"),
+            "created_by": doc.get("created_by"),
+            "tags": doc.get("tags") or [],
+            "content": fields[2][1]
+        })
+    else:
+        record.update({"flow_id": doc.get("flow_id"), "step_order": doc.get("step_order"), "content": fields[2][1]})
+    return record
+
+def search_terms(fields: List[tuple]) -> Dict[str, tuple]:
+    # term -> (weight, token positions)
+    weights: Dict[str, int] = {}
+    positions: Dict[str, List[int]] = {}
+    position = 0
+    for field, text in fields:
+        weight = SEARCH_FIELD_WEIGHTS[field]
+        for token in tokenize(text):
+            weights[token] = weights.get(token, 0) + weight
+            positions.setdefault(token, []).append(position)
+            position += 1
+    return {term: (weights[term], tuple(positions[term])) for term in weights}
+
+def build_snippet(text: str, positions: List[int], content_start: int) -> str:
+    # Cut a window of SEARCH_SNIPPET_TOKENS tokens around the densest cluster of
+    # matched content positions and wrap the matches in <mark>. The text must
+    # be the content field exactly as indexed, so positions line up; it is
+    # HTML-escaped so the snippet can be rendered as markup.
+    spans = token_spans(text)
+    if not spans:
+        return html.escape(" ".join(text.split())[:200])
+    hits = sorted({position - content_start for position in positions if 0 <= position - content_start < len(spans)})
+
+    window_start, best = 0, 0
+    first = 0
+    for last in range(len(hits)):
+        while hits[last] - hits[first] >= SEARCH_SNIPPET_TOKENS:
+            first += 1
+        if last - first + 1 > best:
+            best = last - first + 1
+            window_start = max(0, hits[first] - 5)
+    window_end = min(len(spans), window_start + SEARCH_SNIPPET_TOKENS)
+
+    marked = set(hits)
+    pieces = ["\u2026 " if window_start > 0 else ""]
+    cursor = spans[window_start][0]
+    for token in range(window_start, window_end):
+        start, end = spans[token]
+        pieces.append(html.escape(re.sub(r"\s+", " ", text[cursor:start])))
+        word = html.escape(text[start:end])
+        pieces.append(f"<mark>{word}</mark>" if token in marked else word)
+        cursor = end
+    if window_end < len(spans):
+        pieces.append(" \u2026")
+    return "".join(pieces)
+
+def encode_positions(positions) -> bytes:
+    encoded = bytearray()
+    previous = 0
+    for position in positions:
+        encode_varint(position - previous, encoded)
+        previous = position
+    return bytes(encoded)
+
+def overlay_postings_size(entries: Dict[str, tuple]) -> int:
+    # Lower bound on the snapshot encoding of overlay postings (one byte per
+    # varint), so overlay and snapshot terms draw on the same byte budget
+    return sum(3 + len(positions) for _, positions in entries.values())
+
+# Query parsing
+# Search input is parsed into a small tree that is evaluated against the
+# index and never reaches Mongo as a pattern. Nodes are ("terms", field,
+# terms, prefix) leaves, where more than one term is a phrase, plus
+# ("and", children), ("or", children) and ("not", child). Inputs that are too
+# long, too deep or have too many clauses are rejected; malformed syntax such
+# as a dangling operator or an unbalanced parenthesis is dropped.
+SEARCH_QUERY_LEXER_RE = re.compile(r'\(|\)|(?:(?P<field>[A-Za-z]+):)?(?:"(?P<phrase>[^"]*)"?|(?P<word>[^\s()"]+))')
+SEARCH_QUERY_FIELDS = {"title": "title", "tag": "tags", "tags": "tags"}
+SEARCH_QUERY_OPERATORS = {"AND", "OR", "NOT"}
+SEARCH_FIELD_RANGES = {
+    "title": lambda record: (0, record["title_length"]),
+    "tags": lambda record: (record["title_length"], record["content_start"])
+}
+
+class SearchQueryTooBroad(Exception):
+    pass
+
+def lex_search_query(q: str) -> List[tuple]:
+    tokens = []
+    for match in SEARCH_QUERY_LEXER_RE.finditer(q):
+        text = match.group(0)
+        if text in ("(", ")"):
+            tokens.append((text, None))
+            continue
+        field, phrase, word = match.group("field"), match.group("phrase"), match.group("word")
+        if field and field.lower() not in SEARCH_QUERY_FIELDS:
+            # Not a field we know (a URL, a time): search the text as written
+            field, phrase, word = None, None, text
+        if phrase is None and field is None:
+            if word in SEARCH_QUERY_OPERATORS:
+                tokens.append((word, None))
+                continue
+            if word.startswith("-") and len(word) > 1:
+                tokens.append(("NOT", None))
+                word = word[1:]
+        terms = tokenize(phrase if phrase is not None else word)
+        if terms:
+            quoted = phrase is not None
+            tokens.append(("LEAF", ("terms", SEARCH_QUERY_FIELDS.get((field or "").lower()), tuple(terms), quoted)))
+    return tokens
+
+def parse_search_query(q: str, prefix_last: bool = False) -> Optional[tuple]:
+    # Returns None when the input contains nothing searchable. With
+    # prefix_last, a trailing unquoted word the user is still typing matches
+    # as a prefix.
+    if len(q) > SEARCH_QUERY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Search query is limited to {SEARCH_QUERY_MAX_LENGTH} characters")
+    tokens = lex_search_query(q)
+    leaf_positions = [position for position, (kind, _) in enumerate(tokens) if kind == "LEAF"]
+    if len(leaf_positions) > SEARCH_QUERY_MAX_CLAUSES:
+        raise HTTPException(status_code=400, detail=f"Search query is limited to {SEARCH_QUERY_MAX_CLAUSES} terms")
+    for position in leaf_positions:
+        kind, (_, field, terms, quoted) = tokens[position]
+        prefix = (prefix_last and position == len(tokens) - 1 and not quoted and not q[-1:].isspace()
+                  and len(terms[-1]) >= SEARCH_QUERY_MIN_PREFIX_LENGTH and tokens[position - 1][0] != "NOT")
+        tokens[position] = (kind, ("terms", field, terms, prefix))
+
+    pos = 0
+
+    def parse_or(depth: int) -> Optional[tuple]:
+        nonlocal pos
+        if depth > SEARCH_QUERY_MAX_DEPTH:
+            raise HTTPException(status_code=400, detail="Search query is nested too deeply")
+        branches = [parse_and(depth)]
+        while pos < len(tokens) and tokens[pos][0] == "OR":
+            pos += 1
+            branches.append(parse_and(depth))
+        branches = [branch for branch in branches if branch is not None]
+        if len(branches) > 1:
+            return ("or", branches)
+        return branches[0] if branches else None
+
+    def parse_and(depth: int) -> Optional[tuple]:
+        nonlocal pos
+        children = []
+        while pos < len(tokens) and tokens[pos][0] not in ("OR", ")"):
+            if tokens[pos][0] == "AND":
+                pos += 1
+                continue
+            child = parse_unary(depth)
+            if child is not None:
+                children.append(child)
+        if len(children) == 1 and children[0][0] != "not":
+            return children[0]
+        return ("and", children) if children else None
+
+    def parse_unary(depth: int) -> Optional[tuple]:
+        nonlocal pos
+        kind, value = tokens[pos]
+        pos += 1
+        if kind == "NOT":
+            if pos >= len(tokens) or tokens[pos][0] in ("AND", "OR", ")"):
+                return None
+            child = parse_unary(depth)
+            if child is None:
+                return None
+            return child[1] if child[0] == "not" else ("not", child)
+        if kind == "(":
+            inner = parse_or(depth + 1)
+            if pos < len(tokens) and tokens[pos][0] == ")":
+                pos += 1
+            return inner
+        return value
+
+    parts = []
+    while pos < len(tokens):
+        node = parse_or(0)
+        if node is not None:
+            parts.append(node)
+        if pos < len(tokens) and tokens[pos][0] == ")":
+            # Stray closing parenthesis
+            pos += 1
+    if not parts:
+        return None
+    node = parts[0] if len(parts) == 1 and parts[0][0] != "not" else ("and", parts)
+    check_search_query(node)
+    return node
+
+def check_search_query(node: tuple, in_and: bool = False):
+    # Negation only narrows a conjunction; on its own it would match the
+    # whole index
+    kind = node[0]
+    if kind == "not":
+        if not in_and:
+            raise HTTPException(status_code=400, detail="NOT must be combined with a term to search for")
+        check_search_query(node[1])
+    elif kind == "and":
+        if all(child[0] == "not" for child in node[1]):
+            raise HTTPException(status_code=400, detail="NOT must be combined with a term to search for")
+        for child in node[1]:
+            check_search_query(child, in_and=True)
+    elif kind == "or":
+        for child in node[1]:
+            check_search_query(child)
+
+def simple_query_terms(node: Optional[tuple]) -> Optional[List[str]]:
+    # The plain terms of a query made only of unfielded words, for typo
+    # correction; None for anything using phrases, fields or operators
+    if node is None:
+        return None
+    leaves = node[1] if node[0] == "and" else [node]
+    if all(leaf[0] == "terms" and leaf[1] is None and len(leaf[2]) == 1 for leaf in leaves):
+        return [leaf[2][0] for leaf in leaves]
+    return None
+
+# Read-only view over a memory-mapped snapshot. Documents are stored sorted by
+# id and terms sorted by their UTF-8 bytes, so both are found by binary search
+# without loading anything into the heap. Each posting list is a run of varint
+# (doc number delta, weight, positions byte length) followed by the
+# delta-encoded token positions, which are only decoded for returned hits.
+class SearchSnapshot:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        if len(buf) < SEARCH_SNAPSHOT_HEADER.size:
+            raise ValueError("Search snapshot is truncated")
+        (magic, version, _, self.last_seq, self.doc_count, self.term_count,
+         doc_data, doc_offsets, postings_data, term_data, term_offsets, postings_offsets,
+         end) = SEARCH_SNAPSHOT_HEADER.unpack_from(buf, 0)
+        if magic != SEARCH_SNAPSHOT_MAGIC or version != SEARCH_SNAPSHOT_FORMAT_VERSION or end != len(buf):
+            raise ValueError("Incompatible search snapshot")
+        self._doc_data = buf[doc_data:doc_offsets]
+        self._doc_offsets = buf[doc_offsets:doc_offsets + 8 * (self.doc_count + 1)].cast("Q")
+        self._postings_data = buf[postings_data:term_data]
+        self._term_data = buf[term_data:term_offsets]
+        self._term_offsets = buf[term_offsets:term_offsets + 8 * (self.term_count + 1)].cast("Q")
+        self._postings_offsets = buf[postings_offsets:postings_offsets + 8 * (self.term_count + 1)].cast("Q")
+
+    def raw_doc(self, doc_num: int) -> bytes:
+        # Records are the document id, a NUL byte and the JSON-encoded record
+        return bytes(self._doc_data[self._doc_offsets[doc_num]:self._doc_offsets[doc_num + 1]])
+
+    def doc_id(self, doc_num: int) -> str:
+        record = self.raw_doc(doc_num)
+        return record[:record.index(b"\x00")].decode()
+
+    def doc(self, doc_num: int) -> dict:
+        record = self.raw_doc(doc_num)
+        return json.loads(record[record.index(b"\x00") + 1:])
+
+    def find_doc(self, doc_id: str) -> int:
+        lo, hi = 0, self.doc_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.doc_id(mid) < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.doc_count and self.doc_id(lo) == doc_id:
+            return lo
+        return -1
+
+    def term(self, term_num: int) -> bytes:
+        return bytes(self._term_data[self._term_offsets[term_num]:self._term_offsets[term_num + 1]])
+
+    def _bisect_term(self, key: bytes) -> int:
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_term(self, term: str) -> int:
+        key = term.encode()
+        term_num = self._bisect_term(key)
+        if term_num < self.term_count and self.term(term_num) == key:
+            return term_num
+        return -1
+
+    def prefix_range(self, prefix: str):
+        key = prefix.encode()
+        # 0xff never occurs in UTF-8, so it sorts after every term sharing the prefix
+        return self._bisect_term(key), self._bisect_term(key + b"\xff")
+
+    def postings(self, term_num: int) -> List[tuple]:
+        # (doc number, weight, positions offset, positions end)
+        buf = self._postings_data
+        pos = self._postings_offsets[term_num]
+        end = self._postings_offsets[term_num + 1]
+        entries = []
+        doc_num = 0
+        while pos < end:
+            delta, pos = decode_varint(buf, pos)
+            weight, pos = decode_varint(buf, pos)
+            length, pos = decode_varint(buf, pos)
+            doc_num += delta
+            entries.append((doc_num, weight, pos, pos + length))
+            pos += length
+        return entries
+
+    def postings_size(self, term_num: int) -> int:
+        return self._postings_offsets[term_num + 1] - self._postings_offsets[term_num]
+
+    def raw_positions(self, start: int, end: int) -> bytes:
+        return bytes(self._postings_data[start:end])
+
+    def positions(self, start: int, end: int) -> List[int]:
+        buf = self._postings_data
+        positions = []
+        position = 0
+        while start < end:
+            delta, start = decode_varint(buf, start)
+            position += delta
+            positions.append(position)
+        return positions
+
+def _pad_to_word(f):
+    padding = -f.tell() % 8
+    if padding:
+        f.write(b"\x00" * padding)
+
+def write_search_snapshot(path: str, snapshot: Optional[SearchSnapshot], docs: Dict[str, dict],
+                          postings: Dict[str, Dict[str, tuple]], removed: set, last_seq: int):
+    # Merge a base snapshot with overlay changes into a new snapshot file. Sections
+    # are streamed to disk one at a time so compaction never holds all postings in
+    # memory, and the file is swapped in atomically at the end.
+    base_count = snapshot.doc_count if snapshot else 0
+    overlay_ids = sorted(docs)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"\x00" * SEARCH_SNAPSHOT_HEADER.size)
+        _pad_to_word(f)
+
+        # Documents: merge surviving base documents with overlay documents by id
+        remap = array("q", [-1]) * base_count
+        overlay_nums: Dict[str, int] = {}
+        doc_offsets = array("Q", [0])
+        doc_data_start = f.tell()
+        base_num, overlay_pos, doc_count = 0, 0, 0
+        while True:
+            while base_num < base_count and base_num in removed:
+                base_num += 1
+            base_id = snapshot.doc_id(base_num) if base_num < base_count else None
+            overlay_id = overlay_ids[overlay_pos] if overlay_pos < len(overlay_ids) else None
+            if base_id is None and overlay_id is None:
+                break
+            if overlay_id is None or (base_id is not None and base_id < overlay_id):
+                record = snapshot.raw_doc(base_num)
+                remap[base_num] = doc_count
+                base_num += 1
+            else:
+                record = overlay_id.encode() + b"\x00" + json.dumps(docs[overlay_id], separators=(",", ":")).encode()
+                overlay_nums[overlay_id] = doc_count
+                overlay_pos += 1
+            f.write(record)
+            doc_count += 1
+            doc_offsets.append(f.tell() - doc_data_start)
+        _pad_to_word(f)
+        doc_offsets_start = f.tell()
+        f.write(doc_offsets.tobytes())
+
+        # Posting lists: merge base and overlay terms in sorted order
+        postings_start = f.tell()
+        terms = bytearray()
+        term_offsets = array("Q", [0])
+        postings_offsets = array("Q", [0])
+        overlay_terms = sorted(term.encode() for term in postings)
+        base_term, overlay_term_pos = 0, 0
+        base_term_count = snapshot.term_count if snapshot else 0
+        while base_term < base_term_count or overlay_term_pos < len(overlay_terms):
+            base_key = snapshot.term(base_term) if base_term < base_term_count else None
+            overlay_key = overlay_terms[overlay_term_pos] if overlay_term_pos < len(overlay_terms) else None
+            entries = []
+            if base_key is not None and (overlay_key is None or base_key <= overlay_key):
+                key = base_key
+                # Positions of surviving base documents are copied without decoding
+                entries.extend(
+                    (remap[doc_num], weight, snapshot.raw_positions(start, end))
+                    for doc_num, weight, start, end in snapshot.postings(base_term) if remap[doc_num] >= 0
+                )
+                base_term += 1
+            else:
+                key = overlay_key
+            if overlay_key == key:
+                entries.extend(
+                    (overlay_nums[doc_id], weight, encode_positions(positions))
+                    for doc_id, (weight, positions) in postings[key.decode()].items()
+                )
+                overlay_term_pos += 1
+            if not entries:
+                continue
+            entries.sort()
+            encoded = bytearray()
+            previous = 0
+            for doc_num, weight, encoded_positions in entries:
+                encode_varint(doc_num - previous, encoded)
+                encode_varint(weight, encoded)
+                encode_varint(len(encoded_positions), encoded)
+                encoded.extend(encoded_positions)
+                previous = doc_num
+            f.write(encoded)
+            terms.extend(key)
+            term_offsets.append(len(terms))
+            postings_offsets.append(f.tell() - postings_start)
+
+        term_data_start = f.tell()
+        f.write(terms)
+        _pad_to_word(f)
+        term_offsets_start = f.tell()
+        f.write(term_offsets.tobytes())
+        postings_offsets_start = f.tell()
+        f.write(postings_offsets.tobytes())
+        end = f.tell()
+
+        f.seek(0)
+        f.write(SEARCH_SNAPSHOT_HEADER.pack(
+            SEARCH_SNAPSHOT_MAGIC, SEARCH_SNAPSHOT_FORMAT_VERSION, 0, last_seq, doc_count, len(term_offsets) - 1,
+            doc_data_start, doc_offsets_start, postings_start, term_data_start, term_offsets_start,
+            postings_offsets_start, end
+        ))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Inverted index over articles, categories, subcategories, flows and flow steps:
+# a shared snapshot plus an in-memory overlay.
+# Documents changed since the snapshot live in the overlay and their base copies
+# are masked by doc number, so queries see the state after the last applied change.
+class SearchIndex:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, "search.idx")
+        self.lock_path = os.path.join(directory, "search.lock")
+        self.snapshot: Optional[SearchSnapshot] = None
+        self.snapshot_stat = None
+        self.applied_seq = 0
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._docs: Dict[str, dict] = {}
+        self._doc_terms: Dict[str, Dict[str, tuple]] = {}
+        self._postings: Dict[str, Dict[str, tuple]] = {}
+        self._removed: set = set()
+
+    def open_snapshot(self):
+        snapshot = SearchSnapshot(self.snapshot_path)
+        stat = os.stat(self.snapshot_path)
+        with self._lock:
+            self.snapshot = snapshot
+            self.snapshot_stat = (stat.st_ino, stat.st_mtime_ns)
+            self.applied_seq = snapshot.last_seq
+
+    def snapshot_changed(self) -> bool:
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) != self.snapshot_stat
+
+    @property
+    def overlay_size(self) -> int:
+        return len(self._docs) + len(self._removed)
+
+    @property
+    def doc_count(self) -> int:
+        base_count = self.snapshot.doc_count if self.snapshot else 0
+        return base_count - len(self._removed) + len(self._docs)
+
+    def _remove_locked(self, doc_id: str):
+        terms = self._doc_terms.pop(doc_id, None)
+        if terms is not None:
+            del self._docs[doc_id]
+            for term in terms:
+                term_postings = self._postings[term]
+                del term_postings[doc_id]
+                if not term_postings:
+                    del self._postings[term]
+        if self.snapshot:
+            doc_num = self.snapshot.find_doc(doc_id)
+            if doc_num >= 0:
+                self._removed.add(doc_num)
+
+    def apply(self, upserts: List[tuple], removals: List[str], seq: int):
+        with self._lock:
+            for doc_id in removals:
+                self._remove_locked(doc_id)
+            for record, terms in upserts:
+                doc_id = record["key"]
+                self._remove_locked(doc_id)
+                self._docs[doc_id] = record
+                self._doc_terms[doc_id] = terms
+                for term, posting in terms.items():
+                    self._postings.setdefault(term, {})[doc_id] = posting
+            self.applied_seq = max(self.applied_seq, seq)
+
+    def record(self, doc_id: str) -> Optional[dict]:
+        with self._lock:
+            if doc_id in self._docs:
+                return self._docs[doc_id]
+            if self.snapshot:
+                doc_num = self.snapshot.find_doc(doc_id)
+                if doc_num >= 0 and doc_num not in self._removed:
+                    return self.snapshot.doc(doc_num)
+        return None
+
+    def iter_records(self):
+        with self._lock:
+            snapshot, removed, overlay_docs = self.snapshot, set(self._removed), list(self._docs.values())
+        if snapshot:
+            for doc_num in range(snapshot.doc_count):
+                if doc_num not in removed:
+                    yield snapshot.doc(doc_num)
+        yield from overlay_docs
+
+    def capture(self):
+        # Copy the overlay so a snapshot can be written without holding the lock
+        with self._lock:
+            return (
+                self.snapshot,
+                dict(self._docs),
+                {term: dict(entries) for term, entries in self._postings.items()},
+                set(self._removed),
+                self.applied_seq
+            )
+
+    def _matching_terms(self, term: str, expand: bool) -> Dict[str, int]:
+        # Maps each matching term to its snapshot term number (-1 when the term
+        # only exists in the overlay)
+        matches: Dict[str, int] = {}
+        if expand:
+            if self.snapshot:
+                lo, hi = self.snapshot.prefix_range(term)
+                for term_num in range(lo, min(hi, lo + SEARCH_PREFIX_EXPANSION_LIMIT)):
+                    matches[self.snapshot.term(term_num).decode()] = term_num
+            for overlay_term in [t for t in self._postings if t.startswith(term)][:SEARCH_PREFIX_EXPANSION_LIMIT]:
+                matches.setdefault(overlay_term, -1)
+        else:
+            term_num = self.snapshot.find_term(term) if self.snapshot else -1
+            if term_num >= 0 or term in self._postings:
+                matches[term] = term_num
+        return matches
+
+    def _term_scores(self, term: str, expand: bool, total_docs: int, budget: list) -> Dict[Any, list]:
+        # Keys are base doc numbers (int) or overlay doc ids (str); values are
+        # [score, position sources] where a source is a slice of snapshot
+        # posting bytes or a tuple of overlay positions. budget[0] is the
+        # number of posting bytes the query may still decode.
+        scores: Dict[Any, list] = {}
+        for matched_term, term_num in self._matching_terms(term, expand).items():
+            overlay_entries = self._postings.get(matched_term, {})
+            budget[0] -= (self.snapshot.postings_size(term_num) if term_num >= 0 else 0) + overlay_postings_size(overlay_entries)
+            if budget[0] < 0:
+                raise SearchQueryTooBroad(term)
+            entries = []
+            if term_num >= 0:
+                entries.extend((doc_num, weight, slice(start, end)) for doc_num, weight, start, end in self.snapshot.postings(term_num)
+                               if doc_num not in self._removed)
+            entries.extend((doc_id, weight, positions) for doc_id, (weight, positions) in overlay_entries.items())
+            if not entries:
+                continue
+            idf = math.log(1 + total_docs / len(entries))
+            for key, weight, source in entries:
+                entry = scores.setdefault(key, [0, []])
+                entry[0] = max(entry[0], weight * idf)
+                entry[1].append(source)
+        return scores
+
+    def _resolve_positions(self, sources: list) -> List[int]:
+        positions = set()
+        for source in sources:
+            if isinstance(source, slice):
+                positions.update(self.snapshot.positions(source.start, source.stop))
+            else:
+                positions.update(source)
+        return sorted(positions)
+
+    def _record_for(self, key) -> dict:
+        return self._docs[key] if isinstance(key, str) else self.snapshot.doc(key)
+
+    def _leaf_scores(self, node: tuple, total_docs: int, budget: list) -> Dict[Any, list]:
+        # A leaf is one term or a phrase, optionally restricted to a field.
+        # Phrases and fields are checked against token positions, which are
+        # only decoded for documents containing every term of the leaf.
+        _, field, terms, prefix = node
+        per_term = []
+        for position, term in enumerate(terms):
+            term_scores = self._term_scores(term, prefix and position == len(terms) - 1, total_docs, budget)
+            if not term_scores:
+                return {}
+            per_term.append(term_scores)
+        if len(terms) == 1 and field is None:
+            return per_term[0]
+
+        scores: Dict[Any, list] = {}
+        for key in set(per_term[0]).intersection(*per_term[1:]):
+            record = self._record_for(key)
+            lo, hi = SEARCH_FIELD_RANGES[field](record) if field else (0, math.inf)
+            positions = [
+                {position for position in self._resolve_positions(term_scores[key][1]) if lo <= position < hi}
+                for term_scores in per_term
+            ]
+            starts = {
+                start for start in positions[0]
+                if all(start + offset in positions[offset] for offset in range(1, len(positions)))
+            }
+            if starts:
+                matched = tuple(sorted(start + offset for start in starts for offset in range(len(positions))))
+                scores[key] = [sum(term_scores[key][0] for term_scores in per_term), [matched]]
+        return scores
+
+    def _evaluate(self, node: tuple, total_docs: int, budget: list) -> Dict[Any, list]:
+        kind = node[0]
+        if kind == "terms":
+            return self._leaf_scores(node, total_docs, budget)
+        if kind == "or":
+            scores: Dict[Any, list] = {}
+            for child in node[1]:
+                for key, (score, sources) in self._evaluate(child, total_docs, budget).items():
+                    entry = scores.setdefault(key, [0, []])
+                    entry[0] += score
+                    entry[1] = entry[1] + sources
+            return scores
+        # "and": intersect the positive children, then drop negated matches
+        scores = None
+        for child in node[1]:
+            if child[0] == "not":
+                continue
+            child_scores = self._evaluate(child, total_docs, budget)
+            if scores is None:
+                scores = child_scores
+            else:
+                scores = {
+                    key: [score + child_scores[key][0], sources + child_scores[key][1]]
+                    for key, (score, sources) in scores.items() if key in child_scores
+                }
+            if not scores:
+                return {}
+        for child in node[1]:
+            if child[0] == "not" and scores:
+                excluded = self._evaluate(child[1], total_docs, budget)
+                scores = {key: value for key, value in scores.items() if key not in excluded}
+        return scores or {}
+
+    def search(self, terms: List[str], prefix_last: bool = False, limit: int = 10, accept=None) -> List[tuple]:
+        # Conjunction of plain terms, the last one optionally matched as a prefix
+        if not terms:
+            return []
+        return self.search_query(
+            ("and", [("terms", None, (term, ), prefix_last and position == len(terms) - 1) for position, term in enumerate(terms)]),
+            limit, accept
+        )
+
+    def search_query(self, node: tuple, limit: int = 10, accept=None) -> List[tuple]:
+        # Returns (score, record, matched token positions) for the best hits of
+        # a parsed query. Raises SearchQueryTooBroad when the query would
+        # decode more than SEARCH_QUERY_MAX_POSTING_BYTES of postings.
+        with self._lock:
+            scores = self._evaluate(node, max(self.doc_count, 1), [SEARCH_QUERY_MAX_POSTING_BYTES])
+
+            results = []
+            for key, (score, sources) in sorted(scores.items(), key=lambda item: item[1][0], reverse=True):
+                record = self._record_for(key)
+                if accept is None or accept(record):
+                    results.append((score, record, self._resolve_positions(sources)))
+                    if len(results) >= limit:
+                        break
+            return results
+
+search_index = SearchIndex(SEARCH_INDEX_DIR)
+
+def run_search_query(node: Optional[tuple], limit: int, accept=None) -> List[tuple]:
+    if node is None:
+        return []
+    try:
+        return search_index.search_query(node, limit, accept)
+    except SearchQueryTooBroad:
+        raise HTTPException(status_code=400, detail="Search query is too broad, add more specific terms")
+
+# Mongo filter fields that index records carry, per listing endpoint
+ARTICLE_SEARCH_FILTER_FIELDS = ("wiki_id", "subcategory_id", "visibility", "tags")
+FLOW_SEARCH_FILTER_FIELDS = ("visibility", "tags")
+
+def search_record_matches(record: dict, query: dict, fields: tuple) -> bool:
+    # Evaluates the equality, $in and $ne conditions of a listing query
+    # against an index record; list fields match like Mongo arrays do
+    for field in fields:
+        if field not in query:
+            continue
+        condition = query[field]
+        value = record.get(field)
+        values = value if isinstance(value, list) else [value]
+        if isinstance(condition, dict):
+            if "$in" in condition and not any(item in condition["$in"] for item in values):
+                return False
+            if "$ne" in condition and condition["$ne"] in values:
+                return False
+        elif condition not in values:
+            return False
+    return True
+
+def find_with_time_limit(cursor) -> List[dict]:
+    # Reads that follow a search are bounded so a slow query cannot pin Mongo
+    try:
+        return list(cursor.max_time_ms(SEARCH_QUERY_MAX_TIME_MS))
+    except ExecutionTimeout:
+        raise HTTPException(status_code=503, detail="Search took too long, try a more specific query")
+
+# Typeahead
+# Titles, tags and category names are kept in a sorted array of phrase keys so a
+# prefix maps to a contiguous range found by bisection. Every word start of a
+# phrase is a key, so "pass" also suggests "Reset password".
+SUGGEST_MAX_WORD_STARTS = 4
+SUGGEST_SCAN_LIMIT = 2000
+SUGGEST_RANKED_CACHE_SIZE = 256
+SUGGEST_POPULARITY_REFRESH_SECONDS = int(os.getenv("SUGGEST_POPULARITY_REFRESH_SECONDS", "60"))
+
+class SuggestIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys: List[str] = []
+        self._entries: Dict[str, dict] = {}
+        self._entry_keys: Dict[str, List[str]] = {}
+        self._article_tags: Dict[str, tuple] = {}
+        # Popularity-ordered entries for prefixes whose range is too wide to scan
+        self._ranked: "OrderedDict[str, List[str]]" = OrderedDict()
+        # Keys collected during a bulk build, sorted into _keys once at the end
+        self._bulk_keys: Optional[set] = None
+        self.popularity_checked_at = datetime.utcnow()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(tokenize(text))
+
+    def _add_keys(self, entry_key: str, text: str):
+        words = tokenize(text)
+        keys = [" ".join(words[start:]) + "\x00" + entry_key for start in range(min(len(words), SUGGEST_MAX_WORD_STARTS))]
+        if self._bulk_keys is not None:
+            self._bulk_keys.update(keys)
+        else:
+            for key in keys:
+                bisect.insort(self._keys, key)
+        self._entry_keys[entry_key] = keys
+
+    def _drop_keys(self, entry_key: str):
+        for key in self._entry_keys.pop(entry_key, []):
+            if self._bulk_keys is not None and key in self._bulk_keys:
+                self._bulk_keys.discard(key)
+                continue
+            position = bisect.bisect_left(self._keys, key)
+            if position < len(self._keys) and self._keys[position] == key:
+                del self._keys[position]
+
+    def _set_entry(self, entry: dict):
+        entry_key = entry["key"]
+        previous = self._entries.get(entry_key)
+        if previous is None or previous["text"] != entry["text"]:
+            self._drop_keys(entry_key)
+            self._add_keys(entry_key, entry["text"])
+        self._entries[entry_key] = entry
+
+    def _drop_entry(self, entry_key: str):
+        self._drop_keys(entry_key)
+        self._entries.pop(entry_key, None)
+
+    def _adjust_tag(self, wiki_id: str, visibility: str, tag: str, delta: int):
+        entry_key = f"tag:{wiki_id}:{tag.lower()}"
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            if delta < 0:
+                return
+            entry = {"key": entry_key, "type": "tag", "id": tag, "text": tag, "wiki_id": wiki_id, "counts": {}, "popularity": 0}
+        counts = entry["counts"]
+        counts[visibility] = counts.get(visibility, 0) + delta
+        if counts[visibility] <= 0:
+            del counts[visibility]
+        entry["popularity"] = sum(counts.values())
+        if entry["popularity"] <= 0:
+            self._drop_entry(entry_key)
+        else:
+            self._set_entry(entry)
+
+    def start_bulk(self):
+        # Inserting keys one by one is O(n) each; a full build instead sorts
+        # once in finish_bulk
+        with self._lock:
+            self._bulk_keys = set()
+
+    def finish_bulk(self):
+        with self._lock:
+            self._keys.extend(self._bulk_keys)
+            self._keys.sort()
+            self._bulk_keys = None
+            self._ranked.clear()
+
+    def _remove_article_locked(self, article_id: str):
+        self._drop_entry(f"article:{article_id}")
+        previous = self._article_tags.pop(article_id, None)
+        if previous:
+            wiki_id, visibility, tags = previous
+            for tag in tags:
+                self._adjust_tag(wiki_id, visibility, tag, -1)
+
+    def apply_articles(self, records: List[dict], removals: List[str]):
+        with self._lock:
+            for article_id in removals:
+                self._remove_article_locked(article_id)
+            for record in records:
+                self._remove_article_locked(record["id"])
+                self._set_entry({
+                    "key": f"article:{record['id']}",
+                    "type": "article",
+                    "id": record["id"],
+                    "text": record["title"],
+                    "wiki_id": record["wiki_id"],
+                    "visibility": record["visibility"],
+                    "popularity": record.get("view_count", 0)
+                })
+                tags = list(dict.fromkeys(tag for tag in record["tags"] if tag))
+                self._article_tags[record["id"]] = (record["wiki_id"], record["visibility"], tags)
+                for tag in tags:
+                    self._adjust_tag(record["wiki_id"], record["visibility"], tag, 1)
+            self._ranked.clear()
+
+    def apply_categories(self, entries: List[dict], removals: List[str]):
+        # Category and subcategory entries, keyed "<type>:<id>"
+        with self._lock:
+            for entry_key in removals:
+                self._drop_entry(entry_key)
+            for entry in entries:
+                self._set_entry(entry)
+            self._ranked.clear()
+
+    def update_popularity(self, article_views: Dict[str, int]):
+        with self._lock:
+            for article_id, views in article_views.items():
+                entry = self._entries.get(f"article:{article_id}")
+                if entry:
+                    entry["popularity"] = views
+            self._ranked.clear()
+
+    def _ranked_entry_keys(self, prefix: str, lo: int, hi: int) -> List[str]:
+        if hi - lo > SUGGEST_SCAN_LIMIT:
+            ranked = self._ranked.get(prefix)
+            if ranked is not None:
+                self._ranked.move_to_end(prefix)
+                return ranked
+        entry_keys = {key.rsplit("\x00", 1)[1] for key in self._keys[lo:hi]}
+        ranked = sorted(entry_keys, key=lambda entry_key: self._entries[entry_key]["popularity"], reverse=True)
+        if hi - lo > SUGGEST_SCAN_LIMIT:
+            self._ranked[prefix] = ranked
+            if len(self._ranked) > SUGGEST_RANKED_CACHE_SIZE:
+                self._ranked.popitem(last=False)
+        return ranked
+
+    def suggest(self, prefix: str, limit: int, accept) -> List[dict]:
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            lo = bisect.bisect_left(self._keys, prefix)
+            hi = bisect.bisect_left(self._keys, prefix + "\uffff")
+            results = []
+            seen = set()
+            for entry_key in self._ranked_entry_keys(prefix, lo, hi):
+                entry = self._entries[entry_key]
+                # Tags are tracked per wiki but suggested once
+                dedupe_key = (entry["type"], entry["text"].lower()) if entry["type"] == "tag" else entry_key
+                if dedupe_key in seen or not accept(entry):
+                    continue
+                seen.add(dedupe_key)
+                results.append(entry)
+                if len(results) >= limit:
+                    break
+            return results
+
+suggest_index = SuggestIndex()
+
+# Fuzzy matching
+# The vocabulary of article title and tag terms is indexed by trigram. A
+# misspelled query term gathers candidate terms sharing enough trigrams, which
+# are then reranked by bounded edit distance. Working on distinct terms rather
+# than articles keeps lookups small no matter how many articles there are.
+FUZZY_MIN_RESULTS = 3
+FUZZY_MIN_TERM_LENGTH = 3
+FUZZY_MAX_CANDIDATES = 5
+
+def term_trigrams(term: str) -> set:
+    padded = f"${term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def bounded_edit_distance(a: str, b: str, limit: int) -> int:
+    # Levenshtein distance, giving up with limit + 1 once every cell of a row exceeds limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def max_edit_distance(term: str) -> int:
+    return 1 if len(term) <= 4 else 2
+
+class FuzzyIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._term_counts: Dict[str, int] = {}
+        self._trigrams: Dict[str, set] = {}
+        self._article_terms: Dict[str, tuple] = {}
+
+    @staticmethod
+    def record_terms(record: dict) -> tuple:
+        text = " ".join([record["title"]] + list(record["tags"]))
+        return tuple({token for token in tokenize(text) if len(token) >= FUZZY_MIN_TERM_LENGTH and not token.isdigit()})
+
+    def _add_term(self, term: str):
+        count = self._term_counts.get(term, 0)
+        self._term_counts[term] = count + 1
+        if count == 0:
+            for trigram in term_trigrams(term):
+                self._trigrams.setdefault(trigram, set()).add(term)
+
+    def _drop_term(self, term: str):
+        count = self._term_counts.get(term, 0) - 1
+        if count > 0:
+            self._term_counts[term] = count
+            return
+        self._term_counts.pop(term, None)
+        for trigram in term_trigrams(term):
+            terms = self._trigrams.get(trigram)
+            if terms is not None:
+                terms.discard(term)
+                if not terms:
+                    del self._trigrams[trigram]
+
+    def apply_articles(self, records: List[dict], removals: List[str]):
+        with self._lock:
+            for article_id in removals + [record["id"] for record in records]:
+                for term in self._article_terms.pop(article_id, ()):
+                    self._drop_term(term)
+            for record in records:
+                terms = self.record_terms(record)
+                self._article_terms[record["id"]] = terms
+                for term in terms:
+                    self._add_term(term)
+
+    def has_term(self, term: str) -> bool:
+        return term in self._term_counts
+
+    def candidates(self, term: str) -> List[str]:
+        limit = max_edit_distance(term)
+        trigrams = term_trigrams(term)
+        # Each edit touches at most three trigrams
+        min_overlap = max(1, len(trigrams) - 3 * limit)
+        with self._lock:
+            overlap: Dict[str, int] = {}
+            for trigram in trigrams:
+                for candidate in self._trigrams.get(trigram, ()):
+                    overlap[candidate] = overlap.get(candidate, 0) + 1
+            scored = []
+            for candidate, shared in overlap.items():
+                if shared < min_overlap or abs(len(candidate) - len(term)) > limit:
+                    continue
+                distance = bounded_edit_distance(term, candidate, limit)
+                if distance <= limit:
+                    scored.append((distance, -self._term_counts[candidate], candidate))
+        scored.sort()
+        return [candidate for _, _, candidate in scored[:FUZZY_MAX_CANDIDATES]]
+
+    def correct(self, terms: List[str]) -> List[str]:
+        # Replace terms missing from the vocabulary by their closest known term
+        corrected = []
+        for term in terms:
+            if len(term) < FUZZY_MIN_TERM_LENGTH or term.isdigit() or self.has_term(term):
+                corrected.append(term)
+                continue
+            candidates = self.candidates(term)
+            corrected.append(candidates[0] if candidates else term)
+        return corrected
+
+fuzzy_index = FuzzyIndex()
+
+# Search result cache
+# Search results only depend on the query, the caller's role and accessible
+# wikis, and the indexed content. Every applied change bumps a generation
+# counter for the wikis it touched (or for everything when the wiki is not
+# known), and a cached result is only served while the generation over the
+# caller's wikis is unchanged.
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+
+class ContentGenerations:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._global = 0
+        self._wikis: Dict[str, int] = {}
+
+    def bump(self, wiki_ids):
+        with self._lock:
+            self._counter += 1
+            for wiki_id in wiki_ids:
+                self._wikis[wiki_id] = self._counter
+
+    def bump_all(self):
+        with self._lock:
+            self._counter += 1
+            self._global = self._counter
+
+    def current(self, wiki_ids: Optional[frozenset]) -> int:
+        # The counter only grows, so the max changes whenever a relevant bump happens
+        with self._lock:
+            if wiki_ids is None:
+                return self._counter
+            return max([self._global] + [self._wikis.get(wiki_id, 0) for wiki_id in wiki_ids])
+
+content_generations = ContentGenerations()
+
+class SearchResultCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def get(self, key: tuple, generation: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != generation:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: tuple, generation: int, value):
+        with self._lock:
+            self._entries[key] = (generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+search_cache = SearchResultCache(SEARCH_CACHE_SIZE)
+
+def category_suggest_entries(category_ids: List[str], subcategory_ids: List[str]) -> tuple:
+    entries = []
+    found = set()
+    for category in db.wiki_categories.find({"id": {"$in": category_ids}}, {"_id": 0, "id": 1, "name": 1, "wiki_id": 1}):
+        found.add(f"category:{category['id']}")
+        entries.append({"key": f"category:{category['id']}", "type": "category", "id": category["id"],
+                        "text": category["name"], "wiki_id": category["wiki_id"], "popularity": 0})
+    subcategories = list(db.wiki_subcategories.find({"id": {"$in": subcategory_ids}}, {"_id": 0, "id": 1, "name": 1, "category_id": 1}))
+    category_wikis = {
+        category["id"]: category["wiki_id"]
+        for category in db.wiki_categories.find(
+            {"id": {"$in": list({subcat["category_id"] for subcat in subcategories})}}, {"_id": 0, "id": 1, "wiki_id": 1}
+        )
+    }
+    for subcat in subcategories:
+        found.add(f"subcategory:{subcat['id']}")
+        entries.append({"key": f"subcategory:{subcat['id']}", "type": "subcategory", "id": subcat["id"],
+                        "text": subcat["name"], "wiki_id": category_wikis.get(subcat["category_id"]), "popularity": 0})
+    removals = [f"category:{i}" for i in category_ids] + [f"subcategory:{i}" for i in subcategory_ids]
+    return entries, [entry_key for entry_key in removals if entry_key not in found]
+
+def build_lookup_indexes(index: SearchIndex):
+    # Typeahead and fuzzy indexes are plain in-memory structures built from the
+    # search index records, then kept current by change replay
+    suggest_index.start_bulk()
+    try:
+        records = []
+        for record in index.iter_records():
+            if record["type"] != "article":
+                continue
+            records.append(record)
+            if len(records) >= SEARCH_REPLAY_BATCH_SIZE:
+                suggest_index.apply_articles(records, [])
+                fuzzy_index.apply_articles(records, [])
+                records = []
+        suggest_index.apply_articles(records, [])
+        fuzzy_index.apply_articles(records, [])
+        category_ids = [category["id"] for category in db.wiki_categories.find({}, {"id": 1})]
+        subcategory_ids = [subcat["id"] for subcat in db.wiki_subcategories.find({}, {"id": 1})]
+        suggest_index.apply_categories(*category_suggest_entries(category_ids, subcategory_ids))
+    finally:
+        suggest_index.finish_bulk()
+
+def refresh_suggest_popularity():
+    # Pick up view counts of articles read since the last refresh
+    checked_at = datetime.utcnow()
+    viewed = db.wiki_articles.find(
+        {"last_viewed_at": {"$gte": suggest_index.popularity_checked_at}},
+        {"_id": 0, "id": 1, "view_count": 1}
+    )
+    suggest_index.update_popularity({article["id"]: article.get("view_count", 0) for article in viewed})
+    suggest_index.popularity_checked_at = checked_at
+
+def record_search_changes(doc_ids: List[str], op: str, doc_type: str = "article"):
+    # Append changes to the shared log for every worker, and apply them to
+    # this worker's overlay right away so the writer immediately sees its own
+    # change. applied_seq is left alone: the background sync replays the log
+    # in order, waiting out gaps left by other writers, and re-reading the
+    # documents again there is harmless.
+    if not doc_ids:
+        return
+    counter = db.counters.find_one_and_update(
+        {"_id": "search_index_changes"},
+        {"$inc": {"seq": len(doc_ids)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    first_seq = counter["seq"] - len(doc_ids) + 1
+    now = datetime.utcnow()
+    db.search_index_changes.insert_many([
+        {"seq": first_seq + offset, "doc_type": doc_type, "doc_id": doc_id, "op": op, "created_at": now}
+        for offset, doc_id in enumerate(doc_ids)
+    ])
+    apply_search_documents(search_index, {doc_type: set(doc_ids)}, 0)
+
+def sync_search_index(index: Optional[SearchIndex] = None):
+    index = index or search_index
+    with index._sync_lock:
+        while True:
+            changes = list(db.search_index_changes.find(
+                {"seq": {"$gt": index.applied_seq}}, {"_id": 0}
+            ).sort("seq", 1).limit(SEARCH_REPLAY_BATCH_SIZE))
+            if not changes:
+                return
+
+            # Sequence numbers are allocated before the change is inserted, so a
+            # gap means a concurrent writer has not committed yet. Wait for it
+            # unless the gap is old enough that the write must have failed.
+            batch = []
+            expected = index.applied_seq + 1
+            now = datetime.utcnow()
+            for change in changes:
+                if change["seq"] != expected and (now - change["created_at"]).total_seconds() < SEARCH_CHANGE_GAP_GRACE_SECONDS:
+                    break
+                batch.append(change)
+                expected = change["seq"] + 1
+            if not batch:
+                return
+
+            apply_search_changes(index, batch)
+
+            if len(batch) < len(changes) or len(changes) < SEARCH_REPLAY_BATCH_SIZE:
+                return
+
+def find_search_documents(doc_type: str, query: dict):
+    # Source documents of one type, shaped the way search_record expects them
+    if doc_type == "article":
+        yield from db.wiki_articles.find(query, {"_id": 0, "images": 0})
+    elif doc_type == "category":
+        yield from db.wiki_categories.find(query, {"_id": 0})
+    elif doc_type == "subcategory":
+        subcategories = list(db.wiki_subcategories.find(query, {"_id": 0}))
+        category_wikis = {
+            category["id"]: category["wiki_id"]
+            for category in db.wiki_categories.find(
+                {"id": {"$in": list({subcat["category_id"] for subcat in subcategories})}}, {"_id": 0, "id": 1, "wiki_id": 1}
+            )
+        }
+        for subcat in subcategories:
+            subcat["wiki_id"] = category_wikis.get(subcat["category_id"])
+            yield subcat
+    elif doc_type == "flow":
+        # Soft-deleted flows drop out of the index
+        yield from db.flows.find({**query, "is_active": True}, {"_id": 0})
+    else:
+        yield from db.flow_steps.find(query, {"_id": 0, "images": 0, "options": 0})
+
+def apply_search_changes(index: SearchIndex, batch: List[dict]):
+    # Only the latest change per document matters; upserts re-read the document
+    # so replaying a change twice is harmless
+    changed_ids: Dict[str, set] = {doc_type: set() for doc_type in SEARCH_DOC_TYPES}
+    for change in batch:
+        changed_ids[change.get("doc_type", "article")].add(change["doc_id"])
+    apply_search_documents(index, changed_ids, batch[-1]["seq"])
+
+def apply_search_documents(index: SearchIndex, changed_ids: Dict[str, set], seq: int):
+    # Brings the given documents up to their current state in Mongo; seq is
+    # the change log position this covers (0 when applied out of band)
+    changed_ids = {doc_type: set(changed_ids.get(doc_type, ())) for doc_type in SEARCH_DOC_TYPES}
+    upserts = []
+    removals = []
+    for doc_type, doc_ids in changed_ids.items():
+        if not doc_ids:
+            continue
+        found = {doc["id"]: doc for doc in find_search_documents(doc_type, {"id": {"$in": list(doc_ids)}})}
+        upserts.extend((search_record(doc_type, doc), search_terms(search_fields(doc_type, doc))) for doc in found.values())
+        removals.extend(search_doc_key(doc_type, doc_id) for doc_id in doc_ids if doc_id not in found)
+
+    # Wikis whose search results change: where documents were and where they are now
+    affected_wikis = {record.get("wiki_id") for record, _ in upserts}
+    for key in [record["key"] for record, _ in upserts] + removals:
+        previous = index.record(key)
+        if previous:
+            affected_wikis.add(previous.get("wiki_id"))
+    index.apply(upserts, removals, seq)
+
+    article_records = [record for record, _ in upserts if record["type"] == "article"]
+    removed_keys = set(removals)
+    article_removals = [doc_id for doc_id in changed_ids["article"] if doc_id in removed_keys]
+    suggest_index.apply_articles(article_records, article_removals)
+    fuzzy_index.apply_articles(article_records, article_removals)
+    if changed_ids["category"] or changed_ids["subcategory"]:
+        suggest_index.apply_categories(*category_suggest_entries(list(changed_ids["category"]), list(changed_ids["subcategory"])))
+    affected_wikis.discard(None)
+    content_generations.bump(affected_wikis)
+
+def build_search_snapshot():
+    # Full rebuild from Mongo; only needed when no usable snapshot exists
+    counter = db.counters.find_one({"_id": "search_index_changes"}) or {}
+    last_seq = counter.get("seq", 0)
+    index = SearchIndex(SEARCH_INDEX_DIR)
+    batch = []
+    for doc_type in SEARCH_DOC_TYPES:
+        for doc in find_search_documents(doc_type, {}):
+            batch.append((search_record(doc_type, doc), search_terms(search_fields(doc_type, doc))))
+            if len(batch) >= SEARCH_REPLAY_BATCH_SIZE:
+                index.apply(batch, [], 0)
+                batch = []
+    index.apply(batch, [], 0)
+    snapshot, docs, postings, removed, _ = index.capture()
+    write_search_snapshot(index.snapshot_path, snapshot, docs, postings, removed, last_seq)
+
+def open_search_index():
+    # Load the latest snapshot and replay changes since it into a fresh index,
+    # then swap it in so queries keep being served from the old one meanwhile
+    global search_index
+    index = SearchIndex(SEARCH_INDEX_DIR)
+    index.open_snapshot()
+    sync_search_index(index)
+    search_index = index
+
+def snapshot_search_index():
+    with open(search_index.lock_path, "a+") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another worker is writing a snapshot
+            return
+        try:
+            if search_index.snapshot_changed() or search_index.overlay_size == 0:
+                return
+            snapshot, docs, postings, removed, last_seq = search_index.capture()
+            previous_seq = snapshot.last_seq if snapshot else 0
+            write_search_snapshot(search_index.snapshot_path, snapshot, docs, postings, removed, last_seq)
+            # Keep one snapshot's worth of changes for workers still on the old file
+            db.search_index_changes.delete_many({"seq": {"$lte": previous_seq}})
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    open_search_index()
+
+def search_index_maintenance_loop():
+    last_snapshot = time.monotonic()
+    last_popularity_refresh = time.monotonic()
+    while True:
+        time.sleep(SEARCH_REPLAY_INTERVAL_SECONDS)
+        try:
+            if search_index.snapshot_changed():
+                open_search_index()
+            sync_search_index()
+            if time.monotonic() - last_popularity_refresh >= SUGGEST_POPULARITY_REFRESH_SECONDS:
+                last_popularity_refresh = time.monotonic()
+                refresh_suggest_popularity()
+            if time.monotonic() - last_snapshot >= SEARCH_SNAPSHOT_INTERVAL_SECONDS:
+                last_snapshot = time.monotonic()
+                snapshot_search_index()
+        except Exception:
+            logger.exception("Search index maintenance failed")
+
+@app.on_event("startup")
+def start_search_index():
+    os.makedirs(SEARCH_INDEX_DIR, exist_ok=True)
+    db.search_index_changes.create_index("seq", unique=True)
+    db.wiki_articles.create_index("last_viewed_at", sparse=True)
+
+    # The first worker to boot without a usable snapshot builds it; the others
+    # wait on the lock and then simply map the file it wrote
+    with open(search_index.lock_path, "a+") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            try:
+                SearchSnapshot(search_index.snapshot_path)
+            except (FileNotFoundError, ValueError):
+                build_search_snapshot()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    open_search_index()
+    build_lookup_indexes(search_index)
+    threading.Thread(target=search_index_maintenance_loop, name="search-index-maintenance", daemon=True).start()
+
+# Search analytics
+# The search path only appends a tuple to an in-memory buffer. A background
+# thread drains it every few seconds, coalesces identical queries and
+# upserts hourly counters into search_query_stats, so reports read at most
+# one document per query per hour. When Mongo is unreachable the buffer is
+# capped and the oldest events are dropped rather than slowing searches.
+SEARCH_LOG_FLUSH_SECONDS = float(os.getenv("SEARCH_LOG_FLUSH_SECONDS", "5"))
+SEARCH_LOG_MAX_BUFFER = 50000
+SEARCH_LOG_MAX_QUERY_LENGTH = 200
+SEARCH_STATS_RETENTION_DAYS = 90
+
+class SearchQueryLog:
+    def __init__(self, max_buffer: int):
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._buffer: deque = deque(maxlen=max_buffer)
+
+    def record(self, source: str, query: str, result_count: int, latency_ms: float):
+        with self._lock:
+            if len(self._buffer) == self.max_buffer:
+                self.dropped += 1
+            self._buffer.append((source, query, result_count, latency_ms, time.time()))
+
+    def drain(self) -> deque:
+        with self._lock:
+            events, self._buffer = self._buffer, deque(maxlen=self.max_buffer)
+        return events
+
+search_query_log = SearchQueryLog(SEARCH_LOG_MAX_BUFFER)
+
+def normalize_search_query(query: str) -> str:
+    return " ".join(query.lower().split())[:SEARCH_LOG_MAX_QUERY_LENGTH]
+
+def flush_search_query_log():
+    events = search_query_log.drain()
+    if not events:
+        return
+    buckets: Dict[tuple, dict] = {}
+    for source, query, result_count, latency_ms, logged_at in events:
+        hour = datetime.utcfromtimestamp(logged_at - logged_at % 3600)
+        key = (hour, source, normalize_search_query(query))
+        bucket = buckets.setdefault(key, {"searches": 0, "zero_results": 0, "total_results": 0, "total_latency_ms": 0.0, "max_latency_ms": 0.0})
+        bucket["searches"] += 1
+        bucket["zero_results"] += 1 if result_count == 0 else 0
+        bucket["total_results"] += result_count
+        bucket["total_latency_ms"] += latency_ms
+        bucket["max_latency_ms"] = max(bucket["max_latency_ms"], latency_ms)
+    db.search_query_stats.bulk_write([
+        UpdateOne(
+            {"hour": hour, "source": source, "query": query},
+            {
+                "$inc": {field: bucket[field] for field in ("searches", "zero_results", "total_results", "total_latency_ms")},
+                "$max": {"max_latency_ms": bucket["max_latency_ms"]}
+            },
+            upsert=True
+        )
+        for (hour, source, query), bucket in buckets.items()
+    ], ordered=False)
+
+def search_query_log_loop():
+    while True:
+        time.sleep(SEARCH_LOG_FLUSH_SECONDS)
+        try:
+            flush_search_query_log()
+        except Exception:
+            logger.exception("Search query log flush failed")
+
+@app.on_event("startup")
+def start_search_query_log():
+    db.search_query_stats.create_index([("hour", 1), ("source", 1), ("query", 1)], unique=True)
+    db.search_query_stats.create_index("hour", expireAfterSeconds=SEARCH_STATS_RETENTION_DAYS * 86400)
+    threading.Thread(target=search_query_log_loop, name="search-query-log", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_search_query_log():
+    flush_search_query_log()
+
+# Article views
+# Reads only bump a per-worker counter; a background thread folds the counts
+# into view_count and last_viewed_at with one bulk write every
+# ARTICLE_VIEW_FLUSH_SECONDS, which is all typeahead ranking needs.
+ARTICLE_VIEW_FLUSH_SECONDS = float(os.getenv("ARTICLE_VIEW_FLUSH_SECONDS", "10"))
+
+class ArticleViewCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {}
+
+    def record(self, article_id: str):
+        with self._lock:
+            self._counts[article_id] = self._counts.get(article_id, 0) + 1
+
+    def drain(self) -> Dict[str, int]:
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        return counts
+
+    def restore(self, counts: Dict[str, int]):
+        with self._lock:
+            for article_id, count in counts.items():
+                self._counts[article_id] = self._counts.get(article_id, 0) + count
+
+article_views = ArticleViewCounter()
+
+def flush_article_views():
+    counts = article_views.drain()
+    if not counts:
+        return
+    viewed_at = datetime.utcnow()
+    try:
+        db.wiki_articles.bulk_write([
+            UpdateOne({"id": article_id}, {"$inc": {"view_count": count}, "$set": {"last_viewed_at": viewed_at}})
+            for article_id, count in counts.items()
+        ], ordered=False)
+    except Exception:
+        # Counts are kept for the next flush rather than lost
+        article_views.restore(counts)
+        raise
+
+def article_view_loop():
+    while True:
+        time.sleep(ARTICLE_VIEW_FLUSH_SECONDS)
+        try:
+            flush_article_views()
+        except Exception:
+            logger.exception("Article view flush failed")
+
+@app.on_event("startup")
+def start_article_views():
+    threading.Thread(target=article_view_loop, name="article-views", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_article_views():
+    flush_article_views()
+
+# Tag facet counts
+# tag_counts holds one counter per (kind, wiki, visibility, tag), maintained on
+# article and flow writes so tag filters never scan documents. Flows are not
+# tied to a wiki and are counted with wiki_id None.
+TAG_COUNT_PROJECTION = {"_id": 0, "id": 1, "wiki_id": 1, "visibility": 1, "tags": 1}
+
+def apply_tag_count_deltas(deltas: Dict[tuple, int]):
+    # deltas maps (kind, wiki_id, visibility, tag) to the change in count
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    db.tag_counts.bulk_write([
+        UpdateOne(
+            {"kind": kind, "wiki_id": wiki_id, "visibility": visibility, "tag": tag},
+            {"$inc": {"count": delta}},
+            upsert=True
+        )
+        for (kind, wiki_id, visibility, tag), delta in deltas.items()
+    ], ordered=False)
+    if any(delta < 0 for delta in deltas.values()):
+        db.tag_counts.delete_many({"tag": {"$in": list({key[3] for key in deltas})}, "count": {"$lte": 0}})
+
+def adjust_tag_counts(kind: str, wiki_id: Optional[str], visibility, tags: List[str], delta: int):
+    visibility = getattr(visibility, "value", visibility)
+    apply_tag_count_deltas({(kind, wiki_id, visibility, tag): delta for tag in set(tags or []) if tag})
+
+def remove_article_tag_counts(articles: List[dict]):
+    deltas: Dict[tuple, int] = {}
+    for article in articles:
+        for tag in set(article.get("tags") or []):
+            if tag:
+                key = ("article", article.get("wiki_id"), article.get("visibility"), tag)
+                deltas[key] = deltas.get(key, 0) - 1
+    apply_tag_count_deltas(deltas)
+
+def rebuild_tag_counts() -> int:
+    # Recount from the source collections into a scratch collection and swap it
+    # in. Increments that land while the rebuild runs are lost, so run it when
+    # counters have drifted rather than routinely.
+    def count_rows(collection, match: dict, kind: str):
+        pipeline = [
+            {"$match": match},
+            {"$project": {"wiki_id": 1, "visibility": 1, "tags": {"$setUnion": [{"$ifNull": ["$tags", []]}, []]}}},
+            {"$unwind": "$tags"},
+            {"$group": {"_id": {"wiki_id": "$wiki_id", "visibility": "$visibility", "tag": "$tags"}, "count": {"$sum": 1}}}
+        ]
+        for row in collection.aggregate(pipeline, allowDiskUse=True):
+            yield {
+                "kind": kind,
+                "wiki_id": row["_id"].get("wiki_id") if kind == "article" else None,
+                "visibility": row["_id"]["visibility"],
+                "tag": row["_id"]["tag"],
+                "count": row["count"]
+            }
+
+    scratch = db.tag_counts_rebuild
+    scratch.drop()
+    scratch.create_index([("kind", 1), ("wiki_id", 1), ("visibility", 1), ("tag", 1)], unique=True)
+    total = 0
+    for kind, collection, match in [("article", db.wiki_articles, {}), ("flow", db.flows, {"is_active": True})]:
+        batch = []
+        for row in count_rows(collection, match, kind):
+            batch.append(row)
+            if len(batch) >= 1000:
+                scratch.insert_many(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            scratch.insert_many(batch)
+            total += len(batch)
+    scratch.rename("tag_counts", dropTarget=True)
+    return total
+
+@app.on_event("startup")
+def create_tag_count_indexes():
+    db.tag_counts.create_index([("kind", 1), ("wiki_id", 1), ("visibility", 1), ("tag", 1)], unique=True)
+
+# Background jobs
+# A lease document per job keeps batch jobs to one run at a time across
+# workers; an expired lease is taken over so a crashed run does not block
+# the job forever.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def acquire_job_lease(name: str, seconds: int) -> bool:
+    now = datetime.utcnow()
+    try:
+        db.job_leases.update_one(
+            {"_id": name, "expires_at": {"$lt": now}},
+            {"$set": {"holder": WORKER_ID, "acquired_at": now, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+def release_job_lease(name: str):
+    db.job_leases.delete_one({"_id": name, "holder": WORKER_ID})
+
+def start_background_job(name: str, lease_seconds: int, target, *args) -> bool:
+    if not acquire_job_lease(name, lease_seconds):
+        return False
+
+    def run():
+        try:
+            target(*args)
+        except Exception:
+            logger.exception("Background job %s failed", name)
+        finally:
+            release_job_lease(name)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return True
+
+# Related articles
+# TF-IDF vectors are built per wiki as one sparse matrix and neighbours come
+# from chunked sparse products, so nothing is compared pair by pair in Python.
+# Each article's top neighbours are stored in article_related, so the
+# endpoint is one indexed read plus one $in read that re-checks the current
+# visibility of the article and its neighbours. Incremental runs rebuild the
+# matrix (linear) but only multiply the rows of articles changed since the
+# last run.
+RELATED_ARTICLES_TOP_K = 10
+RELATED_ARTICLES_MIN_SCORE = 0.05
+RELATED_ARTICLES_MAX_DF = 0.5
+RELATED_ARTICLES_MAX_TERMS = 32
+RELATED_ARTICLES_CHUNK_ROWS = 1024
+RELATED_ARTICLES_LEASE_SECONDS = 3600
+RELATED_ARTICLES_PROJECTION = {"_id": 0, "id": 1, "title": 1, "tags": 1, "content": 1, "visibility": 1, "created_by": 1, "updated_at": 1}
+
+def build_tfidf_matrix(articles) -> tuple:
+    # Returns (metadata rows, L2-normalised csr matrix). Terms are counted with
+    # the search field weights; the raw content is dropped as soon as the row
+    # is built so memory stays proportional to the number of non-zeros.
+    vocabulary: Dict[str, int] = {}
+    indptr = array("q", [0])
+    indices = array("i")
+    data = array("f")
+    rows = []
+    for article in articles:
+        counts: Dict[str, int] = {}
+        for field, text in article_search_fields(article):
+            weight = SEARCH_FIELD_WEIGHTS[field]
+            for term in tokenize(text):
+                counts[term] = counts.get(term, 0) + weight
+        for term, count in counts.items():
+            indices.append(vocabulary.setdefault(term, len(vocabulary)))
+            data.append(1.0 + math.log(count))
+        indptr.append(len(indices))
+        rows.append({
+            "id": article["id"],
+            "title": article.get("title", ""),
+            "visibility": article.get("visibility"),
+            "created_by": article.get("created_by"),
+            "updated_at": article.get("updated_at")
+        })
+
+    doc_count = len(rows)
+    matrix = sparse.csr_matrix(
+        (np.frombuffer(data, dtype=np.float32), np.frombuffer(indices, dtype=np.int32), np.frombuffer(indptr, dtype=np.int64)),
+        shape=(doc_count, len(vocabulary))
+    )
+    if not doc_count or not len(vocabulary):
+        return rows, matrix
+
+    # Terms in a single article cannot link two articles and terms in most of
+    # them link everything, so both are dropped before weighting.
+    df = np.bincount(matrix.indices, minlength=len(vocabulary))
+    idf = (np.log((1.0 + doc_count) / (1.0 + df)) + 1.0).astype(np.float32)
+    idf[(df < 2) | (df > max(2, RELATED_ARTICLES_MAX_DF * doc_count))] = 0.0
+    matrix = (matrix @ sparse.diags(idf)).tocsr()
+    matrix.eliminate_zeros()
+
+    # Each article keeps only its highest weighted terms. This bounds the
+    # product to roughly rows * terms * postings per term instead of growing
+    # with every shared common word, at a small cost in cosine accuracy.
+    row_ids = np.repeat(np.arange(doc_count), np.diff(matrix.indptr))
+    order = np.lexsort((-matrix.data, row_ids))
+    rank = np.arange(len(order)) - matrix.indptr[row_ids[order]]
+    keep = np.zeros(len(order), dtype=bool)
+    keep[order[rank < RELATED_ARTICLES_MAX_TERMS]] = True
+    matrix = sparse.csr_matrix(
+        (matrix.data[keep], matrix.indices[keep], np.concatenate(([0], np.cumsum(np.bincount(row_ids[keep], minlength=doc_count))))),
+        shape=matrix.shape
+    )
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    matrix = (sparse.diags((1.0 / norms).astype(np.float32)) @ matrix).tocsr()
+    return rows, matrix
+
+def similarity_rows(matrix, transposed, row_numbers):
+    # Yields (row, candidate columns, scores) for each requested row, the
+    # self-match removed, computed in chunks to bound the product's size
+    for chunk_start in range(0, len(row_numbers), RELATED_ARTICLES_CHUNK_ROWS):
+        chunk = row_numbers[chunk_start:chunk_start + RELATED_ARTICLES_CHUNK_ROWS]
+        product = (matrix[chunk] @ transposed).tocsr()
+        for local, row in enumerate(chunk):
+            start, end = product.indptr[local], product.indptr[local + 1]
+            columns = product.indices[start:end]
+            scores = product.data[start:end]
+            keep = (columns != row) & (scores >= RELATED_ARTICLES_MIN_SCORE)
+            yield row, columns[keep], scores[keep]
+
+def top_neighbours(columns, scores) -> List[tuple]:
+    if len(scores) > RELATED_ARTICLES_TOP_K:
+        top = np.argpartition(-scores, RELATED_ARTICLES_TOP_K)[:RELATED_ARTICLES_TOP_K]
+        columns, scores = columns[top], scores[top]
+    order = np.argsort(-scores, kind="stable")
+    return [(int(columns[i]), float(scores[i])) for i in order]
+
+def related_entry(row: dict, score: float) -> dict:
+    return {
+        "id": row["id"],
+        "title": row["title"],
+        "visibility": row["visibility"],
+        "created_by": row["created_by"],
+        "score": round(score, 4)
+    }
+
+def related_document(wiki_id: str, row: dict, related: List[dict], computed_at: datetime) -> dict:
+    return {
+        "article_id": row["id"],
+        "wiki_id": wiki_id,
+        "visibility": row["visibility"],
+        "created_by": row["created_by"],
+        "related": related,
+        "computed_at": computed_at
+    }
+
+def compute_related_articles(wiki_id: str, full: bool = False) -> int:
+    started_at = datetime.utcnow()
+    state = db.related_articles_state.find_one({"wiki_id": wiki_id}) or {}
+    last_run_at = None if full else state.get("last_run_at")
+
+    rows, matrix = build_tfidf_matrix(
+        db.wiki_articles.find({"wiki_id": wiki_id}, RELATED_ARTICLES_PROJECTION).sort("id", 1).batch_size(500)
+    )
+    row_by_id = {row["id"]: number for number, row in enumerate(rows)}
+    transposed = matrix.T.tocsr()
+
+    # Articles that no longer exist are dropped from the collection and from
+    # every list that still points at them
+    stored_ids = set(db.article_related.distinct("article_id", {"wiki_id": wiki_id}))
+    deleted = list(stored_ids - set(row_by_id))
+    if deleted:
+        db.article_related.delete_many({"article_id": {"$in": deleted}})
+        db.article_related.update_many(
+            {"wiki_id": wiki_id, "related.id": {"$in": deleted}},
+            {"$pull": {"related": {"id": {"$in": deleted}}}}
+        )
+
+    if last_run_at is None:
+        changed = list(range(len(rows)))
+    else:
+        changed = [
+            number for number, row in enumerate(rows)
+            if row["id"] not in stored_ids or (row["updated_at"] and row["updated_at"] >= last_run_at)
+        ]
+
+    writes = []
+    # Only an incremental run has to push changed articles into the lists of
+    # unchanged ones; column -> {changed row: score}
+    reverse: Dict[int, Dict[int, float]] = {}
+    changed_set = set(changed)
+    for row, columns, scores in similarity_rows(matrix, transposed, changed):
+        related = [related_entry(rows[column], score) for column, score in top_neighbours(columns, scores)]
+        writes.append(ReplaceOne(
+            {"article_id": rows[row]["id"]},
+            related_document(wiki_id, rows[row], related, started_at),
+            upsert=True
+        ))
+        if last_run_at is not None:
+            for column, score in zip(columns.tolist(), scores.tolist()):
+                if column not in changed_set:
+                    reverse.setdefault(column, {})[row] = score
+        if len(writes) >= 500:
+            db.article_related.bulk_write(writes, ordered=False)
+            writes = []
+
+    if last_run_at is not None and changed:
+        changed_ids = {rows[row]["id"] for row in changed}
+        # Lists that already mention a changed article need its new score (or
+        # its removal) even when it no longer scores against them
+        for doc in db.article_related.find({"wiki_id": wiki_id, "related.id": {"$in": list(changed_ids)}}, {"article_id": 1}):
+            column = row_by_id.get(doc["article_id"])
+            if column is not None and column not in changed_set:
+                reverse.setdefault(column, {})
+        affected = [rows[column]["id"] for column in reverse]
+        for start in range(0, len(affected), 500):
+            for doc in db.article_related.find({"article_id": {"$in": affected[start:start + 500]}}, {"_id": 0}):
+                column = row_by_id[doc["article_id"]]
+                candidates = {entry["id"]: entry for entry in doc.get("related", []) if entry["id"] not in changed_ids}
+                for row, score in reverse[column].items():
+                    candidates[rows[row]["id"]] = related_entry(rows[row], score)
+                related = sorted(candidates.values(), key=lambda entry: -entry["score"])[:RELATED_ARTICLES_TOP_K]
+                writes.append(ReplaceOne(
+                    {"article_id": doc["article_id"]},
+                    related_document(wiki_id, rows[column], related, started_at),
+                    upsert=True
+                ))
+                if len(writes) >= 500:
+                    db.article_related.bulk_write(writes, ordered=False)
+                    writes = []
+    if writes:
+        db.article_related.bulk_write(writes, ordered=False)
+
+    db.related_articles_state.update_one(
+        {"wiki_id": wiki_id},
+        {"$set": {"last_run_at": started_at, "article_count": len(rows), "recomputed": len(changed)}},
+        upsert=True
+    )
+    return len(changed)
+
+def run_related_articles_job(full: bool = False):
+    started = time.monotonic()
+    recomputed = 0
+    for wiki in db.wikis.find({}, {"_id": 0, "id": 1}):
+        recomputed += compute_related_articles(wiki["id"], full)
+    logger.info("Related articles recomputed for %d articles in %.1fs", recomputed, time.monotonic() - started)
+
+@app.on_event("startup")
+def create_related_article_indexes():
+    db.article_related.create_index("article_id", unique=True)
+    db.article_related.create_index([("wiki_id", 1), ("related.id", 1)])
+    db.related_articles_state.create_index("wiki_id", unique=True)
+
+def drop_related_articles(articles: List[dict]):
+    # Called when articles are deleted so neither their own lists nor the
+    # lists that mention them outlive them until the next run
+    ids_by_wiki: Dict[str, List[str]] = {}
+    for article in articles:
+        ids_by_wiki.setdefault(article.get("wiki_id"), []).append(article["id"])
+    for wiki_id, article_ids in ids_by_wiki.items():
+        db.article_related.delete_many({"article_id": {"$in": article_ids}})
+        db.article_related.update_many(
+            {"wiki_id": wiki_id, "related.id": {"$in": article_ids}},
+            {"$pull": {"related": {"id": {"$in": article_ids}}}}
+        )
+
+# Near-duplicate detection
+# Article content is reduced to a MinHash signature over word shingles and
+# split into LSH bands; articles sharing any band key are candidates and the
+# signatures estimate their Jaccard similarity. Signatures live in
+# article_minhash with a multikey index on the band keys, so checking one
+# article is a single indexed lookup. With 16 bands of 8 rows, pairs around
+# 0.7 similarity have even odds of sharing a band.
+DUPLICATE_SHINGLE_SIZE = 5
+DUPLICATE_MIN_TOKENS = 20
+DUPLICATE_BANDS = 16
+DUPLICATE_BAND_ROWS = 8
+DUPLICATE_THRESHOLD = 0.8
+DUPLICATE_CANDIDATE_LIMIT = 200
+# Buckets larger than this are streamed on their own instead of grouped,
+# comparing members against at most DUPLICATE_MAX_LEADERS leaders
+DUPLICATE_MAX_BUCKET_SIZE = 500
+DUPLICATE_MAX_LEADERS = 200
+DUPLICATE_SIGNATURE_BATCH_SIZE = 1000
+DUPLICATE_LEASE_SECONDS = 3600
+MINHASH_PRIME = (1 << 31) - 1
+_minhash_rng = np.random.default_rng(0x5EED)
+MINHASH_A = _minhash_rng.integers(1, MINHASH_PRIME, size=DUPLICATE_BANDS * DUPLICATE_BAND_ROWS, dtype=np.uint64)
+MINHASH_B = _minhash_rng.integers(0, MINHASH_PRIME, size=DUPLICATE_BANDS * DUPLICATE_BAND_ROWS, dtype=np.uint64)
+
+def minhash_signature(content: str) -> Optional[bytes]:
+    # None for articles too short to say anything useful about
+    tokens = tokenize(strip_html(content))
+    if len(tokens) < DUPLICATE_MIN_TOKENS:
+        return None
+    shingles = {
+        zlib.crc32(" ".join(tokens[i:i + DUPLICATE_SHINGLE_SIZE]).encode("utf-8")) & 0x7FFFFFFF
+        for i in range(len(tokens) - DUPLICATE_SHINGLE_SIZE + 1)
+    }
+    hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+    # a * h stays below 2**62, so the universal hash never overflows uint64
+    permuted = (MINHASH_A[:, None] * hashes[None, :] + MINHASH_B[:, None]) % MINHASH_PRIME
+    return permuted.min(axis=1).astype("<u4").tobytes()
+
+def minhash_bands(signature: bytes) -> List[str]:
+    width = DUPLICATE_BAND_ROWS * 4
+    return [
+        f"{band}:{hashlib.blake2b(signature[band * width:(band + 1) * width], digest_size=8).hexdigest()}"
+        for band in range(DUPLICATE_BANDS)
+    ]
+
+def signature_similarity(first: bytes, second: bytes) -> float:
+    return float(np.mean(np.frombuffer(first, dtype="<u4") == np.frombuffer(second, dtype="<u4")))
+
+def minhash_document(article: dict, signature: bytes) -> dict:
+    return {
+        "article_id": article["id"],
+        "wiki_id": article.get("wiki_id"),
+        "signature": signature,
+        "bands": minhash_bands(signature),
+        "computed_at": datetime.utcnow()
+    }
+
+def store_article_minhash(article: dict) -> Optional[bytes]:
+    signature = minhash_signature(article.get("content", ""))
+    if signature is None:
+        db.article_minhash.delete_one({"article_id": article["id"]})
+    else:
+        db.article_minhash.replace_one({"article_id": article["id"]}, minhash_document(article, signature), upsert=True)
+    return signature
+
+def find_near_duplicates(signature: bytes, exclude_id: Optional[str] = None) -> List[tuple]:
+    # (article_id, estimated similarity) at or above the threshold, best first
+    matches = []
+    candidates = db.article_minhash.find(
+        {"bands": {"$in": minhash_bands(signature)}},
+        {"_id": 0, "article_id": 1, "signature": 1}
+    ).limit(DUPLICATE_CANDIDATE_LIMIT)
+    for candidate in candidates:
+        if candidate["article_id"] == exclude_id:
+            continue
+        similarity = signature_similarity(signature, candidate["signature"])
+        if similarity >= DUPLICATE_THRESHOLD:
+            matches.append((candidate["article_id"], similarity))
+    matches.sort(key=lambda match: -match[1])
+    return matches
+
+def refresh_article_minhashes() -> int:
+    # Streams every article once, recomputing signatures that are missing or
+    # older than the article, and drops signatures of deleted articles
+    computed_at = {
+        doc["article_id"]: doc["computed_at"]
+        for doc in db.article_minhash.find({}, {"_id": 0, "article_id": 1, "computed_at": 1})
+    }
+    seen = set()
+    writes = []
+    refreshed = 0
+    articles = db.wiki_articles.find({}, {"_id": 0, "id": 1, "wiki_id": 1, "content": 1, "updated_at": 1}).batch_size(500)
+    for article in articles:
+        seen.add(article["id"])
+        stored_at = computed_at.get(article["id"])
+        if stored_at is not None and article.get("updated_at") and stored_at >= article["updated_at"]:
+            continue
+        signature = minhash_signature(article.get("content", ""))
+        if signature is not None:
+            writes.append(ReplaceOne({"article_id": article["id"]}, minhash_document(article, signature), upsert=True))
+            refreshed += 1
+        elif stored_at is not None:
+            writes.append(DeleteOne({"article_id": article["id"]}))
+        if len(writes) >= 500:
+            db.article_minhash.bulk_write(writes, ordered=False)
+            writes = []
+    if writes:
+        db.article_minhash.bulk_write(writes, ordered=False)
+    stale = [article_id for article_id in computed_at if article_id not in seen]
+    for start in range(0, len(stale), 1000):
+        db.article_minhash.delete_many({"article_id": {"$in": stale[start:start + 1000]}})
+    return refreshed
+
+def cluster_near_duplicates() -> int:
+    # Each LSH bucket is clustered greedily against leaders, so a bucket costs
+    # members * leaders comparisons rather than every pair; clusters from
+    # different buckets are merged with union-find.
+    parent: Dict[str, str] = {}
+    best: Dict[str, float] = {}
+    wiki_of: Dict[str, Optional[str]] = {}
+
+    def find(article_id: str) -> str:
+        root = article_id
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while parent.get(article_id, article_id) != root:
+            parent[article_id], article_id = root, parent[article_id]
+        return root
+
+    def union(first: str, second: str, similarity: float):
+        parent.setdefault(first, first)
+        parent.setdefault(second, second)
+        first_root, second_root = find(first), find(second)
+        if first_root != second_root:
+            parent[second_root] = first_root
+        root = find(first)
+        best[root] = min(similarity, best.get(first_root, 1.0), best.get(second_root, 1.0))
+
+    def cluster_bucket(members):
+        leaders = []
+        for member in members:
+            for leader in leaders:
+                similarity = signature_similarity(leader["signature"], member["signature"])
+                if similarity >= DUPLICATE_THRESHOLD:
+                    union(leader["article_id"], member["article_id"], similarity)
+                    wiki_of[leader["article_id"]] = leader.get("wiki_id")
+                    wiki_of[member["article_id"]] = member.get("wiki_id")
+                    break
+            else:
+                if len(leaders) < DUPLICATE_MAX_LEADERS:
+                    leaders.append(member)
+
+    # Groups only ever hold article ids, and never more than
+    # DUPLICATE_MAX_BUCKET_SIZE of them, so none can reach the document size
+    # limit; signatures are fetched for a batch of buckets at a time
+    oversized = [
+        bucket["_id"] for bucket in db.article_minhash.aggregate([
+            {"$unwind": "$bands"},
+            {"$group": {"_id": "$bands", "size": {"$sum": 1}}},
+            {"$match": {"size": {"$gt": DUPLICATE_MAX_BUCKET_SIZE}}}
+        ], allowDiskUse=True)
+    ]
+    buckets = db.article_minhash.aggregate([
+        {"$unwind": "$bands"},
+        {"$match": {"bands": {"$nin": oversized}}},
+        {"$group": {"_id": "$bands", "ids": {"$push": "$article_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ], allowDiskUse=True)
+    projection = {"_id": 0, "article_id": 1, "wiki_id": 1, "signature": 1}
+
+    def cluster_batch(batch: List[List[str]]):
+        ids = list({article_id for bucket_ids in batch for article_id in bucket_ids})
+        members = {doc["article_id"]: doc for doc in db.article_minhash.find({"article_id": {"$in": ids}}, projection)}
+        for bucket_ids in batch:
+            cluster_bucket(members[article_id] for article_id in bucket_ids if article_id in members)
+
+    batch, batch_ids = [], 0
+    for bucket in buckets:
+        batch.append(bucket["ids"])
+        batch_ids += len(bucket["ids"])
+        if batch_ids >= DUPLICATE_SIGNATURE_BATCH_SIZE:
+            cluster_batch(batch)
+            batch, batch_ids = [], 0
+    if batch:
+        cluster_batch(batch)
+
+    # Degenerate buckets, e.g. thousands of copies of one runbook, are
+    # streamed straight from the band index
+    for band in oversized:
+        cluster_bucket(db.article_minhash.find({"bands": band}, projection).batch_size(500))
+    if oversized:
+        logger.info("Duplicate detection streamed %d oversized LSH buckets", len(oversized))
+
+    clusters: Dict[str, List[str]] = {}
+    for article_id in list(parent):
+        clusters.setdefault(find(article_id), []).append(article_id)
+
+    scratch = db.article_duplicate_clusters_rebuild
+    scratch.drop()
+    computed_at = datetime.utcnow()
+    batch = []
+    for root, article_ids in clusters.items():
+        batch.append({
+            "id": str(uuid.uuid4()),
+            "article_ids": sorted(article_ids),
+            "wiki_ids": sorted({wiki_of.get(article_id) for article_id in article_ids} - {None}),
+            "size": len(article_ids),
+            "min_similarity": round(best.get(root, DUPLICATE_THRESHOLD), 4),
+            "computed_at": computed_at
+        })
+        if len(batch) >= 500:
+            scratch.insert_many(batch)
+            batch = []
+    if batch:
+        scratch.insert_many(batch)
+    scratch.create_index([("size", -1)])
+    scratch.create_index("wiki_ids")
+    scratch.rename("article_duplicate_clusters", dropTarget=True)
+    return len(clusters)
+
+def run_duplicate_detection_job():
+    started = time.monotonic()
+    refreshed = refresh_article_minhashes()
+    clusters = cluster_near_duplicates()
+    logger.info("Duplicate detection refreshed %d signatures, found %d clusters in %.1fs", refreshed, clusters, time.monotonic() - started)
+
+@app.on_event("startup")
+def create_duplicate_detection_indexes():
+    db.article_minhash.create_index("article_id", unique=True)
+    db.article_minhash.create_index("bands")
+
+# Flow logic
+# Conditions on CONDITIONAL_BRANCH steps are compiled into closures when a
+# flow graph is built, so they are parsed once per flow version and
+# evaluating one is a few function calls. A condition is either structured,
+# {"field", "operator", "value"}, or an "expression" such as
+#   answer >= 18 and (session.plan == "pro" or answers.<step_id> contains "vip")
+# with ==, !=, <, <=, >, >=, contains, matches "<regex>", in [..] or in a..b,
+# and, or, not and parentheses. answer is the answer being submitted,
+# answers.<step_id> an earlier answer and session.<key> the session data.
+CONDITION_MAX_LENGTH = 1000
+CONDITION_MAX_NODES = 100
+SAFE_REGEX_MAX_PATTERN_LENGTH = 200
+SAFE_REGEX_MAX_INPUT_LENGTH = 500
+SAFE_REGEX_MAX_VARIABLE_REPEATS = 3
+
+class FlowDefinitionError(ValueError):
+    pass
+
+def _regex_risk(items, inside_repeat: bool, variable: List[int]) -> Optional[str]:
+    # Python's engine backtracks, so anything that lets a repeat split the
+    # same text more than one way is refused up front: alternation or a
+    # variable repeat inside a repeat (bounded or not), and backreferences.
+    # Exact repeats such as \d{3} leave no choice and may nest. A sequence of
+    # k variable repeats still costs up to n**k steps, so k is capped (an
+    # unanchored search counts as one) which, with the input cap, keeps a
+    # worst-case match to a fraction of a second
+    for op, av in items:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) or op == getattr(sre_parse, "POSSESSIVE_REPEAT", None):
+            low, high, sub = av
+            if inside_repeat and low != high:
+                return "nested repetition"
+            if low != high:
+                variable[0] += 1
+                if variable[0] > SAFE_REGEX_MAX_VARIABLE_REPEATS:
+                    return f"more than {SAFE_REGEX_MAX_VARIABLE_REPEATS} variable repetitions"
+            risk = _regex_risk(sub, True, variable)
+        elif op == sre_parse.SUBPATTERN:
+            risk = _regex_risk(av[-1], inside_repeat, variable)
+        elif op == getattr(sre_parse, "ATOMIC_GROUP", None):
+            risk = _regex_risk(av, inside_repeat, variable)
+        elif op == sre_parse.BRANCH:
+            if inside_repeat:
+                return "alternation inside repetition"
+            risk = next((r for r in (_regex_risk(branch, inside_repeat, variable) for branch in av[1]) if r), None)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            risk = _regex_risk(av[1], inside_repeat, variable)
+        elif op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            risk = "backreferences"
+        else:
+            risk = None
+        if risk:
+            return risk
+    return None
+
+def compile_safe_regex(pattern) -> "re.Pattern":
+    if not isinstance(pattern, str):
+        raise FlowDefinitionError("Regex pattern must be a string")
+    if len(pattern) > SAFE_REGEX_MAX_PATTERN_LENGTH:
+        raise FlowDefinitionError(f"Regex pattern is limited to {SAFE_REGEX_MAX_PATTERN_LENGTH} characters")
+    try:
+        parsed = sre_parse.parse(pattern)
+        anchored = len(parsed) > 0 and parsed[0] in (
+            (sre_parse.AT, sre_parse.AT_BEGINNING), (sre_parse.AT, sre_parse.AT_BEGINNING_STRING))
+        risk = _regex_risk(parsed, False, [0 if anchored else 1])
+        compiled = re.compile(pattern)
+    except re.error as e:
+        raise FlowDefinitionError(f"Invalid regex pattern: {e}")
+    if risk:
+        raise FlowDefinitionError(f"Regex pattern uses {risk}, which is not allowed")
+    return compiled
+
+def regex_matches(compiled: "re.Pattern", value) -> bool:
+    # Input length is capped as well, which bounds even linear-time patterns
+    if value is None:
+        return False
+    text = value if isinstance(value, str) else str(value)
+    return len(text) <= SAFE_REGEX_MAX_INPUT_LENGTH and compiled.search(text) is not None
+
+def _number(value) -> Optional[float]:
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip())
+        except ValueError:
+            return None
+    return None
+
+def _equal(left, right) -> bool:
+    # Text answers compare equal to numbers they spell, so "18" == 18
+    if left == right:
+        return True
+    if isinstance(left, (int, float)) != isinstance(right, (int, float)):
+        left_number, right_number = _number(left), _number(right)
+        return left_number is not None and left_number == right_number
+    return False
+
+def _ordered(op: str):
+    compare = {"<": lambda a, b: a < b, "<=": lambda a, b: a <= b, ">": lambda a, b: a > b, ">=": lambda a, b: a >= b}[op]
+
+    def evaluate(left, right) -> bool:
+        left_number, right_number = _number(left), _number(right)
+        if left_number is not None and right_number is not None:
+            return compare(left_number, right_number)
+        if isinstance(left, str) and isinstance(right, str):
+            return compare(left, right)
+        return False
+    return evaluate
+
+def _contains(left, right) -> bool:
+    if isinstance(left, str):
+        return right is not None and str(right).lower() in left.lower()
+    if isinstance(left, (list, tuple)):
+        return any(_equal(item, right) for item in left)
+    if isinstance(left, dict):
+        return right in left
+    return False
+
+CONDITION_COMPARATORS = {
+    "==": _equal,
+    "!=": lambda left, right: not _equal(left, right),
+    "<": _ordered("<"),
+    "<=": _ordered("<="),
+    ">": _ordered(">"),
+    ">=": _ordered(">="),
+    "contains": _contains
+}
+
+def compile_reference(name: str):
+    # Returns ctx -> value for answer, answers.<step_id>[.key...] and
+    # session.<key>[.key...]
+    parts = name.split(".")
+    root, path = parts[0], parts[1:]
+    if root == "answer":
+        base = lambda ctx: ctx["answer"]
+    elif root == "answers":
+        if not path:
+            raise FlowDefinitionError("answers must be followed by a step id, as in answers.<step_id>")
+        step_id, path = path[0], path[1:]
+
+        def base(ctx):
+            entry = ctx["answers"].get(step_id)
+            return entry.get("answer") if isinstance(entry, dict) else None
+    elif root in ("session", "session_data"):
+        base = lambda ctx: ctx["session"]
+    else:
+        raise FlowDefinitionError(f"Unknown reference '{name}'; use answer, answers.<step_id> or session.<key>")
+    if not path:
+        return base
+
+    def resolve(ctx):
+        value = base(ctx)
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+    return resolve
+
+CONDITION_TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<number>\d+(?:\.\d+)?(?![\w.]\w))
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<op>==|!=|<=|>=|<|>|\.\.|[()\[\],-])
+  | (?P<name>[A-Za-z_][\w-]*(?:\.[\w-]+)*)
+)""", re.VERBOSE)
+CONDITION_KEYWORDS = {"and", "or", "not", "contains", "matches", "in", "true", "false", "null"}
+
+def lex_condition(source: str) -> List[tuple]:
+    tokens = []
+    pos = 0
+    source = source.rstrip()
+    while pos < len(source):
+        match = CONDITION_TOKEN_RE.match(source, pos)
+        if not match or match.end() == pos:
+            raise FlowDefinitionError(f"Unexpected character at position {pos + 1}: {source[pos:pos + 10]!r}")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "number":
+            tokens.append(("value", float(text) if "." in text else int(text), match.start(kind)))
+        elif kind == "string":
+            tokens.append(("value", ast.literal_eval(text), match.start(kind)))
+        elif kind == "name" and text in CONDITION_KEYWORDS:
+            if text in ("true", "false", "null"):
+                tokens.append(("value", {"true": True, "false": False, "null": None}[text], match.start(kind)))
+            else:
+                tokens.append(("op", text, match.start(kind)))
+        else:
+            tokens.append((kind, text, match.start(kind)))
+        pos = match.end()
+    return tokens
+
+def compile_condition_expression(source: str):
+    # Returns a predicate ctx -> bool; raises FlowDefinitionError with the
+    # position of the problem
+    if not isinstance(source, str) or not source.strip():
+        raise FlowDefinitionError("Condition expression is empty")
+    if len(source) > CONDITION_MAX_LENGTH:
+        raise FlowDefinitionError(f"Condition expression is limited to {CONDITION_MAX_LENGTH} characters")
+    tokens = lex_condition(source)
+    pos = 0
+    nodes = 0
+
+    def peek(*values) -> bool:
+        return pos < len(tokens) and tokens[pos][0] == "op" and tokens[pos][1] in values
+
+    def expect(value: str):
+        nonlocal pos
+        if not peek(value):
+            where = f"position {tokens[pos][2] + 1}" if pos < len(tokens) else "end of expression"
+            raise FlowDefinitionError(f"Expected '{value}' at {where}")
+        pos += 1
+
+    def count_node():
+        nonlocal nodes
+        nodes += 1
+        if nodes > CONDITION_MAX_NODES:
+            raise FlowDefinitionError(f"Condition expression is limited to {CONDITION_MAX_NODES} terms")
+
+    def parse_or():
+        nonlocal pos
+        branches = [parse_and()]
+        while peek("or"):
+            pos += 1
+            branches.append(parse_and())
+        if len(branches) == 1:
+            return branches[0]
+        return lambda ctx: any(branch(ctx) for branch in branches)
+
+    def parse_and():
+        nonlocal pos
+        terms = [parse_not()]
+        while peek("and"):
+            pos += 1
+            terms.append(parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda ctx: all(term(ctx) for term in terms)
+
+    def parse_not():
+        nonlocal pos
+        if peek("not"):
+            pos += 1
+            inner = parse_not()
+            return lambda ctx: not inner(ctx)
+        return parse_comparison()
+
+    def parse_comparison():
+        nonlocal pos
+        if peek("("):
+            pos += 1
+            inner = parse_or()
+            expect(")")
+            return inner
+        left = parse_operand()
+        if pos >= len(tokens) or tokens[pos][0] != "op" or tokens[pos][1] in ("and", "or", ")"):
+            # A bare operand is true when it holds a truthy value
+            return lambda ctx: bool(left(ctx))
+        op = tokens[pos][1]
+        pos += 1
+        count_node()
+        if op in CONDITION_COMPARATORS:
+            right = parse_operand()
+            comparator = CONDITION_COMPARATORS[op]
+            return lambda ctx: comparator(left(ctx), right(ctx))
+        if op == "matches":
+            if pos >= len(tokens) or tokens[pos][0] != "value" or not isinstance(tokens[pos][1], str):
+                raise FlowDefinitionError("matches must be followed by a quoted pattern")
+            compiled = compile_safe_regex(tokens[pos][1])
+            pos += 1
+            return lambda ctx: regex_matches(compiled, left(ctx))
+        if op == "in":
+            if peek("["):
+                items = parse_list()
+                return lambda ctx: any(_equal(left(ctx), item) for item in items)
+            low = parse_literal()
+            expect("..")
+            high = parse_literal()
+            low_number, high_number = _number(low), _number(high)
+            if low_number is None or high_number is None:
+                raise FlowDefinitionError("Range bounds must be numbers, as in 1..10")
+
+            def in_range(ctx) -> bool:
+                value = _number(left(ctx))
+                return value is not None and low_number <= value <= high_number
+            return in_range
+        raise FlowDefinitionError(f"Unexpected '{op}' at position {tokens[pos - 1][2] + 1}")
+
+    def parse_literal():
+        nonlocal pos
+        negative = False
+        if peek("-"):
+            negative = True
+            pos += 1
+        if pos >= len(tokens) or tokens[pos][0] != "value":
+            where = f"position {tokens[pos][2] + 1}" if pos < len(tokens) else "end of expression"
+            raise FlowDefinitionError(f"Expected a value at {where}")
+        value = tokens[pos][1]
+        pos += 1
+        if negative:
+            if _number(value) is None or isinstance(value, str):
+                raise FlowDefinitionError("Only numbers can be negated")
+            value = -value
+        return value
+
+    def parse_list() -> List[Any]:
+        nonlocal pos
+        expect("[")
+        items = []
+        while not peek("]"):
+            items.append(parse_literal())
+            if not peek("]"):
+                expect(",")
+        pos += 1
+        return items
+
+    def parse_operand():
+        nonlocal pos
+        count_node()
+        if pos < len(tokens) and tokens[pos][0] == "name":
+            reference = compile_reference(tokens[pos][1])
+            pos += 1
+            return reference
+        if peek("["):
+            items = parse_list()
+            return lambda ctx: items
+        value = parse_literal()
+        return lambda ctx: value
+
+    predicate = parse_or()
+    if pos < len(tokens):
+        raise FlowDefinitionError(f"Unexpected '{tokens[pos][1]}' at position {tokens[pos][2] + 1}")
+    return predicate
+
+CONDITION_OPERATORS = {
+    "equals": "==", "not_equals": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=", "contains": "contains"
+}
+
+def compile_condition(condition: dict):
+    # Structured conditions and expressions compile to the same predicates
+    if not isinstance(condition, dict):
+        raise FlowDefinitionError("Each condition must be an object")
+    if condition.get("expression") is not None:
+        return compile_condition_expression(condition["expression"])
+    field = compile_reference(condition.get("field") or "answer")
+    operator = condition.get("operator", "equals")
+    value = condition.get("value")
+    if operator in CONDITION_OPERATORS:
+        comparator = CONDITION_COMPARATORS[CONDITION_OPERATORS[operator]]
+        return lambda ctx: comparator(field(ctx), value)
+    if operator == "matches":
+        compiled = compile_safe_regex(value)
+        return lambda ctx: regex_matches(compiled, field(ctx))
+    if operator == "in":
+        if not isinstance(value, list):
+            raise FlowDefinitionError("The in operator needs a list value")
+        return lambda ctx: any(_equal(field(ctx), item) for item in value)
+    if operator == "between":
+        if not isinstance(value, (list, tuple)) or len(value) != 2 or _number(value[0]) is None or _number(value[1]) is None:
+            raise FlowDefinitionError("The between operator needs a [low, high] pair of numbers")
+        low, high = _number(value[0]), _number(value[1])
+
+        def between(ctx) -> bool:
+            number = _number(field(ctx))
+            return number is not None and low <= number <= high
+        return between
+    raise FlowDefinitionError(f"Unknown condition operator '{operator}'")
+
+def compile_conditional_logic(logic: dict) -> tuple:
+    # (list of (predicate, next_step), default_next_step)
+    if not isinstance(logic, dict):
+        raise FlowDefinitionError("conditional_logic must be an object")
+    conditions = logic.get("conditions") or []
+    if not isinstance(conditions, list):
+        raise FlowDefinitionError("conditional_logic.conditions must be a list")
+    compiled = []
+    for number, condition in enumerate(conditions, start=1):
+        try:
+            compiled.append((compile_condition(condition), condition.get("next_step")))
+        except FlowDefinitionError as e:
+            raise FlowDefinitionError(f"Condition {number}: {e}")
+    return compiled, logic.get("default_next_step")
+
+# Validation rules on TEXT_INPUT steps use the keys the flow editor already
+# writes: required, min_length, max_length, pattern (with pattern_message),
+# email and phone, plus min/max for numeric answers and enum for a fixed set
+# of accepted values. Like conditions they are compiled with the graph.
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s.]+(?:\.[^@\s.]+)+$")
+PHONE_RE = re.compile(r"^\+?[\d\s().-]{7,20}$")
+
+def _length_rule(rules: dict, key: str) -> Optional[int]:
+    value = rules.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise FlowDefinitionError(f"{key} must be a non-negative integer")
+    return value
+
+def _bound_rule(rules: dict, key: str) -> Optional[float]:
+    value = rules.get(key)
+    if value is None:
+        return None
+    number = _number(value)
+    if number is None or isinstance(value, str):
+        raise FlowDefinitionError(f"{key} must be a number")
+    return number
+
+def compile_validation_rules(rules: dict, required: bool = False):
+    # Returns answer -> error message, or None when the answer is valid
+    if not isinstance(rules, dict):
+        raise FlowDefinitionError("validation_rules must be an object")
+    required = bool(rules.get("required", required))
+    min_length, max_length = _length_rule(rules, "min_length"), _length_rule(rules, "max_length")
+    minimum, maximum = _bound_rule(rules, "min"), _bound_rule(rules, "max")
+    if min_length is not None and max_length is not None and min_length > max_length:
+        raise FlowDefinitionError("min_length cannot be greater than max_length")
+    if minimum is not None and maximum is not None and minimum > maximum:
+        raise FlowDefinitionError("min cannot be greater than max")
+
+    checks = []
+    if min_length is not None:
+        checks.append(lambda text: f"Minimum length is {min_length} characters" if len(text) < min_length else None)
+    if max_length is not None:
+        checks.append(lambda text: f"Maximum length is {max_length} characters" if len(text) > max_length else None)
+    if minimum is not None or maximum is not None:
+        def check_bounds(text: str) -> Optional[str]:
+            number = _number(text)
+            if number is None:
+                return "Please enter a number"
+            if minimum is not None and number < minimum:
+                return f"Minimum value is {rules['min']}"
+            if maximum is not None and number > maximum:
+                return f"Maximum value is {rules['max']}"
+            return None
+        checks.append(check_bounds)
+    if rules.get("enum") is not None:
+        if not isinstance(rules["enum"], list) or not rules["enum"]:
+            raise FlowDefinitionError("enum must be a non-empty list")
+        accepted = {str(value).strip().lower() for value in rules["enum"]}
+        listing = ", ".join(str(value) for value in rules["enum"][:10])
+        checks.append(lambda text: None if text.strip().lower() in accepted else f"Answer must be one of: {listing}")
+    if rules.get("email"):
+        checks.append(lambda text: None if regex_matches(EMAIL_RE, text.strip()) else "Please enter a valid email address")
+    if rules.get("phone"):
+        def check_phone(text: str) -> Optional[str]:
+            digits = sum(char.isdigit() for char in text)
+            if regex_matches(PHONE_RE, text.strip()) and 7 <= digits <= 15:
+                return None
+            return "Please enter a valid phone number"
+        checks.append(check_phone)
+    if rules.get("pattern"):
+        pattern = compile_safe_regex(rules["pattern"])
+        pattern_message = rules.get("pattern_message") or "Invalid format"
+
+        def check_pattern(text: str) -> Optional[str]:
+            if len(text) > SAFE_REGEX_MAX_INPUT_LENGTH:
+                return f"Maximum length is {SAFE_REGEX_MAX_INPUT_LENGTH} characters"
+            return None if regex_matches(pattern, text) else pattern_message
+        checks.append(check_pattern)
+
+    def validate(answer) -> Optional[str]:
+        if answer is None or (isinstance(answer, str) and not answer.strip()):
+            return "This field is required" if required else None
+        if isinstance(answer, (dict, list)):
+            return "Answer must be text"
+        text = answer if isinstance(answer, str) else str(answer)
+        for check in checks:
+            error = check(text)
+            if error:
+                return error
+        return None
+    return validate
+
+def validate_flow_step(step: dict):
+    # Authoring-time check so broken logic is reported on save, not when a
+    # user reaches the step
+    try:
+        if step["step_type"] == FlowStepType.CONDITIONAL_BRANCH:
+            compile_conditional_logic(step.get("conditional_logic") or {})
+    except FlowDefinitionError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid conditional_logic: {e}")
+    try:
+        if step["step_type"] == FlowStepType.TEXT_INPUT:
+            compile_validation_rules(step.get("validation_rules") or {})
+    except FlowDefinitionError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid validation_rules: {e}")
+
+def validate_flow_definition(steps: List[dict]):
+    # Everything validate_flow_step checks, plus that every edge points at a
+    # step of the same flow
+    step_ids = {step["id"] for step in steps}
+    for step in steps:
+        validate_flow_step(step)
+        targets = [option.get("next_step") for option in step.get("options") or []]
+        logic = step.get("conditional_logic") or {}
+        targets += [condition.get("next_step") for condition in logic.get("conditions") or []]
+        targets.append(logic.get("default_next_step"))
+        missing = [target for target in targets if target and target not in step_ids]
+        if missing:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Step '{step['question_text']}' points to unknown step {missing[0]}"
+            )
+
+# Flow graphs
+# Each flow version is compiled once into a graph of its steps: option and
+# conditional edges plus the step_order successor used as the fallback.
+# Published versions are immutable snapshots in flow_versions and executions
+# started from one stay pinned to it, so their graphs never need
+# invalidation. Flows that were never published run from the working copy
+# of their steps; step writes bump the flow version, so a draft graph is
+# never patched, a new version just compiles into a new cache entry.
+FLOW_GRAPH_CACHE_SIZE = int(os.getenv("FLOW_GRAPH_CACHE_SIZE", "256"))
+
+def _edge_key(value):
+    # Answers are matched by equality; unhashable values (lists, dicts) are
+    # compared through their JSON form
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ("json", json.dumps(value, sort_keys=True, default=str))
+
+class FlowGraph:
+    def __init__(self, flow_id: str, version: int, steps: List[dict]):
+        self.flow_id = flow_id
+        self.version = version
+        self.order = [step["id"] for step in steps]
+        self.steps = {step["id"]: step for step in steps}
+        self.first_step_id = self.order[0] if self.order else None
+
+        # Successor by order is the first step with a strictly greater
+        # step_order, so steps sharing an order are never chained
+        self.order_successor: Dict[str, Optional[str]] = {}
+        successor_index = 0
+        for position, step in enumerate(steps):
+            successor_index = max(successor_index, position + 1)
+            while successor_index < len(steps) and steps[successor_index]["step_order"] <= step["step_order"]:
+                successor_index += 1
+            self.order_successor[step["id"]] = steps[successor_index]["id"] if successor_index < len(steps) else None
+
+        # Option edges keep the first match, as a linear scan would; branch
+        # conditions are compiled once here and tried in order
+        self.option_edges: Dict[str, Dict[Any, Optional[str]]] = {}
+        self.branch_edges: Dict[str, tuple] = {}
+        self.validators: Dict[str, Any] = {}
+        self.subflow_ids: List[str] = []
+        for step in steps:
+            if step["step_type"] == FlowStepType.SUBFLOW and step.get("subflow_id"):
+                if step["subflow_id"] not in self.subflow_ids:
+                    self.subflow_ids.append(step["subflow_id"])
+            elif step["step_type"] == FlowStepType.TEXT_INPUT:
+                self.validators[step["id"]] = self._compile_validator(step)
+            elif step["step_type"] == FlowStepType.MULTIPLE_CHOICE:
+                edges: Dict[Any, Optional[str]] = {}
+                for option in step.get("options") or []:
+                    edges.setdefault(_edge_key(option.get("value")), option.get("next_step"))
+                self.option_edges[step["id"]] = edges
+            elif step["step_type"] == FlowStepType.CONDITIONAL_BRANCH:
+                self.branch_edges[step["id"]] = self._compile_branch(step)
+
+    def _compile_branch(self, step: dict) -> tuple:
+        # Steps saved before logic was validated may hold conditions that do
+        # not compile; those never match instead of failing the whole flow
+        logic = step.get("conditional_logic") or {}
+        rules = []
+        for condition in logic.get("conditions") or []:
+            try:
+                rules.append((compile_condition(condition), condition.get("next_step")))
+            except (FlowDefinitionError, AttributeError) as e:
+                logger.warning("Skipping invalid condition on step %s of flow %s: %s", step["id"], self.flow_id, e)
+        return rules, logic.get("default_next_step")
+
+    def _compile_validator(self, step: dict):
+        try:
+            return compile_validation_rules(step.get("validation_rules") or {}, step.get("is_required", False))
+        except FlowDefinitionError as e:
+            logger.warning("Ignoring invalid validation rules on step %s of flow %s: %s", step["id"], self.flow_id, e)
+            return compile_validation_rules({}, step.get("is_required", False))
+
+    def validate_answer(self, step_id: str, answer) -> Optional[str]:
+        validator = self.validators.get(step_id)
+        return validator(answer) if validator else None
+
+    def fixed_successor(self, step_id: str) -> tuple:
+        # (True, next step id) when the step leads to the same place whatever
+        # the answer, (False, None) when it depends on the answer
+        if step_id in self.option_edges:
+            successor = self.order_successor[step_id]
+            targets = {target or successor for target in self.option_edges[step_id].values()} | {successor}
+            return (True, successor) if len(targets) == 1 else (False, None)
+        if step_id in self.branch_edges:
+            rules, default_next_step = self.branch_edges[step_id]
+            return (True, default_next_step) if not rules else (False, None)
+        return True, self.order_successor[step_id]
+
+    def ordered_steps(self) -> List[dict]:
+        return [self.steps[step_id] for step_id in self.order]
+
+    def next_step_id(self, step_id: str, answer, answers: Optional[dict] = None,
+                     session_data: Optional[dict] = None) -> Optional[str]:
+        if step_id in self.option_edges:
+            return self.option_edges[step_id].get(_edge_key(answer)) or self.order_successor[step_id]
+        if step_id in self.branch_edges:
+            rules, default_next_step = self.branch_edges[step_id]
+            ctx = {"answer": answer, "answers": answers or {}, "session": session_data or {}}
+            for predicate, next_step in rules:
+                if predicate(ctx):
+                    return next_step
+            return default_next_step
+        return self.order_successor[step_id]
+
+class FlowGraphCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._graphs: "OrderedDict[tuple, FlowGraph]" = OrderedDict()
+
+    def get(self, key: tuple, load_steps) -> FlowGraph:
+        # key is (flow_id, published version) or (flow_id, "draft", flow version)
+        with self._lock:
+            graph = self._graphs.get(key)
+            if graph is not None:
+                self._graphs.move_to_end(key)
+                return graph
+        graph = FlowGraph(key[0], key[-1], load_steps())
+        with self._lock:
+            self._graphs[key] = graph
+            self._graphs.move_to_end(key)
+            while len(self._graphs) > self.max_entries:
+                self._graphs.popitem(last=False)
+        return graph
+
+    def invalidate_drafts(self, flow_id: str):
+        # Frees draft graphs of older versions early; correctness does not
+        # depend on it
+        with self._lock:
+            for key in [key for key in self._graphs if key[0] == flow_id and key[1] == "draft"]:
+                del self._graphs[key]
+
+flow_graphs = FlowGraphCache(FLOW_GRAPH_CACHE_SIZE)
+
+def get_flow_graph(flow: dict) -> FlowGraph:
+    # Working copy of the steps at the flow's current version
+    flow_id = flow["id"]
+    return flow_graphs.get(
+        (flow_id, "draft", flow.get("version", 1)),
+        lambda: list(db.flow_steps.find({"flow_id": flow_id}, {"_id": 0, "images": 0}).sort("step_order", 1))
+    )
+
+def get_published_flow_graph(flow_id: str, version: int) -> FlowGraph:
+    def load_steps() -> List[dict]:
+        published = db.flow_versions.find_one({"flow_id": flow_id, "version": version}, {"_id": 0, "steps.images": 0})
+        if not published:
+            raise HTTPException(status_code=404, detail="Flow version not found")
+        return published["steps"]
+    return flow_graphs.get((flow_id, version), load_steps)
+
+def get_execution_graph(execution: dict, flow: Optional[dict] = None) -> FlowGraph:
+    if execution.get("flow_version"):
+        return get_published_flow_graph(execution["flow_id"], execution["flow_version"])
+    flow = flow or db.flows.find_one({"id": execution["flow_id"]}, {"_id": 0, "id": 1, "version": 1})
+    if not flow:
+        raise HTTPException(status_code=404, detail="Flow not found")
+    return get_flow_graph(flow)
+
+# Subflows
+# A SUBFLOW step runs another flow in place. Child flows are resolved when
+# the parent execution starts: each is pinned to its published version (or
+# the draft version at that moment), its graph is loaded into the cache and
+# cycles are refused. The execution keeps a call stack of the parent steps
+# it entered subflows from, so moving in and out of a subflow never needs
+# more than the cached graphs.
+# Only published pins are immutable. Draft steps are not snapshotted, so a
+# draft pin holds only while its graph stays cached; once evicted, the
+# graph is rebuilt from the current draft steps under the old pin. Publish
+# a flow before using it as a subflow where that matters.
+MAX_SUBFLOW_DEPTH = 8
+
+def get_pinned_flow_graph(flow_id: str, pin: dict) -> FlowGraph:
+    if pin.get("flow_version"):
+        return get_published_flow_graph(flow_id, pin["flow_version"])
+    return get_flow_graph({"id": flow_id, "version": pin.get("draft_version", 1)})
+
+def flow_pin(flow: dict) -> dict:
+    return {"flow_version": flow.get("published_version"), "draft_version": flow.get("version", 1)}
+
+def resolve_subflows(graph: FlowGraph, ancestors: tuple = ()) -> Dict[str, dict]:
+    # Pins every flow reachable through subflow steps; raises
+    # FlowDefinitionError on a cycle, a missing flow or excessive nesting
+    pins: Dict[str, dict] = {}
+    graphs = {graph.flow_id: graph}
+    resolved = set()
+
+    def visit(current: FlowGraph, path: tuple):
+        if len(path) > MAX_SUBFLOW_DEPTH:
+            raise FlowDefinitionError(f"Subflows are nested more than {MAX_SUBFLOW_DEPTH} levels deep")
+        for child_id in current.subflow_ids:
+            if child_id in path:
+                raise FlowDefinitionError(f"Subflow cycle: flow {child_id} is reached from itself")
+            if child_id in resolved:
+                continue
+            if child_id not in graphs:
+                child = db.flows.find_one({"id": child_id}, {"_id": 0, "id": 1, "version": 1, "published_version": 1})
+                if not child:
+                    raise FlowDefinitionError(f"Subflow {child_id} not found")
+                pins[child_id] = flow_pin(child)
+                graphs[child_id] = get_pinned_flow_graph(child_id, pins[child_id])
+            visit(graphs[child_id], path + (child_id,))
+            resolved.add(child_id)
+
+    visit(graph, ancestors + (graph.flow_id,))
+    return pins
+
+def get_execution_graphs(execution: dict, flow: Optional[dict] = None) -> Dict[str, FlowGraph]:
+    graphs = {execution["flow_id"]: get_execution_graph(execution, flow)}
+    for child_id, pin in (execution.get("subflow_versions") or {}).items():
+        graphs[child_id] = get_pinned_flow_graph(child_id, pin)
+    return graphs
+
+def check_subflow_target(flow_id: str, subflow_id: Optional[str]):
+    if not subflow_id:
+        raise HTTPException(status_code=400, detail="Subflow steps need a subflow_id")
+    if subflow_id == flow_id:
+        raise HTTPException(status_code=400, detail="A flow cannot be its own subflow")
+    child = db.flows.find_one({"id": subflow_id}, {"_id": 0, "id": 1, "version": 1, "published_version": 1})
+    if not child:
+        raise HTTPException(status_code=400, detail="Subflow not found")
+    try:
+        resolve_subflows(get_pinned_flow_graph(subflow_id, flow_pin(child)), (flow_id,))
+    except FlowDefinitionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def expand_subflow_steps(graphs: Dict[str, FlowGraph], flow_id: str, depth: int = 0) -> List[dict]:
+    # Steps in order with each subflow's steps following the step that
+    # enters it
+    steps = []
+    for step in graphs[flow_id].ordered_steps():
+        steps.append(step)
+        child_id = step.get("subflow_id") if step["step_type"] == FlowStepType.SUBFLOW else None
+        if child_id in graphs and depth < MAX_SUBFLOW_DEPTH:
+            steps.extend(expand_subflow_steps(graphs, child_id, depth + 1))
+    return steps
+
+class ExecutionCursor:
+    # Position of an execution: the flow it is in and the stack of
+    # {"flow_id", "step_id"} frames it entered subflows from
+    def __init__(self, graphs: Dict[str, FlowGraph], flow_id: str, call_stack: List[dict]):
+        self.graphs = graphs
+        self.flow_id = flow_id
+        self.call_stack = call_stack
+
+    @classmethod
+    def for_execution(cls, execution: dict, graphs: Dict[str, FlowGraph]) -> "ExecutionCursor":
+        flow_id = execution.get("current_flow_id") or execution["flow_id"]
+        return cls(graphs, flow_id if flow_id in graphs else execution["flow_id"], list(execution.get("call_stack") or []))
+
+    @property
+    def graph(self) -> FlowGraph:
+        return self.graphs[self.flow_id]
+
+    def settle(self, step_id: Optional[str], answers: Optional[dict] = None,
+               session_data: Optional[dict] = None) -> Optional[str]:
+        # Enters subflows and returns to parents until step_id is a step the
+        # user answers, or None when the whole execution is finished
+        while True:
+            if step_id is None:
+                if not self.call_stack:
+                    return None
+                frame = self.call_stack.pop()
+                self.flow_id = frame["flow_id"]
+                step_id = self.graph.next_step_id(frame["step_id"], None, answers, session_data)
+                continue
+            step = self.graph.steps.get(step_id)
+            child_id = step.get("subflow_id") if step and step["step_type"] == FlowStepType.SUBFLOW else None
+            if child_id not in self.graphs:
+                return step_id
+            stack_flow_ids = {frame["flow_id"] for frame in self.call_stack} | {self.flow_id}
+            if len(self.call_stack) >= MAX_SUBFLOW_DEPTH or child_id in stack_flow_ids:
+                raise HTTPException(status_code=400, detail="Subflow cycle detected")
+            self.call_stack.append({"flow_id": self.flow_id, "step_id": step_id})
+            self.flow_id = child_id
+            step_id = self.graph.first_step_id
+
+    def copy(self) -> "ExecutionCursor":
+        return ExecutionCursor(self.graphs, self.flow_id, list(self.call_stack))
+
+    def advance(self, step_id: str, answer, answers: Optional[dict] = None,
+                session_data: Optional[dict] = None) -> Optional[str]:
+        next_step_id = self.graph.next_step_id(step_id, answer, answers, session_data)
+        return self.settle(next_step_id, answers, session_data)
+
+MAX_ANSWER_BATCH_SIZE = 500
+
+def apply_step_answer(cursor: ExecutionCursor, answers: dict, session_data: Optional[dict],
+                      answer_data: FlowStepAnswer, events: Optional[list] = None) -> Optional[str]:
+    # Validates one answer against the flow the cursor is in, records it in
+    # answers and moves the cursor on; returns the next step id. Funnel
+    # events are appended to events for the caller to record once saved.
+    if answer_data.step_id not in cursor.graph.steps:
+        raise HTTPException(status_code=404, detail="Flow step not found")
+    
+    validation_error = cursor.graph.validate_answer(answer_data.step_id, answer_data.answer)
+    if validation_error:
+        raise HTTPException(status_code=400, detail=validation_error)
+    
+    answers[answer_data.step_id] = {
+        "answer": answer_data.answer,
+        "metadata": answer_data.metadata or {},
+        "answered_at": datetime.utcnow().isoformat()
+    }
+    
+    # The selected option or matching branch, falling back to the next step
+    # by order, entering or leaving subflows on the way
+    flow_id = cursor.flow_id
+    is_choice = cursor.graph.steps[answer_data.step_id]["step_type"] == FlowStepType.MULTIPLE_CHOICE
+    next_step_id = cursor.advance(answer_data.step_id, answer_data.answer, answers, session_data)
+    if events is not None:
+        events.append(("answered", flow_id, answer_data.step_id, answer_data.answer if is_choice else None))
+        if next_step_id:
+            events.append(("reached", cursor.flow_id, next_step_id))
+    return next_step_id
+
+def seconds_since_reached(execution: dict, step_id: str) -> Optional[float]:
+    reached_at = execution.get("current_step_reached_at")
+    if not reached_at or execution.get("current_step_id") != step_id:
+        return None
+    return max((datetime.utcnow() - reached_at).total_seconds(), 0.0)
+
+def step_payload(step: dict) -> dict:
+    # Graphs are loaded without images, so embedded steps carry none; the
+    # client fetches the step itself when it needs them
+    return {key: value for key, value in step.items() if key != "images"}
+
+def upcoming_steps(cursor: ExecutionCursor, next_step_id: Optional[str]) -> dict:
+    # The step the execution moved to and, when its successor does not
+    # depend on the answer, the one after it, straight from the graphs
+    if not next_step_id:
+        return {"next_step": None, "following_step": None}
+    lookahead = cursor.copy()
+    upcoming = {"next_step": step_payload(lookahead.graph.steps[next_step_id]), "following_step": None}
+    deterministic, successor_id = lookahead.graph.fixed_successor(next_step_id)
+    if deterministic:
+        following_id = lookahead.settle(successor_id)
+        if following_id:
+            upcoming["following_step"] = step_payload(lookahead.graph.steps[following_id])
+    return upcoming
+
+def save_execution_progress(execution: dict, update_data: dict) -> dict:
+    # Writes only the given fields, and only while the execution is still in
+    # progress at the step it was read at; a concurrent submission (another
+    # tab, a retried request) gets a 409 instead of silently overwriting
+    if FLOW_SESSION_CACHE_ENABLED:
+        updated = execution_sessions.update(execution, update_data)
+        if updated is not None:
+            return updated
+    updated = db.flow_executions.find_one_and_update(
+        {
+            "flow_id": execution["flow_id"],
+            "session_id": execution["session_id"],
+            "status": FlowExecutionStatus.IN_PROGRESS,
+            "current_step_id": execution.get("current_step_id")
+        },
+        {"$set": update_data},
+        projection={"_id": 0, "status": 1, "current_step_id": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
+        raise HTTPException(status_code=409, detail="Flow execution was updated concurrently, reload and retry")
+    return updated
+
+# Flow execution sessions
+# With FLOW_SESSION_CACHE_ENABLED, executions in progress live in memory and
+# their writes reach Mongo in batches every FLOW_SESSION_FLUSH_SECONDS, so
+# an agent clicking through a flow costs no reads and a fraction of the
+# writes. This needs session affinity: every request for a session must
+# reach the same process, which is why it is off by default.
+# Durability: every accepted write is appended to a local journal before the
+# request returns (and fsynced when FLOW_SESSION_JOURNAL_FSYNC is set, which
+# also covers power loss rather than just a process crash). Each worker
+# journals to its own FLOW_SESSION_JOURNAL_PATH.<worker id> file and holds an
+# exclusive flock on a matching .lock file for as long as it runs, so at
+# startup a worker replays into Mongo only the journals whose lock it can
+# take, i.e. those left behind by workers that are gone. A journal is
+# rotated away after each flush that reached Mongo. Completed executions are
+# flushed right away; idle ones are flushed and dropped after
+# FLOW_SESSION_IDLE_SECONDS.
+# Every write was accepted while the execution was in progress, so flushes
+# and replays only apply while Mongo still has it in progress. A late flush
+# for an execution another worker's sweep has abandoned or archived is
+# refused, logged and counted in unmatched_writes, and the entry is dropped.
+FLOW_SESSION_CACHE_ENABLED = os.getenv("FLOW_SESSION_CACHE_ENABLED", "false").lower() == "true"
+FLOW_SESSION_FLUSH_SECONDS = float(os.getenv("FLOW_SESSION_FLUSH_SECONDS", "2"))
+FLOW_SESSION_IDLE_SECONDS = int(os.getenv("FLOW_SESSION_IDLE_SECONDS", "300"))
+FLOW_SESSION_MAX_ENTRIES = int(os.getenv("FLOW_SESSION_MAX_ENTRIES", "10000"))
+FLOW_SESSION_JOURNAL_PATH = os.getenv(
+    "FLOW_SESSION_JOURNAL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "flow_sessions.journal")
+)
+FLOW_SESSION_JOURNAL_FSYNC = os.getenv("FLOW_SESSION_JOURNAL_FSYNC", "false").lower() == "true"
+
+def _copy_execution(execution: dict) -> dict:
+    # Callers mutate answers and call_stack while applying an answer
+    return dict(execution, answers=dict(execution.get("answers") or {}), call_stack=list(execution.get("call_stack") or []))
+
+def _apply_set(execution: dict, update_data: dict):
+    for path, value in update_data.items():
+        target = execution
+        *parents, field = path.split(".")
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[field] = value
+
+def _claim_journal(journal_path: str):
+    # Returns the locked .lock file of a journal, or None while the worker
+    # that writes the journal is still alive and holds it
+    lock_file = open(journal_path + ".lock", "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+class ExecutionSessionStore:
+    def __init__(self, journal_base: str, worker_id: str, max_entries: int):
+        self.journal_base = journal_base
+        self.journal_path = f"{journal_base}.{worker_id}"
+        self.flushing_path = self.journal_path + ".flushing"
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (flow_id, session_id) -> {"doc", "pending", "touched", "discard"}
+        self._entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._flush_lock = threading.Lock()
+        self._journal = None
+        self._journal_lock = None
+        self.unmatched_writes = 0
+
+    def open(self):
+        self._journal_lock = _claim_journal(self.journal_path)
+        if self._journal_lock is None:
+            raise RuntimeError(f"Flow session journal {self.journal_path} is locked by another process")
+        self.replay()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def get(self, flow_id: str, session_id: str) -> Optional[dict]:
+        key = (flow_id, session_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not entry["discard"]:
+                self._entries.move_to_end(key)
+                entry["touched"] = time.monotonic()
+                return _copy_execution(entry["doc"])
+        execution = db.flow_executions.find_one({"flow_id": flow_id, "session_id": session_id}, {"_id": 0})
+        if execution and execution["status"] == FlowExecutionStatus.IN_PROGRESS:
+            self.add(execution)
+        return execution
+
+    def add(self, execution: dict):
+        key = (execution["flow_id"], execution["session_id"])
+        doc = _copy_execution({field: value for field, value in execution.items() if field != "_id"})
+        with self._lock:
+            # A write that raced this load is newer than what Mongo returned
+            if key not in self._entries:
+                self._entries[key] = {"doc": doc, "pending": {}, "touched": time.monotonic(), "discard": False}
+
+    def update(self, execution: dict, update_data: dict) -> Optional[dict]:
+        # Same contract as the conditional Mongo update; None when the
+        # session is not held here and Mongo must be written directly
+        key = (execution["flow_id"], execution["session_id"])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["discard"]:
+                return None
+            doc = entry["doc"]
+            if doc["status"] != FlowExecutionStatus.IN_PROGRESS or doc.get("current_step_id") != execution.get("current_step_id"):
+                raise HTTPException(status_code=409, detail="Flow execution was updated concurrently, reload and retry")
+            self._journal.write(json_util.dumps({"flow_id": key[0], "session_id": key[1], "set": update_data}) + "\n")
+            self._journal.flush()
+            if FLOW_SESSION_JOURNAL_FSYNC:
+                os.fsync(self._journal.fileno())
+            _apply_set(doc, update_data)
+            entry["pending"].update(update_data)
+            entry["touched"] = time.monotonic()
+            finished = doc["status"] != FlowExecutionStatus.IN_PROGRESS
+            result = {"status": doc["status"], "current_step_id": doc.get("current_step_id")}
+        if finished:
+            self.flush()
+        return result
+
+    def flush(self):
+        # Flushes are serialized so a rotated journal is only removed once
+        # every write it holds has reached Mongo
+        with self._flush_lock:
+            with self._lock:
+                writes = [(key, entry["pending"]) for key, entry in self._entries.items() if entry["pending"]]
+                for key, pending in writes:
+                    self._entries[key]["pending"] = {}
+                if writes:
+                    self._rotate_journal()
+            if writes:
+                try:
+                    result = db.flow_executions.bulk_write([
+                        UpdateOne(
+                            {"flow_id": flow_id, "session_id": session_id, "status": FlowExecutionStatus.IN_PROGRESS},
+                            {"$set": pending}
+                        )
+                        for (flow_id, session_id), pending in writes
+                    ], ordered=False)
+                except Exception:
+                    # Put the writes back under anything newer; the rotated
+                    # journal stays until a flush succeeds
+                    with self._lock:
+                        for key, pending in writes:
+                            if key in self._entries:
+                                self._entries[key]["pending"] = {**pending, **self._entries[key]["pending"]}
+                    raise
+                os.remove(self.flushing_path)
+                if result.matched_count < len(writes):
+                    self._drop_unmatched(writes)
+            self._evict()
+
+    def _drop_unmatched(self, writes: List[tuple]):
+        # Finds the executions a flush did not match by checking whether
+        # Mongo now holds the status the write would have left behind
+        current = {
+            (doc["flow_id"], doc["session_id"]): doc.get("status")
+            for doc in db.flow_executions.find(
+                {"$or": [{"flow_id": flow_id, "session_id": session_id} for (flow_id, session_id), _ in writes]},
+                {"_id": 0, "flow_id": 1, "session_id": 1, "status": 1}
+            )
+        }
+        for key, pending in writes:
+            if current.get(key) == pending.get("status", FlowExecutionStatus.IN_PROGRESS):
+                continue
+            self.unmatched_writes += 1
+            logger.warning("Dropped flow execution write for %s/%s: execution is %s in Mongo", key[0], key[1], current.get(key, "gone"))
+            with self._lock:
+                self._entries.pop(key, None)
+
+    def _rotate_journal(self):
+        # Called with the lock held; everything journaled so far is covered
+        # by the flush about to run
+        self._journal.close()
+        if os.path.exists(self.flushing_path):
+            with open(self.flushing_path, "a", encoding="utf-8") as flushing, open(self.journal_path, encoding="utf-8") as journal:
+                flushing.write(journal.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.flushing_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _evict(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in list(self._entries):
+                entry = self._entries[key]
+                if entry["pending"]:
+                    continue
+                if (entry["discard"]
+                        or entry["doc"]["status"] != FlowExecutionStatus.IN_PROGRESS
+                        or now - entry["touched"] > FLOW_SESSION_IDLE_SECONDS
+                        or len(self._entries) > self.max_entries):
+                    del self._entries[key]
+
+    def discard(self, keys: List[tuple]):
+        # For sessions changed in Mongo behind the store's back. Entries with
+        # writes still pending stop serving requests and are dropped by the
+        # flush that lands those writes, so nothing journaled is lost.
+        flush_needed = False
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry["pending"]:
+                    entry["discard"] = True
+                    flush_needed = True
+                else:
+                    del self._entries[key]
+        if flush_needed:
+            self.flush()
+
+    def replay(self):
+        # Replays this worker's own journal (left by an earlier process with
+        # the same worker id) and every journal whose worker is gone. Journals
+        # of live workers are skipped since their lock cannot be taken.
+        self._replay_journal(self.journal_path)
+        pattern = glob.escape(self.journal_base) + ".*.lock"
+        for lock_path in glob.glob(pattern):
+            journal_path = lock_path[:-len(".lock")]
+            if journal_path == self.journal_path:
+                continue
+            lock_file = _claim_journal(journal_path)
+            if lock_file is None:
+                continue
+            try:
+                self._replay_journal(journal_path)
+                os.remove(lock_path)
+            finally:
+                lock_file.close()
+
+    def _replay_journal(self, journal_path: str):
+        # Re-applies writes a crashed process journaled but never flushed;
+        # $set is idempotent, so writes that did reach Mongo are harmless
+        writes = []
+        paths = (journal_path + ".flushing", journal_path)
+        for path in paths:
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as journal:
+                    for line in journal:
+                        try:
+                            record = json_util.loads(line)
+                        except ValueError:
+                            break  # A torn last line from the crash
+                        writes.append(UpdateOne(
+                            {"flow_id": record["flow_id"], "session_id": record["session_id"], "status": FlowExecutionStatus.IN_PROGRESS},
+                            {"$set": record["set"]}
+                        ))
+        if writes:
+            db.flow_executions.bulk_write(writes, ordered=True)
+            logger.info("Replayed %d journaled flow execution writes from %s", len(writes), journal_path)
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+execution_sessions = ExecutionSessionStore(FLOW_SESSION_JOURNAL_PATH, WORKER_ID.replace(":", "."), FLOW_SESSION_MAX_ENTRIES)
+
+def load_execution(flow_id: str, session_id: str) -> Optional[dict]:
+    if FLOW_SESSION_CACHE_ENABLED:
+        execution = execution_sessions.get(flow_id, session_id)
+    else:
+        execution = db.flow_executions.find_one({"flow_id": flow_id, "session_id": session_id}, {"_id": 0})
+    if execution is None:
+        # Finished executions stay readable (summaries) once archived
+        execution = find_archived_execution(flow_id, session_id)
+    return execution
+
+def execution_session_loop():
+    while True:
+        time.sleep(FLOW_SESSION_FLUSH_SECONDS)
+        try:
+            execution_sessions.flush()
+        except Exception:
+            logger.exception("Flow execution session flush failed")
+
+@app.on_event("startup")
+def start_execution_sessions():
+    if FLOW_SESSION_CACHE_ENABLED:
+        execution_sessions.open()
+        threading.Thread(target=execution_session_loop, name="flow-execution-sessions", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_execution_sessions():
+    if FLOW_SESSION_CACHE_ENABLED:
+        execution_sessions.flush()
+
+# Flow execution lifecycle
+# A periodic sweep keeps flow_executions proportional to live sessions:
+# executions idle for FLOW_EXECUTION_ABANDON_HOURS are marked abandoned, and
+# completed or abandoned ones whose last activity is older than
+# FLOW_EXECUTION_ARCHIVE_DAYS move to a monthly archive collection,
+# flow_executions_YYYY_MM by started_at. flow_execution_partitions lists the
+# partitions with their month and size, so readers open only the months a
+# time range covers, and flow_execution_locator maps a session to its
+# partition for single lookups. Partitions older than
+# FLOW_EXECUTION_RETENTION_MONTHS are dropped whole (0 keeps them).
+FLOW_EXECUTION_ABANDON_HOURS = float(os.getenv("FLOW_EXECUTION_ABANDON_HOURS", "24"))
+FLOW_EXECUTION_ARCHIVE_DAYS = int(os.getenv("FLOW_EXECUTION_ARCHIVE_DAYS", "30"))
+FLOW_EXECUTION_RETENTION_MONTHS = int(os.getenv("FLOW_EXECUTION_RETENTION_MONTHS", "12"))
+FLOW_EXECUTION_SWEEP_INTERVAL_SECONDS = int(os.getenv("FLOW_EXECUTION_SWEEP_INTERVAL_SECONDS", "900"))
+FLOW_EXECUTION_SWEEP_BATCH_SIZE = 1000
+FLOW_EXECUTION_SWEEP_LEASE_SECONDS = 3600
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+def add_months(start: datetime, months: int) -> datetime:
+    index = start.year * 12 + start.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def archive_partition_name(start: datetime) -> str:
+    return f"flow_executions_{start.year:04d}_{start.month:02d}"
+
+_known_partitions = set()
+
+def ensure_archive_partition(start: datetime) -> str:
+    name = archive_partition_name(start)
+    if name not in _known_partitions:
+        db[name].create_index([("flow_id", 1), ("started_at", 1)])
+        db[name].create_index("started_at")
+        db.flow_execution_partitions.update_one(
+            {"_id": name},
+            {"$setOnInsert": {"month_start": start, "month_end": add_months(start, 1), "count": 0}},
+            upsert=True
+        )
+        _known_partitions.add(name)
+    return name
+
+def archive_partitions(start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[dict]:
+    # Partitions whose month overlaps [start, end), newest first
+    query: Dict[str, Any] = {}
+    if start:
+        query["month_end"] = {"$gt": start}
+    if end:
+        query["month_start"] = {"$lt": end}
+    return list(db.flow_execution_partitions.find(query).sort("month_start", -1))
+
+def execution_collections(start: Optional[datetime] = None, end: Optional[datetime] = None) -> list:
+    # The live collection plus the archive partitions a started_at range needs
+    return [db.flow_executions] + [db[partition["_id"]] for partition in archive_partitions(start, end)]
+
+def find_archived_execution(flow_id: str, session_id: str) -> Optional[dict]:
+    location = db.flow_execution_locator.find_one({"flow_id": flow_id, "session_id": session_id}, {"_id": 0, "partition": 1})
+    if not location:
+        return None
+    return db[location["partition"]].find_one({"flow_id": flow_id, "session_id": session_id}, {"_id": 0})
+
+def abandon_idle_executions(now: datetime) -> int:
+    query = {
+        "status": FlowExecutionStatus.IN_PROGRESS,
+        "last_activity": {"$lt": now - timedelta(hours=FLOW_EXECUTION_ABANDON_HOURS)}
+    }
+    abandoned = 0
+    if FLOW_SESSION_CACHE_ENABLED:
+        # last_activity of sessions held in memory must be current in Mongo
+        execution_sessions.flush()
+    while True:
+        batch = list(db.flow_executions.find(query, {"_id": 1, "flow_id": 1, "session_id": 1}).limit(FLOW_EXECUTION_SWEEP_BATCH_SIZE))
+        if not batch:
+            break
+        # The query is repeated so a session that became active meanwhile
+        # is left alone
+        result = db.flow_executions.update_many(
+            {**query, "_id": {"$in": [doc["_id"] for doc in batch]}},
+            {"$set": {"status": FlowExecutionStatus.ABANDONED, "abandoned_at": now}}
+        )
+        if FLOW_SESSION_CACHE_ENABLED:
+            execution_sessions.discard([(doc["flow_id"], doc["session_id"]) for doc in batch])
+        abandoned += result.modified_count
+        if len(batch) < FLOW_EXECUTION_SWEEP_BATCH_SIZE:
+            break
+    return abandoned
+
+def archive_execution_batch(source, batch: List[dict], now: datetime):
+    partitions: Dict[str, List[dict]] = {}
+    for execution in batch:
+        execution["archived_at"] = now
+        started_at = execution.get("started_at") or execution.get("last_activity") or now
+        partitions.setdefault(ensure_archive_partition(month_start(started_at)), []).append(execution)
+    
+    for name, executions in partitions.items():
+        # Copies keep their _id, so a batch repeated after a crash between
+        # the insert and the delete only hits duplicate keys
+        inserted = len(executions)
+        try:
+            db[name].insert_many(executions, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            inserted -= len(errors)
+        db.flow_execution_locator.bulk_write([
+            UpdateOne(
+                {"flow_id": execution["flow_id"], "session_id": execution["session_id"]},
+                {"$set": {"partition": name}},
+                upsert=True
+            )
+            for execution in executions
+        ], ordered=False)
+        db.flow_execution_partitions.update_one({"_id": name}, {"$inc": {"count": inserted}})
+    source.delete_many({"_id": {"$in": [execution["_id"] for execution in batch]}})
+
+def archive_finished_executions(now: datetime) -> int:
+    query = {
+        "status": {"$in": [FlowExecutionStatus.COMPLETED, FlowExecutionStatus.ABANDONED]},
+        "last_activity": {"$lt": now - timedelta(days=FLOW_EXECUTION_ARCHIVE_DAYS)}
+    }
+    archived = 0
+    while True:
+        batch = list(db.flow_executions.find(query).limit(FLOW_EXECUTION_SWEEP_BATCH_SIZE))
+        if not batch:
+            break
+        archive_execution_batch(db.flow_executions, batch, now)
+        archived += len(batch)
+        if len(batch) < FLOW_EXECUTION_SWEEP_BATCH_SIZE:
+            break
+    return archived
+
+def drop_expired_partitions(now: datetime) -> int:
+    if FLOW_EXECUTION_RETENTION_MONTHS <= 0:
+        return 0
+    cutoff = add_months(month_start(now), -FLOW_EXECUTION_RETENTION_MONTHS)
+    expired = list(db.flow_execution_partitions.find({"month_end": {"$lte": cutoff}}, {"_id": 1}))
+    for partition in expired:
+        name = partition["_id"]
+        db[name].drop()
+        db.flow_execution_locator.delete_many({"partition": name})
+        db.flow_execution_partitions.delete_one({"_id": name})
+        _known_partitions.discard(name)
+    return len(expired)
+
+def sweep_flow_executions():
+    now = datetime.utcnow()
+    abandoned = abandon_idle_executions(now)
+    archived = archive_finished_executions(now)
+    dropped = drop_expired_partitions(now)
+    if abandoned or archived or dropped:
+        logger.info("Flow execution sweep: %d abandoned, %d archived, %d partitions dropped", abandoned, archived, dropped)
+
+def flow_execution_sweep_loop():
+    while True:
+        time.sleep(FLOW_EXECUTION_SWEEP_INTERVAL_SECONDS)
+        if not acquire_job_lease("flow_execution_sweep", FLOW_EXECUTION_SWEEP_LEASE_SECONDS):
+            continue
+        try:
+            sweep_flow_executions()
+        except Exception:
+            logger.exception("Flow execution sweep failed")
+        finally:
+            release_job_lease("flow_execution_sweep")
+
+@app.on_event("startup")
+def start_flow_execution_sweeper():
+    db.flow_executions.create_index([("status", 1), ("last_activity", 1)])
+    db.flow_executions.create_index("started_at")
+    db.flow_executions.create_index([("flow_id", 1), ("started_at", 1)])
+    db.flow_execution_locator.create_index([("flow_id", 1), ("session_id", 1)], unique=True)
+    db.flow_execution_locator.create_index("partition")
+    threading.Thread(target=flow_execution_sweep_loop, name="flow-execution-sweep", daemon=True).start()
+
+# Flow execution export
+# Exports stream from Mongo cursors straight into the response, a few
+# hundred rows per chunk, so memory does not grow with the number of
+# executions. CSV has one column per step of the flow and of the subflows it
+# runs (across their draft and published versions); NDJSON carries every
+# answer with its question.
+EXPORT_BATCH_SIZE = 500
+EXPORT_EXECUTION_FIELDS = ["execution_id", "session_id", "user_id", "status", "flow_version", "started_at", "completed_at"]
+EXPORT_PROJECTION = {
+    "_id": 0, "id": 1, "session_id": 1, "user_id": 1, "status": 1, "flow_version": 1,
+    "started_at": 1, "completed_at": 1, "answers": 1
+}
+
+def export_step_columns(flow_id: str, label_prefix: str = "", ancestors: tuple = (), seen: Optional[set] = None) -> List[dict]:
+    # Steps of every version of the flow, by id, with the latest text. Each
+    # subflow step is followed by the steps of the flow it runs, labelled
+    # under it (3.1, 3.2, ...), as the summary lists them
+    seen = set() if seen is None else seen
+    fields = ("id", "step_order", "question_text", "step_type", "subflow_id")
+    steps: Dict[str, dict] = {}
+    versions = db.flow_versions.find(
+        {"flow_id": flow_id},
+        {"_id": 0, **{f"steps.{field}": 1 for field in fields}}
+    ).sort("version", 1)
+    for version in versions:
+        for step in version["steps"]:
+            steps[step["id"]] = step
+    for step in db.flow_steps.find({"flow_id": flow_id}, {"_id": 0, **{field: 1 for field in fields}}):
+        steps[step["id"]] = step
+    columns = []
+    path = ancestors + (flow_id,)
+    for step in sorted(steps.values(), key=lambda step: step["step_order"]):
+        if step["id"] in seen:
+            continue
+        seen.add(step["id"])
+        label = f"{label_prefix}{step['step_order']}"
+        columns.append({**step, "label": label})
+        child_id = step.get("subflow_id") if step.get("step_type") == FlowStepType.SUBFLOW else None
+        if child_id and child_id not in path and len(path) <= MAX_SUBFLOW_DEPTH:
+            columns.extend(export_step_columns(child_id, label + ".", path, seen))
+    return columns
+
+def export_executions(flow_id: str, start: Optional[datetime], end: Optional[datetime]):
+    # Archive months oldest first, then the live collection
+    query: Dict[str, Any] = {"flow_id": flow_id}
+    if start or end:
+        query["started_at"] = {}
+        if start:
+            query["started_at"]["$gte"] = start
+        if end:
+            query["started_at"]["$lt"] = end
+    for collection in reversed(execution_collections(start, end)):
+        yield from collection.find(query, EXPORT_PROJECTION).sort("started_at", 1).batch_size(EXPORT_BATCH_SIZE)
+
+def export_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        text = "; ".join(export_value(item) for item in value)
+    elif isinstance(value, dict):
+        text = json.dumps(value, default=str)
+    else:
+        text = str(value)
+    # Keeps spreadsheet applications from evaluating answers as formulas
+    return "'" + text if text[:1] in ("=", "+", "-", "@") else text
+
+def export_row(execution: dict) -> dict:
+    return {
+        "execution_id": execution["id"],
+        "session_id": execution["session_id"],
+        "user_id": execution.get("user_id"),
+        "status": execution["status"],
+        "flow_version": execution.get("flow_version"),
+        "started_at": execution.get("started_at"),
+        "completed_at": execution.get("completed_at")
+    }
+
+def stream_executions_csv(flow_id: str, start: Optional[datetime], end: Optional[datetime]):
+    columns = export_step_columns(flow_id)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_EXECUTION_FIELDS + [f"{step['label']}. {step['question_text']}" for step in columns])
+    for count, execution in enumerate(export_executions(flow_id, start, end), start=1):
+        row = export_row(execution)
+        answers = execution.get("answers") or {}
+        writer.writerow(
+            [export_value(row[field]) for field in EXPORT_EXECUTION_FIELDS]
+            + [export_value((answers.get(step["id"]) or {}).get("answer")) for step in columns]
+        )
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def stream_executions_ndjson(flow_id: str, start: Optional[datetime], end: Optional[datetime]):
+    questions = {step["id"]: step["question_text"] for step in export_step_columns(flow_id)}
+    lines = []
+    for execution in export_executions(flow_id, start, end):
+        row = export_row(execution)
+        row["answers"] = [
+            {
+                "step_id": step_id,
+                "question": questions.get(step_id),
+                "answer": answer.get("answer"),
+                "answered_at": answer.get("answered_at")
+            }
+            for step_id, answer in (execution.get("answers") or {}).items()
+        ]
+        lines.append(json.dumps(row, default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value)))
+        if len(lines) == EXPORT_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+# Flow step analytics
+# Per-step funnel counters are kept in flow_step_stats, one document per
+# (flow, step, UTC day): how often the step was reached and answered, the
+# distribution of chosen options and a histogram of seconds from reaching
+# the step to answering it. Answer handlers record events in memory and a
+# background loop folds them into the documents with $inc every
+# FLOW_STATS_FLUSH_SECONDS, so reading a flow's funnel only touches its
+# steps' daily documents, never the executions.
+FLOW_STATS_FLUSH_SECONDS = float(os.getenv("FLOW_STATS_FLUSH_SECONDS", "5"))
+FLOW_STATS_RETENTION_DAYS = 400
+FLOW_STATS_MAX_OPTION_KEY = 100
+# Upper edges of the time-to-answer buckets in seconds; one more bucket
+# holds everything slower
+FLOW_STATS_SECONDS_BUCKETS = [1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600]
+
+def stats_option_key(value) -> str:
+    # Option values become field names, which cannot contain dots or start
+    # with $
+    text = value if isinstance(value, str) else json.dumps(value, sort_keys=True, default=str)
+    text = text[:FLOW_STATS_MAX_OPTION_KEY].replace(".", "．")
+    if text.startswith("$"):
+        text = "＄" + text[1:]
+    return text or "(empty)"
+
+class FlowStepStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[tuple, Dict[str, int]] = {}
+
+    def _add(self, flow_id: str, step_id: str, field: str):
+        now = datetime.utcnow()
+        key = (flow_id, step_id, datetime(now.year, now.month, now.day))
+        with self._lock:
+            counters = self._counters.setdefault(key, {})
+            counters[field] = counters.get(field, 0) + 1
+
+    def record(self, events: List[tuple], seconds_to_first_answer: Optional[float] = None):
+        # events come from apply_step_answer: ("reached", flow_id, step_id)
+        # and ("answered", flow_id, step_id, option value or None)
+        timed = seconds_to_first_answer is not None
+        for event in events:
+            self._add(event[1], event[2], event[0])
+            if event[0] != "answered":
+                continue
+            if event[3] is not None:
+                self._add(event[1], event[2], f"options.{stats_option_key(event[3])}")
+            if timed:
+                bucket = bisect.bisect_left(FLOW_STATS_SECONDS_BUCKETS, seconds_to_first_answer)
+                self._add(event[1], event[2], f"answer_seconds.{bucket}")
+                timed = False
+
+    def drain(self) -> Dict[tuple, Dict[str, int]]:
+        with self._lock:
+            counters, self._counters = self._counters, {}
+        return counters
+
+flow_step_stats = FlowStepStats()
+
+def flush_flow_step_stats():
+    counters = flow_step_stats.drain()
+    if not counters:
+        return
+    db.flow_step_stats.bulk_write([
+        UpdateOne({"flow_id": flow_id, "step_id": step_id, "day": day}, {"$inc": increments}, upsert=True)
+        for (flow_id, step_id, day), increments in counters.items()
+    ], ordered=False)
+
+def median_seconds(histogram: Dict[str, int]) -> Optional[float]:
+    # Interpolated within the bucket holding the middle answer
+    total = sum(histogram.values())
+    if not total:
+        return None
+    seen = 0
+    for bucket in range(len(FLOW_STATS_SECONDS_BUCKETS) + 1):
+        count = histogram.get(str(bucket), 0)
+        if count and seen + count >= total / 2:
+            low = FLOW_STATS_SECONDS_BUCKETS[bucket - 1] if bucket > 0 else 0
+            if bucket == len(FLOW_STATS_SECONDS_BUCKETS):
+                return float(low)
+            high = FLOW_STATS_SECONDS_BUCKETS[bucket]
+            return round(low + (high - low) * (total / 2 - seen) / count, 1)
+        seen += count
+    return None
+
+def flow_step_stats_loop():
+    while True:
+        time.sleep(FLOW_STATS_FLUSH_SECONDS)
+        try:
+            flush_flow_step_stats()
+        except Exception:
+            logger.exception("Flow step stats flush failed")
+
+@app.on_event("startup")
+def start_flow_step_stats():
+    db.flow_step_stats.create_index([("flow_id", 1), ("step_id", 1), ("day", 1)], unique=True)
+    db.flow_step_stats.create_index([("flow_id", 1), ("day", 1)])
+    db.flow_step_stats.create_index("day", expireAfterSeconds=FLOW_STATS_RETENTION_DAYS * 86400)
+    threading.Thread(target=flow_step_stats_loop, name="flow-step-stats", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_flow_step_stats():
+    flush_flow_step_stats()
+
+# Flow summaries
+# A summary is rendered only in the format asked for. Once an execution is
+# completed its answers cannot change, but the flow title and, for a flow
+# that was never published, its draft questions can. Renderings of completed
+# executions are therefore cached and tagged per flow version, which every
+# edit of the flow or its steps bumps, and a matching If-None-Match is
+# answered with a 304 after reading only that version. Subflows pinned to a
+# draft are only as stable as their pins (see Subflows).
+FLOW_SUMMARY_CACHE_SIZE = int(os.getenv("FLOW_SUMMARY_CACHE_SIZE", "2048"))
+FLOW_SUMMARY_MEDIA_TYPES = {
+    "json": "application/json",
+    "markdown": "text/markdown; charset=utf-8",
+    "text": "text/plain; charset=utf-8",
+    "csv": "text/csv; charset=utf-8",
+    "html": "text/html; charset=utf-8"
+}
+
+class FlowSummaryCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, Any]" = OrderedDict()
+
+    def get(self, key: tuple):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+flow_summaries = FlowSummaryCache(FLOW_SUMMARY_CACHE_SIZE)
+
+def flow_summary_etag(session_id: str, flow_version: int, format: str) -> str:
+    return f'"{session_id}.{flow_version}.{format}"'
+
+def summary_answer_text(answer) -> str:
+    if isinstance(answer, list):
+        return ", ".join(str(item) for item in answer)
+    if isinstance(answer, dict):
+        return json.dumps(answer, default=str)
+    return "" if answer is None else str(answer)
+
+def build_flow_summary_data(execution: dict, flow: dict) -> dict:
+    steps = expand_subflow_steps(get_execution_graphs(execution, flow), flow["id"])
+    answers = execution["answers"]
+    completed_steps = [
+        {
+            "step_order": step["step_order"],
+            "question": step["question_text"],
+            "answer": answers[step["id"]]["answer"],
+            "answered_at": answers[step["id"]]["answered_at"]
+        }
+        for step in steps if step["id"] in answers
+    ]
+    started_at = execution["started_at"]
+    completed_at = execution.get("completed_at") or datetime.utcnow()
+    return {
+        "flow_id": flow["id"],
+        "flow_title": flow["title"],
+        "execution_id": execution["id"],
+        "status": execution["status"],
+        "completed_steps": completed_steps,
+        "total_time_seconds": int((completed_at - started_at).total_seconds()),
+        "started_at": started_at.isoformat() if isinstance(started_at, datetime) else started_at,
+        "completed_at": completed_at.isoformat() if isinstance(completed_at, datetime) else completed_at
+    }
 
-# Utility functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+def render_summary_text(data: dict) -> str:
+    lines = [f"Flow '{data['flow_title']}' completed with {len(data['completed_steps'])} steps answered.", ""]
+    for step in data["completed_steps"]:
+        lines.append(f"Q{step['step_order']}. {step['question']}")
+        lines.append(f"Answer: {summary_answer_text(step['answer'])}")
+        lines.append("")
+    return "\n".join(lines)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+def render_summary_markdown(data: dict) -> str:
+    parts = [f"# Flow Summary: {data['flow_title']}\n\n"]
+    for step in data["completed_steps"]:
+        parts.append(f"**Q{step['step_order']}.** {step['question']}\n")
+        parts.append(f"**Answer:** {summary_answer_text(step['answer'])}\n\n")
+    return "".join(parts)
 
-def create_access_token(data: dict) -> str:
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=JWT_ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
-    return encoded_jwt
+def render_summary_csv(data: dict) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["step_order", "question", "answer", "answered_at"])
+    for step in data["completed_steps"]:
+        writer.writerow([step["step_order"], step["question"], export_value(step["answer"]), step["answered_at"]])
+    return buffer.getvalue()
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-    except jwt.PyJWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-    
-    user = db.users.find_one({"id": user_id})
-    if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
-    
-    return user
+def render_summary_html(data: dict) -> str:
+    parts = [
+        "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">",
+        f"<title>Flow Summary: {html.escape(data['flow_title'])}</title></head><body>",
+        f"<h1>Flow Summary: {html.escape(data['flow_title'])}</h1><dl>"
+    ]
+    for step in data["completed_steps"]:
+        parts.append(f"<dt>Q{step['step_order']}. {html.escape(step['question'])}</dt>")
+        parts.append(f"<dd>{html.escape(summary_answer_text(step['answer']))}</dd>")
+    parts.append(f"</dl><p>Total time: {data['total_time_seconds']} seconds</p></body></html>")
+    return "".join(parts)
 
-def check_permission(user: dict, required_permission: AppPermission):
-    user_role = UserRole(user["role"])
-    user_permissions = ROLE_PERMISSIONS.get(user_role, [])
-    if required_permission not in user_permissions:
-        raise HTTPException(status_code=403, detail="Insufficient permissions")
+SUMMARY_RENDERERS = {
+    "text": render_summary_text,
+    "markdown": render_summary_markdown,
+    "csv": render_summary_csv,
+    "html": render_summary_html
+}
+
+def render_flow_summary(data: dict, format: Optional[str]):
+    # Without a format the full FlowSummary with every rendering is built,
+    # as older clients expect; generated_at is added per response
+    if format == "json":
+        return data
+    if format:
+        return SUMMARY_RENDERERS[format](data)
+    return {
+        "execution_id": data["execution_id"],
+        "flow_title": data["flow_title"],
+        "completed_steps": data["completed_steps"],
+        "total_time_seconds": data["total_time_seconds"],
+        "summary_text": render_summary_text(data),
+        "summary_markdown": render_summary_markdown(data),
+        "summary_json": data
+    }
+
+def bump_flow_version(flow_id: str):
+    db.flows.update_one({"id": flow_id}, {"$inc": {"version": 1}, "$set": {"updated_at": datetime.utcnow()}})
+    flow_graphs.invalidate_drafts(flow_id)
+
+@app.on_event("startup")
+def create_flow_version_indexes():
+    db.flow_versions.create_index([("flow_id", 1), ("version", 1)], unique=True)
+    db.flow_executions.create_index([("flow_id", 1), ("session_id", 1)], unique=True)
 
 # API Routes
 
@@ -651,15 +4631,26 @@ async def delete_wiki(
         raise HTTPException(status_code=404, detail="Wiki not found")
     
     # Delete all associated categories, subcategories, and articles
+    deleted_articles = []
+    deleted_subcategory_ids = []
     categories = list(db.wiki_categories.find({"wiki_id": wiki_id}))
     for category in categories:
         subcategories = list(db.wiki_subcategories.find({"category_id": category["id"]}))
+        deleted_subcategory_ids.extend(subcategory["id"] for subcategory in subcategories)
         for subcategory in subcategories:
+            deleted_articles.extend(db.wiki_articles.find({"subcategory_id": subcategory["id"]}, TAG_COUNT_PROJECTION))
             db.wiki_articles.delete_many({"subcategory_id": subcategory["id"]})
         db.wiki_subcategories.delete_many({"category_id": category["id"]})
     
     db.wiki_categories.delete_many({"wiki_id": wiki_id})
     db.wikis.delete_one({"id": wiki_id})
+    record_search_changes([article["id"] for article in deleted_articles], "delete")
+    db.article_minhash.delete_many({"article_id": {"$in": [article["id"] for article in deleted_articles]}})
+    db.article_related.delete_many({"wiki_id": wiki_id})
+    db.related_articles_state.delete_one({"wiki_id": wiki_id})
+    db.tag_counts.delete_many({"kind": "article", "wiki_id": wiki_id})
+    record_search_changes(deleted_subcategory_ids, "delete", "subcategory")
+    record_search_changes([category["id"] for category in categories], "delete", "category")
     
     return {"message": "Wiki deleted successfully"}
 
@@ -697,6 +4688,7 @@ async def create_category(
     }
     
     db.wiki_categories.insert_one(category_doc)
+    record_search_changes([category_id], "upsert", "category")
     
     # Add counts
     category_doc["subcategories_count"] = 0
@@ -772,6 +4764,7 @@ async def update_category(
     if update_data:
         update_data["updated_at"] = datetime.utcnow()
         db.wiki_categories.update_one({"id": category_id}, {"$set": update_data})
+        record_search_changes([category_id], "upsert", "category")
     
     updated_category = db.wiki_categories.find_one({"id": category_id}, {"_id": 0})
     updated_category["subcategories_count"] = db.wiki_subcategories.count_documents({"category_id": category_id})
@@ -791,12 +4784,20 @@ async def delete_category(
         raise HTTPException(status_code=404, detail="Category not found")
     
     # Delete associated subcategories and articles
+    deleted_articles = []
     subcategories = list(db.wiki_subcategories.find({"category_id": category_id}))
     for subcategory in subcategories:
+        deleted_articles.extend(db.wiki_articles.find({"subcategory_id": subcategory["id"]}, TAG_COUNT_PROJECTION))
         db.wiki_articles.delete_many({"subcategory_id": subcategory["id"]})
     
     db.wiki_subcategories.delete_many({"category_id": category_id})
     db.wiki_categories.delete_one({"id": category_id})
+    record_search_changes([article["id"] for article in deleted_articles], "delete")
+    db.article_minhash.delete_many({"article_id": {"$in": [article["id"] for article in deleted_articles]}})
+    drop_related_articles(deleted_articles)
+    remove_article_tag_counts(deleted_articles)
+    record_search_changes([subcategory["id"] for subcategory in subcategories], "delete", "subcategory")
+    record_search_changes([category_id], "delete", "category")
     
     return {"message": "Category deleted successfully"}
 
@@ -843,6 +4844,7 @@ async def create_subcategory(
     }
     
     db.wiki_subcategories.insert_one(subcategory_doc)
+    record_search_changes([subcategory_id], "upsert", "subcategory")
     
     # Add counts and nested subcategories
     subcategory_doc["nested_subcategories"] = []
@@ -945,6 +4947,7 @@ async def update_subcategory(
     if update_data:
         update_data["updated_at"] = datetime.utcnow()
         db.wiki_subcategories.update_one({"id": subcategory_id}, {"$set": update_data})
+        record_search_changes([subcategory_id], "upsert", "subcategory")
     
     updated_subcategory = db.wiki_subcategories.find_one({"id": subcategory_id}, {"_id": 0})
     updated_subcategory["nested_subcategories"] = []
@@ -964,18 +4967,27 @@ async def delete_subcategory(
         raise HTTPException(status_code=404, detail="Subcategory not found")
     
     # Delete all articles in this subcategory
+    deleted_articles = list(db.wiki_articles.find({"subcategory_id": subcategory_id}, TAG_COUNT_PROJECTION))
     db.wiki_articles.delete_many({"subcategory_id": subcategory_id})
     
     # Delete all nested subcategories and their articles (recursive deletion)
+    deleted_subcategory_ids = [subcategory_id]
     def delete_nested_subcategories(parent_id):
         nested = list(db.wiki_subcategories.find({"parent_subcategory_id": parent_id}))
         for nested_subcat in nested:
             delete_nested_subcategories(nested_subcat["id"])
+            deleted_articles.extend(db.wiki_articles.find({"subcategory_id": nested_subcat["id"]}, TAG_COUNT_PROJECTION))
             db.wiki_articles.delete_many({"subcategory_id": nested_subcat["id"]})
             db.wiki_subcategories.delete_one({"id": nested_subcat["id"]})
+            deleted_subcategory_ids.append(nested_subcat["id"])
     
     delete_nested_subcategories(subcategory_id)
     db.wiki_subcategories.delete_one({"id": subcategory_id})
+    record_search_changes([article["id"] for article in deleted_articles], "delete")
+    db.article_minhash.delete_many({"article_id": {"$in": [article["id"] for article in deleted_articles]}})
+    drop_related_articles(deleted_articles)
+    remove_article_tag_counts(deleted_articles)
+    record_search_changes(deleted_subcategory_ids, "delete", "subcategory")
     
     return {"message": "Subcategory and all nested content deleted successfully"}
 
@@ -1037,8 +5049,31 @@ async def create_article(
         "created_by": current_user["id"]
     }
     db.wiki_article_versions.insert_one(version_doc)
-    
-    return ArticleResponse(**article_doc)
+    record_search_changes([article_id], "upsert")
+    adjust_tag_counts("article", article_doc["wiki_id"], article_doc["visibility"], article_doc["tags"], 1)
+    
+    # Flag copies of existing articles while the author is still looking
+    possible_duplicates = []
+    signature = store_article_minhash(article_doc)
+    if signature is not None:
+        matches = find_near_duplicates(signature, exclude_id=article_id)[:5]
+        titles = {
+            doc["id"]: doc for doc in db.wiki_articles.find(
+                {"id": {"$in": [match_id for match_id, _ in matches]}},
+                {"_id": 0, "id": 1, "title": 1, "wiki_id": 1, "visibility": 1, "created_by": 1}
+            )
+        }
+        user_role = UserRole(current_user["role"])
+        for match_id, similarity in matches:
+            match = titles.get(match_id)
+            if not match:
+                continue
+            if (match["visibility"] == ArticleVisibility.PRIVATE.value and match["created_by"] != current_user["id"]
+                    and user_role not in [UserRole.ADMIN, UserRole.MANAGER]):
+                continue
+            possible_duplicates.append(DuplicateCandidate(id=match_id, title=match["title"], wiki_id=match["wiki_id"], similarity=similarity))
+    
+    return ArticleResponse(**article_doc, possible_duplicates=possible_duplicates)
 
 @app.get("/api/wiki/articles", response_model=List[ArticleResponse])
 async def get_articles(
@@ -1121,15 +5156,6 @@ async def get_articles(
     elif visibility:
         query["visibility"] = visibility
     
-    # Search functionality
-    if search_query and len(search_query.strip()) >= 2:
-        search_regex = {"$regex": search_query.strip(), "$options": "i"}
-        query["$or"] = [
-            {"title": search_regex},
-            {"content": search_regex},
-            {"tags": search_regex}
-        ]
-    
     # Tag filtering
     if tags:
         tag_list = [tag.strip() for tag in tags.split(",") if tag.strip()]
@@ -1149,7 +5175,21 @@ async def get_articles(
             wiki_ids = [wiki["id"] for wiki in accessible_wikis]
             query["wiki_id"] = {"$in": wiki_ids}
     
-    articles = list(db.wiki_articles.find(query, {"_id": 0}).sort("updated_at", -1))
+    # Search functionality: matches come from the search index and only
+    # narrow the Mongo query by id. The other filters are applied to the hits
+    # first, so the match cap never drops in-scope articles.
+    started = time.perf_counter()
+    if search_query and len(search_query.strip()) >= 2:
+        hits = run_search_query(
+            parse_search_query(search_query.strip()),
+            SEARCH_QUERY_MAX_MATCHES,
+            lambda record: record["type"] == "article" and search_record_matches(record, query, ARTICLE_SEARCH_FILTER_FIELDS)
+        )
+        query["id"] = {"$in": [record["id"] for _, record, _ in hits]}
+    
+    articles = find_with_time_limit(db.wiki_articles.find(query, {"_id": 0}).sort("updated_at", -1))
+    if search_query and len(search_query.strip()) >= 2:
+        search_query_log.record("article_filter", search_query, len(articles), (time.perf_counter() - started) * 1000)
     return [ArticleResponse(**article) for article in articles]
 
 @app.get("/api/wiki/articles/{article_id}", response_model=ArticleResponse)
@@ -1171,8 +5211,55 @@ async def get_article(
         if article["created_by"] != current_user["id"] and user_role not in [UserRole.ADMIN, UserRole.MANAGER]:
             raise HTTPException(status_code=403, detail="Access denied to private article")
     
+    # Track views for typeahead ranking
+    article_views.record(article_id)
+    
     return ArticleResponse(**article)
 
+@app.get("/api/wiki/articles/{article_id}/related", response_model=List[RelatedArticle])
+async def get_related_articles(
+    article_id: str,
+    limit: int = 5,
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.WIKI_READ)
+    
+    # Precomputed by the related articles job; articles it has not seen yet
+    # simply have no neighbours
+    doc = db.article_related.find_one({"article_id": article_id}, {"_id": 0})
+    if not doc:
+        return []
+    
+    # Visibility may have changed, and articles may have gone, since the job
+    # ran, so the article and its neighbours are checked as they are now
+    entry_ids = [entry["id"] for entry in doc.get("related", [])]
+    current = {
+        article["id"]: article
+        for article in db.wiki_articles.find(
+            {"id": {"$in": [article_id] + entry_ids}},
+            {"_id": 0, "id": 1, "title": 1, "visibility": 1, "created_by": 1}
+        )
+    }
+    if article_id not in current:
+        raise HTTPException(status_code=404, detail="Article not found")
+    
+    user_role = UserRole(current_user["role"])
+    can_see_private = user_role in [UserRole.ADMIN, UserRole.MANAGER]
+    
+    def visible(article: dict) -> bool:
+        return (article["visibility"] != ArticleVisibility.PRIVATE.value
+                or article["created_by"] == current_user["id"] or can_see_private)
+    
+    if not visible(current[article_id]):
+        raise HTTPException(status_code=403, detail="Access denied to private article")
+    
+    related = [
+        RelatedArticle(id=entry["id"], title=current[entry["id"]]["title"], score=entry["score"])
+        for entry in doc.get("related", [])
+        if entry["id"] in current and visible(current[entry["id"]])
+    ]
+    return related[:max(1, min(limit, RELATED_ARTICLES_TOP_K))]
+
 @app.put("/api/wiki/articles/{article_id}", response_model=ArticleResponse)
 async def update_article(
     article_id: str,
@@ -1225,6 +5312,19 @@ async def update_article(
         "change_notes": change_notes or f"Updated by {current_user['full_name']}"
     }
     db.wiki_article_versions.insert_one(version_doc)
+    record_search_changes([article_id], "upsert")
+    if article_data.content is not None:
+        store_article_minhash({"id": article_id, "wiki_id": article["wiki_id"], "content": article_data.content})
+    if article_data.tags is not None or article_data.visibility is not None:
+        new_visibility = getattr(update_data.get("visibility"), "value", update_data.get("visibility", article["visibility"]))
+        deltas: Dict[tuple, int] = {}
+        for tag in set(article.get("tags") or []) - {""}:
+            key = ("article", article["wiki_id"], article["visibility"], tag)
+            deltas[key] = deltas.get(key, 0) - 1
+        for tag in set(update_data.get("tags", article.get("tags")) or []) - {""}:
+            key = ("article", article["wiki_id"], new_visibility, tag)
+            deltas[key] = deltas.get(key, 0) + 1
+        apply_tag_count_deltas(deltas)
     
     # Get updated article
     updated_article = db.wiki_articles.find_one({"id": article_id}, {"_id": 0})
@@ -1249,6 +5349,10 @@ async def delete_article(
     # Delete article and its versions
     db.wiki_articles.delete_one({"id": article_id})
     db.wiki_article_versions.delete_many({"article_id": article_id})
+    record_search_changes([article_id], "delete")
+    db.article_minhash.delete_one({"article_id": article_id})
+    drop_related_articles([article])
+    adjust_tag_counts("article", article["wiki_id"], article["visibility"], article.get("tags", []), -1)
     
     return {"message": "Article deleted successfully"}
 
@@ -1281,44 +5385,206 @@ async def search_wiki(
     
     if len(q.strip()) < 2:
         return {"articles": [], "categories": [], "subcategories": []}
+    started = time.perf_counter()
     
-    search_regex = {"$regex": q, "$options": "i"}
-    
-    # Search articles
-    article_query = {
-        "$or": [
-            {"title": search_regex},
-            {"content": search_regex},
-            {"tags": search_regex}
-        ]
-    }
-    
-    # Apply visibility filters
+    # Results only depend on the query, the role and the content of the
+    # accessible wikis, so identical searches are served from the cache
     user_role = UserRole(current_user["role"])
-    if user_role == UserRole.VIEWER:
-        article_query["visibility"] = {"$in": [ArticleVisibility.PUBLIC, ArticleVisibility.INTERNAL]}
-    elif user_role not in [UserRole.ADMIN, UserRole.MANAGER]:
-        article_query["visibility"] = {"$ne": ArticleVisibility.PRIVATE}
+    wiki_ids = get_accessible_wiki_ids(user_role)
+    cache_key = (" ".join(q.lower().split()), user_role.value, wiki_ids)
+    generation = content_generations.current(wiki_ids)
+    cached = search_cache.get(cache_key, generation)
+    if cached is not None:
+        search_query_log.record("wiki_search", q, sum(len(cached[group]) for group in ("articles", "categories", "subcategories")),
+                                (time.perf_counter() - started) * 1000)
+        return cached
+    
+    # Apply visibility and wiki access filters
+    allowed_visibility = get_searchable_visibility(user_role)
+    
+    # Search articles through the index; the last term matches as a prefix
+    # so results keep up with the user typing
+    node = parse_search_query(q, prefix_last=True)
+    accept = lambda record: (record["type"] == "article" and record["visibility"] in allowed_visibility and
+                             (wiki_ids is None or record["wiki_id"] in wiki_ids))
+    hits = run_search_query(node, 10, accept)
+    
+    # Fall back to typo-corrected terms when exact matches are sparse
+    corrected_query = None
+    terms = simple_query_terms(node)
+    if terms and len(hits) < FUZZY_MIN_RESULTS:
+        corrected = fuzzy_index.correct(terms)
+        if corrected != terms:
+            corrected_query = " ".join(corrected)
+            seen_ids = {record["id"] for _, record, _ in hits}
+            for hit in run_search_query(parse_search_query(" ".join(corrected)), 10, accept):
+                if hit[1]["id"] not in seen_ids and len(hits) < 10:
+                    hits.append(hit)
+    
+    # Snippets are cut from the excerpt stored with each record, around the
+    # matched positions, so no article is read
+    articles = [
+        ArticleSearchHit(
+            **{field: record.get(field) for field in ["id", "title", "subcategory_id", "wiki_id", "visibility", "tags", "updated_at"]},
+            score=round(score, 4),
+            snippet=build_snippet(record.get("content", ""), positions, record.get("content_start", 0))
+        )
+        for score, record, positions in hits
+    ]
     
-    articles = list(db.wiki_articles.find(article_query, {"_id": 0}).limit(10))
+    # Search categories and subcategories through the same index
+    def category_ids(doc_type: str) -> List[str]:
+        accept_type = lambda record: record["type"] == doc_type and (wiki_ids is None or record["wiki_id"] in wiki_ids)
+        return [record["id"] for _, record, _ in run_search_query(node, 5, accept_type)]
     
-    # Search categories
-    categories = list(db.wiki_categories.find(
-        {"$or": [{"name": search_regex}, {"description": search_regex}]},
-        {"_id": 0}
-    ).limit(5))
+    def ranked(collection, ids: List[str]) -> List[dict]:
+        if not ids:
+            return []
+        docs = {doc["id"]: doc for doc in find_with_time_limit(collection.find({"id": {"$in": ids}}, {"_id": 0}))}
+        return [docs[doc_id] for doc_id in ids if doc_id in docs]
     
-    # Search subcategories
-    subcategories = list(db.wiki_subcategories.find(
-        {"$or": [{"name": search_regex}, {"description": search_regex}]},
-        {"_id": 0}
-    ).limit(5))
+    categories = ranked(db.wiki_categories, category_ids("category"))
+    subcategories = ranked(db.wiki_subcategories, category_ids("subcategory"))
     
-    return {
-        "articles": [ArticleResponse(**article) for article in articles],
+    response = {
+        "articles": articles,
         "categories": [CategoryResponse(**cat) for cat in categories],
-        "subcategories": [SubcategoryResponse(**subcat) for subcat in subcategories]
+        "subcategories": [SubcategoryResponse(**subcat) for subcat in subcategories],
+        "corrected_query": corrected_query
     }
+    search_cache.put(cache_key, generation, response)
+    search_query_log.record("wiki_search", q, len(articles) + len(categories) + len(subcategories),
+                            (time.perf_counter() - started) * 1000)
+    return response
+
+@app.get("/api/wiki/suggest", response_model=List[Suggestion])
+async def suggest_wiki(
+    prefix: str,
+    limit: int = 8,
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.WIKI_READ)
+    
+    user_role = UserRole(current_user["role"])
+    wiki_ids = get_accessible_wiki_ids(user_role)
+    allowed_visibility = get_searchable_visibility(user_role)
+    
+    def accept(entry: dict) -> bool:
+        if wiki_ids is not None and entry["wiki_id"] not in wiki_ids:
+            return False
+        if entry["type"] == "article":
+            return entry["visibility"] in allowed_visibility
+        if entry["type"] == "tag":
+            return any(visibility in allowed_visibility for visibility in entry["counts"])
+        return True
+    
+    entries = suggest_index.suggest(prefix, max(1, min(limit, 20)), accept)
+    return [
+        Suggestion(type=entry["type"], id=entry["id"], text=entry["text"], wiki_id=entry["wiki_id"])
+        for entry in entries
+    ]
+
+@app.get("/api/search", response_model=List[SearchHit])
+async def unified_search(
+    q: str,
+    types: Optional[str] = None,
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user)
+):
+    user_role = UserRole(current_user["role"])
+    permissions = ROLE_PERMISSIONS.get(user_role, [])
+    allowed_types = set()
+    if AppPermission.WIKI_READ in permissions:
+        allowed_types.update(["article", "category", "subcategory"])
+    if AppPermission.FLOW_READ in permissions:
+        allowed_types.update(["flow", "step"])
+    if not allowed_types:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    if types:
+        allowed_types &= {doc_type.strip() for doc_type in types.split(",")}
+    
+    started = time.perf_counter()
+    node = parse_search_query(q, prefix_last=True)
+    if node is None or not allowed_types:
+        return []
+    
+    # Each type keeps its own rules: articles by visibility and wiki access,
+    # categories by wiki access, flows by visibility, steps through their flow
+    wiki_ids = get_accessible_wiki_ids(user_role)
+    allowed_visibility = get_searchable_visibility(user_role)
+    flow_access: Dict[str, bool] = {}
+    
+    def flow_visible(flow_id: str) -> bool:
+        if flow_id not in flow_access:
+            flow = search_index.record(search_doc_key("flow", flow_id))
+            flow_access[flow_id] = flow is not None and flow["visibility"] in allowed_visibility
+        return flow_access[flow_id]
+    
+    def accept(record: dict) -> bool:
+        doc_type = record["type"]
+        if doc_type not in allowed_types:
+            return False
+        if doc_type == "article":
+            return record["visibility"] in allowed_visibility and (wiki_ids is None or record["wiki_id"] in wiki_ids)
+        if doc_type in ("category", "subcategory"):
+            return wiki_ids is None or record["wiki_id"] in wiki_ids
+        if doc_type == "flow":
+            return flow_visible(record["id"])
+        return flow_visible(record["flow_id"])
+    
+    hits = run_search_query(node, max(1, min(limit, 50)), accept)
+    
+    results = []
+    for score, record, positions in hits:
+        results.append(SearchHit(
+            type=record["type"],
+            id=record["id"],
+            title=record["title"],
+            score=round(score, 4),
+            snippet=build_snippet(record.get("content", ""), positions, record.get("content_start", 0)),
+            wiki_id=record.get("wiki_id"),
+            flow_id=record.get("flow_id"),
+            visibility=record.get("visibility"),
+            tags=record.get("tags", [])
+        ))
+    search_query_log.record("unified_search", q, len(results), (time.perf_counter() - started) * 1000)
+    return results
+
+# Tag routes
+@app.get("/api/tags", response_model=List[TagCount])
+async def get_tags(
+    wiki_id: Optional[str] = None,
+    kind: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.WIKI_READ)
+    
+    if kind and kind not in ["article", "flow"]:
+        raise HTTPException(status_code=400, detail="Invalid tag kind")
+    
+    user_role = UserRole(current_user["role"])
+    wiki_ids = get_accessible_wiki_ids(user_role)
+    query = {"visibility": {"$in": list(get_searchable_visibility(user_role))}}
+    if kind:
+        query["kind"] = kind
+    if wiki_id:
+        if wiki_ids is not None and wiki_id not in wiki_ids:
+            raise HTTPException(status_code=403, detail="Access denied to this wiki")
+        query["kind"] = "article"
+        query["wiki_id"] = wiki_id
+    elif wiki_ids is not None:
+        query["$or"] = [{"kind": "flow"}, {"wiki_id": {"$in": list(wiki_ids)}}]
+    
+    tags: Dict[str, dict] = {}
+    for row in db.tag_counts.find(query, {"_id": 0}):
+        tag = tags.setdefault(row["tag"], {"tag": row["tag"], "article_count": 0, "flow_count": 0, "by_wiki": {}, "by_visibility": {}})
+        tag[f"{row['kind']}_count"] += row["count"]
+        if row["wiki_id"]:
+            tag["by_wiki"][row["wiki_id"]] = tag["by_wiki"].get(row["wiki_id"], 0) + row["count"]
+        tag["by_visibility"][row["visibility"]] = tag["by_visibility"].get(row["visibility"], 0) + row["count"]
+    
+    ranked = sorted(tags.values(), key=lambda tag: (-(tag["article_count"] + tag["flow_count"]), tag["tag"]))
+    return [TagCount(**tag) for tag in ranked]
 
 # Flow management routes
 @app.post("/api/flows", response_model=FlowResponse)
@@ -1344,6 +5610,8 @@ async def create_flow(
     }
     
     db.flows.insert_one(flow_doc)
+    record_search_changes([flow_id], "upsert", "flow")
+    adjust_tag_counts("flow", None, flow_doc["visibility"], flow_doc["tags"], 1)
     return FlowResponse(**flow_doc)
 
 @app.get("/api/flows", response_model=List[FlowResponse])
@@ -1363,20 +5631,21 @@ async def get_flows(
     elif user_role not in [UserRole.ADMIN, UserRole.MANAGER]:
         query["visibility"] = {"$ne": ArticleVisibility.PRIVATE}
     
-    # Search functionality
-    if search:
-        query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"tags": {"$regex": search, "$options": "i"}}
-        ]
-    
     # Filter by tags
     if tags:
         tag_list = [tag.strip() for tag in tags.split(",")]
         query["tags"] = {"$in": tag_list}
     
-    flows = list(db.flows.find(query, {"_id": 0}).sort("created_at", -1))
+    # Search functionality, scoped by the filters above before the match cap
+    if search:
+        hits = run_search_query(
+            parse_search_query(search),
+            SEARCH_QUERY_MAX_MATCHES,
+            lambda record: record["type"] == "flow" and search_record_matches(record, query, FLOW_SEARCH_FILTER_FIELDS)
+        )
+        query["id"] = {"$in": [record["id"] for _, record, _ in hits]}
+    
+    flows = find_with_time_limit(db.flows.find(query, {"_id": 0}).sort("created_at", -1))
     return [FlowResponse(**flow) for flow in flows]
 
 @app.get("/api/flows/{flow_id}", response_model=FlowResponse)
@@ -1428,6 +5697,10 @@ async def update_flow(
     }
     
     db.flows.update_one({"id": flow_id}, {"$set": update_data})
+    record_search_changes([flow_id], "upsert", "flow")
+    if flow.get("is_active", True):
+        adjust_tag_counts("flow", None, flow["visibility"], flow.get("tags", []), -1)
+        adjust_tag_counts("flow", None, update_data["visibility"], update_data["tags"], 1)
     
     updated_flow = db.flows.find_one({"id": flow_id}, {"_id": 0})
     return FlowResponse(**updated_flow)
@@ -1450,6 +5723,9 @@ async def delete_flow(
     
     # Soft delete - set is_active to False
     db.flows.update_one({"id": flow_id}, {"$set": {"is_active": False, "updated_at": datetime.utcnow()}})
+    record_search_changes([flow_id], "delete", "flow")
+    if flow.get("is_active", True):
+        adjust_tag_counts("flow", None, flow["visibility"], flow.get("tags", []), -1)
     
     return {"message": "Flow deleted successfully"}
 
@@ -1488,13 +5764,19 @@ async def create_flow_step(
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
+    validate_flow_step(step_doc)
+    if step_doc["step_type"] == FlowStepType.SUBFLOW:
+        check_subflow_target(flow_id, step_doc["subflow_id"])
     
     db.flow_steps.insert_one(step_doc)
+    bump_flow_version(flow_id)
+    record_search_changes([step_id], "upsert", "step")
     return FlowStepResponse(**step_doc)
 
 @app.get("/api/flows/{flow_id}/steps", response_model=List[FlowStepResponse])
 async def get_flow_steps(
     flow_id: str,
+    version: Optional[int] = None,
     current_user: dict = Depends(get_current_user)
 ):
     check_permission(current_user, AppPermission.FLOW_READ)
@@ -1504,6 +5786,13 @@ async def get_flow_steps(
     if not flow:
         raise HTTPException(status_code=404, detail="Flow not found")
     
+    # A published version returns the steps as they were when it was published
+    if version is not None:
+        published = db.flow_versions.find_one({"flow_id": flow_id, "version": version}, {"_id": 0, "steps": 1})
+        if not published:
+            raise HTTPException(status_code=404, detail="Flow version not found")
+        return [FlowStepResponse(**step) for step in published["steps"]]
+    
     steps = list(db.flow_steps.find({"flow_id": flow_id}, {"_id": 0}).sort("step_order", 1))
     return [FlowStepResponse(**step) for step in steps]
 
@@ -1538,10 +5827,15 @@ async def update_flow_step(
         "is_required": step_data.is_required,
         "updated_at": datetime.utcnow()
     }
+    validate_flow_step(update_data)
+    if update_data["step_type"] == FlowStepType.SUBFLOW:
+        check_subflow_target(flow_id, update_data["subflow_id"])
     
     result = db.flow_steps.update_one({"id": step_id, "flow_id": flow_id}, {"$set": update_data})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Flow step not found")
+    bump_flow_version(flow_id)
+    record_search_changes([step_id], "upsert", "step")
     
     updated_step = db.flow_steps.find_one({"id": step_id}, {"_id": 0})
     return FlowStepResponse(**updated_step)
@@ -1566,9 +5860,66 @@ async def delete_flow_step(
     result = db.flow_steps.delete_one({"id": step_id, "flow_id": flow_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Flow step not found")
+    bump_flow_version(flow_id)
+    record_search_changes([step_id], "delete", "step")
     
     return {"message": "Flow step deleted successfully"}
 
+@app.post("/api/flows/{flow_id}/publish", response_model=FlowVersionResponse)
+async def publish_flow(
+    flow_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.FLOW_WRITE)
+    
+    flow = db.flows.find_one({"id": flow_id})
+    if not flow:
+        raise HTTPException(status_code=404, detail="Flow not found")
+    
+    user_role = UserRole(current_user["role"])
+    if flow["created_by"] != current_user["id"] and user_role not in [UserRole.ADMIN, UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="You can only publish your own flows")
+    
+    steps = list(db.flow_steps.find({"flow_id": flow_id}, {"_id": 0}).sort("step_order", 1))
+    if not steps:
+        raise HTTPException(status_code=400, detail="Cannot publish a flow without steps")
+    validate_flow_definition(steps)
+    for subflow_id in {step.get("subflow_id") for step in steps if step["step_type"] == FlowStepType.SUBFLOW}:
+        check_subflow_target(flow_id, subflow_id)
+    
+    # Allocate the number first and only point the flow at it once the
+    # snapshot exists, so new executions never see a missing version
+    counter = db.flows.find_one_and_update(
+        {"id": flow_id},
+        {"$inc": {"publish_seq": 1}},
+        projection={"_id": 0, "publish_seq": 1, "version": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    version_doc = {
+        "flow_id": flow_id,
+        "version": counter["publish_seq"],
+        "title": flow["title"],
+        "draft_version": counter.get("version", 1),
+        "steps": steps,
+        "step_count": len(steps),
+        "published_at": datetime.utcnow(),
+        "published_by": current_user["id"]
+    }
+    db.flow_versions.insert_one(version_doc)
+    db.flows.update_one({"id": flow_id}, {"$max": {"published_version": version_doc["version"]}})
+    
+    return FlowVersionResponse(**version_doc)
+
+@app.get("/api/flows/{flow_id}/versions", response_model=List[FlowVersionResponse])
+async def get_flow_versions(
+    flow_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.FLOW_READ)
+    
+    versions = list(db.flow_versions.find({"flow_id": flow_id}, {"_id": 0, "steps": 0}).sort("version", -1))
+    return [FlowVersionResponse(**version) for version in versions]
+
 # Flow execution routes
 @app.post("/api/flows/{flow_id}/execute", response_model=FlowExecutionResponse)
 async def start_flow_execution(
@@ -1583,8 +5934,21 @@ async def start_flow_execution(
     if not flow:
         raise HTTPException(status_code=404, detail="Flow not found")
     
-    # Get first step
-    first_step = db.flow_steps.find_one({"flow_id": flow_id}, {"_id": 0}, sort=[("step_order", 1)])
+    # Executions are pinned to the latest published version; flows that were
+    # never published run from their working copy
+    flow_version = flow.get("published_version")
+    graph = get_published_flow_graph(flow_id, flow_version) if flow_version else get_flow_graph(flow)
+    
+    # Pin and prefetch every subflow now so entering one later is free
+    try:
+        subflow_versions = resolve_subflows(graph)
+    except FlowDefinitionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    graphs = {flow_id: graph}
+    graphs.update({child_id: get_pinned_flow_graph(child_id, pin) for child_id, pin in subflow_versions.items()})
+    session_data = execution_data.session_data or {}
+    cursor = ExecutionCursor(graphs, flow_id, [])
+    first_step_id = cursor.settle(graph.first_step_id, {}, session_data)
     
     execution_id = str(uuid.uuid4())
     session_id = str(uuid.uuid4())
@@ -1592,12 +5956,17 @@ async def start_flow_execution(
     execution_doc = {
         "id": execution_id,
         "flow_id": flow_id,
+        "flow_version": flow_version,
         "user_id": current_user["id"] if current_user else None,
         "session_id": session_id,
         "status": FlowExecutionStatus.IN_PROGRESS,
-        "current_step_id": first_step["id"] if first_step else None,
+        "current_step_id": first_step_id,
+        "current_step_reached_at": datetime.utcnow(),
+        "current_flow_id": cursor.flow_id,
+        "call_stack": cursor.call_stack,
+        "subflow_versions": subflow_versions,
         "answers": {},
-        "session_data": execution_data.session_data or {},
+        "session_data": session_data,
         "url_path": f"/flows/{flow_id}/execute/{session_id}",
         "started_at": datetime.utcnow(),
         "completed_at": None,
@@ -1605,6 +5974,10 @@ async def start_flow_execution(
     }
     
     db.flow_executions.insert_one(execution_doc)
+    if FLOW_SESSION_CACHE_ENABLED:
+        execution_sessions.add(execution_doc)
+    if first_step_id:
+        flow_step_stats.record([("reached", cursor.flow_id, first_step_id)])
     return FlowExecutionResponse(**execution_doc)
 
 @app.get("/api/flows/{flow_id}/execute/{session_id}", response_model=FlowExecutionResponse)
@@ -1615,7 +5988,7 @@ async def get_flow_execution(
 ):
     check_permission(current_user, AppPermission.FLOW_EXECUTE)
     
-    execution = db.flow_executions.find_one({"flow_id": flow_id, "session_id": session_id}, {"_id": 0})
+    execution = load_execution(flow_id, session_id)
     if not execution:
         raise HTTPException(status_code=404, detail="Flow execution not found")
     
@@ -1626,74 +5999,32 @@ async def submit_step_answer(
     flow_id: str,
     session_id: str,
     answer_data: FlowStepAnswer,
+    include_next: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
     check_permission(current_user, AppPermission.FLOW_EXECUTE)
     
-    execution = db.flow_executions.find_one({"flow_id": flow_id, "session_id": session_id})
+    execution = load_execution(flow_id, session_id)
     if not execution:
         raise HTTPException(status_code=404, detail="Flow execution not found")
     
     if execution["status"] != FlowExecutionStatus.IN_PROGRESS:
         raise HTTPException(status_code=400, detail="Flow execution is not in progress")
     
-    # Get current step
-    current_step = db.flow_steps.find_one({"id": answer_data.step_id, "flow_id": flow_id})
-    if not current_step:
-        raise HTTPException(status_code=404, detail="Flow step not found")
-    
-    # Store the answer
+    # Steps and edges come from the compiled graphs of the versions the
+    # execution is pinned to; the answer must be for the flow it is in
+    cursor = ExecutionCursor.for_execution(execution, get_execution_graphs(execution))
     answers = execution["answers"]
-    answers[answer_data.step_id] = {
-        "answer": answer_data.answer,
-        "metadata": answer_data.metadata or {},
-        "answered_at": datetime.utcnow().isoformat()
-    }
-    
-    # Determine next step
-    next_step_id = None
-    if current_step["step_type"] == FlowStepType.MULTIPLE_CHOICE:
-        # Find next step based on selected option
-        for option in current_step["options"]:
-            if option.get("value") == answer_data.answer:
-                next_step_id = option.get("next_step")
-                break
-        
-        # If no specific next step, get next step by order
-        if not next_step_id:
-            next_step = db.flow_steps.find_one(
-                {"flow_id": flow_id, "step_order": {"$gt": current_step["step_order"]}},
-                sort=[("step_order", 1)]
-            )
-            next_step_id = next_step["id"] if next_step else None
-    
-    elif current_step["step_type"] == FlowStepType.CONDITIONAL_BRANCH:
-        # Evaluate conditional logic
-        conditional_logic = current_step.get("conditional_logic", {})
-        # For now, simple implementation - can be extended
-        conditions = conditional_logic.get("conditions", [])
-        for condition in conditions:
-            if condition.get("field") == "answer" and condition.get("operator") == "equals":
-                if answer_data.answer == condition.get("value"):
-                    next_step_id = condition.get("next_step")
-                    break
-        
-        # Default next step
-        if not next_step_id:
-            next_step_id = conditional_logic.get("default_next_step")
+    events: List[tuple] = []
+    next_step_id = apply_step_answer(cursor, answers, execution.get("session_data"), answer_data, events)
     
-    else:
-        # For text input and other types, get next step by order
-        next_step = db.flow_steps.find_one(
-            {"flow_id": flow_id, "step_order": {"$gt": current_step["step_order"]}},
-            sort=[("step_order", 1)]
-        )
-        next_step_id = next_step["id"] if next_step else None
-    
-    # Update execution
+    # Update execution; only the new answer is written, not the whole dict
     update_data = {
-        "answers": answers,
+        f"answers.{answer_data.step_id}": answers[answer_data.step_id],
         "current_step_id": next_step_id,
+        "current_step_reached_at": datetime.utcnow(),
+        "current_flow_id": cursor.flow_id,
+        "call_stack": cursor.call_stack,
         "last_activity": datetime.utcnow()
     }
     
@@ -1702,76 +6033,201 @@ async def submit_step_answer(
         update_data["status"] = FlowExecutionStatus.COMPLETED
         update_data["completed_at"] = datetime.utcnow()
     
-    db.flow_executions.update_one(
-        {"flow_id": flow_id, "session_id": session_id},
-        {"$set": update_data}
-    )
+    save_execution_progress(execution, update_data)
+    flow_step_stats.record(events, seconds_since_reached(execution, answer_data.step_id))
     
-    return {
+    response = {
         "message": "Answer submitted successfully",
         "next_step_id": next_step_id,
         "is_completed": not next_step_id
     }
+    if include_next:
+        response.update(upcoming_steps(cursor, next_step_id))
+    return response
 
-@app.get("/api/flows/{flow_id}/execute/{session_id}/summary", response_model=FlowSummary)
-async def get_flow_summary(
+@app.post("/api/flows/{flow_id}/execute/{session_id}/answers")
+async def submit_step_answers(
     flow_id: str,
     session_id: str,
+    batch: FlowStepAnswerBatch,
+    include_next: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
     check_permission(current_user, AppPermission.FLOW_EXECUTE)
     
-    execution = db.flow_executions.find_one({"flow_id": flow_id, "session_id": session_id})
+    if not batch.answers:
+        raise HTTPException(status_code=400, detail="No answers submitted")
+    if len(batch.answers) > MAX_ANSWER_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_ANSWER_BATCH_SIZE} answers can be submitted at once")
+    
+    execution = load_execution(flow_id, session_id)
     if not execution:
         raise HTTPException(status_code=404, detail="Flow execution not found")
     
-    flow = db.flows.find_one({"id": flow_id})
-    steps = list(db.flow_steps.find({"flow_id": flow_id}, {"_id": 0}).sort("step_order", 1))
+    if execution["status"] != FlowExecutionStatus.IN_PROGRESS:
+        raise HTTPException(status_code=400, detail="Flow execution is not in progress")
     
-    # Build completed steps summary
-    completed_steps = []
-    for step in steps:
-        if step["id"] in execution["answers"]:
-            answer_data = execution["answers"][step["id"]]
-            completed_steps.append({
-                "step_order": step["step_order"],
-                "question": step["question_text"],
-                "answer": answer_data["answer"],
-                "answered_at": answer_data["answered_at"]
-            })
+    # Walk the graph from the current step; each answer must be for the step
+    # the previous one led to, and nothing is stored unless all are valid
+    cursor = ExecutionCursor.for_execution(execution, get_execution_graphs(execution))
+    answers = dict(execution["answers"])
+    session_data = execution.get("session_data")
+    step_id = execution.get("current_step_id")
+    events: List[tuple] = []
+    for position, answer_data in enumerate(batch.answers, start=1):
+        if step_id is None:
+            raise HTTPException(status_code=400, detail=f"Answer {position}: the flow is already complete")
+        if answer_data.step_id != step_id:
+            raise HTTPException(status_code=400, detail=f"Answer {position}: expected an answer for step {step_id}")
+        try:
+            step_id = apply_step_answer(cursor, answers, session_data, answer_data, events)
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"Answer {position}: {e.detail}")
+    
+    update_data = {f"answers.{answer_data.step_id}": answers[answer_data.step_id] for answer_data in batch.answers}
+    update_data.update({
+        "current_step_id": step_id,
+        "current_step_reached_at": datetime.utcnow(),
+        "current_flow_id": cursor.flow_id,
+        "call_stack": cursor.call_stack,
+        "last_activity": datetime.utcnow()
+    })
+    if not step_id:
+        update_data["status"] = FlowExecutionStatus.COMPLETED
+        update_data["completed_at"] = datetime.utcnow()
     
-    # Calculate total time
-    started_at = execution["started_at"]
-    completed_at = execution.get("completed_at", datetime.utcnow())
-    total_time = int((completed_at - started_at).total_seconds())
+    save_execution_progress(execution, update_data)
+    # Only the first answer has a known start time
+    flow_step_stats.record(events, seconds_since_reached(execution, batch.answers[0].step_id))
     
-    # Generate summaries
-    summary_text = f"Flow '{flow['title']}' completed with {len(completed_steps)} steps answered."
+    response = {
+        "message": "Answers submitted successfully",
+        "answered": len(batch.answers),
+        "next_step_id": step_id,
+        "is_completed": not step_id
+    }
+    if include_next:
+        response.update(upcoming_steps(cursor, step_id))
+    return response
+
+@app.get("/api/flows/{flow_id}/execute/{session_id}/summary", response_model=FlowSummary)
+async def get_flow_summary(
+    flow_id: str,
+    session_id: str,
+    format: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.FLOW_EXECUTE)
     
-    summary_markdown = f"# Flow Summary: {flow['title']}\n\n"
-    for step in completed_steps:
-        summary_markdown += f"**Q{step['step_order']}.** {step['question']}\n"
-        summary_markdown += f"**Answer:** {step['answer']}\n\n"
+    if format is not None and format not in FLOW_SUMMARY_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be one of: " + ", ".join(FLOW_SUMMARY_MEDIA_TYPES))
     
-    summary_json = {
-        "flow_id": flow_id,
-        "flow_title": flow["title"],
-        "execution_id": execution["id"],
-        "completed_steps": completed_steps,
-        "total_time_seconds": total_time,
-        "started_at": started_at.isoformat() if isinstance(started_at, datetime) else started_at,
-        "completed_at": completed_at.isoformat() if isinstance(completed_at, datetime) else completed_at
-    }
+    flow = db.flows.find_one({"id": flow_id}, {"_id": 0, "id": 1, "title": 1, "version": 1})
+    if not flow:
+        raise HTTPException(status_code=404, detail="Flow not found")
+    
+    # ETags are only handed out for completed executions, whose summaries
+    # only change with the flow version
+    flow_version = flow.get("version", 1)
+    etag = flow_summary_etag(session_id, flow_version, format or "full")
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    key = (flow_id, session_id, flow_version, format)
+    summary = flow_summaries.get(key)
+    if summary is None:
+        execution = load_execution(flow_id, session_id)
+        if not execution:
+            raise HTTPException(status_code=404, detail="Flow execution not found")
+        
+        summary = render_flow_summary(build_flow_summary_data(execution, flow), format)
+        completed = execution["status"] == FlowExecutionStatus.COMPLETED
+        if completed:
+            flow_summaries.put(key, summary)
+    else:
+        completed = True
+    
+    headers = {"Cache-Control": "private, max-age=31536000, immutable", "ETag": etag} if completed else {"Cache-Control": "no-store"}
+    if format is None:
+        return JSONResponse(jsonable_encoder(FlowSummary(**summary, generated_at=datetime.utcnow())), headers=headers)
+    if format == "json":
+        return JSONResponse(jsonable_encoder(summary), headers=headers)
+    return Response(content=summary, media_type=FLOW_SUMMARY_MEDIA_TYPES[format], headers=headers)
+
+@app.get("/api/flows/{flow_id}/analytics", response_model=FlowAnalyticsResponse)
+async def get_flow_analytics(
+    flow_id: str,
+    days: int = 30,
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.FLOW_WRITE)
+    
+    flow = db.flows.find_one({"id": flow_id}, {"_id": 0, "id": 1, "version": 1})
+    if not flow:
+        raise HTTPException(status_code=404, detail="Flow not found")
     
-    return FlowSummary(
-        execution_id=execution["id"],
-        flow_title=flow["title"],
-        completed_steps=completed_steps,
-        total_time_seconds=total_time,
-        summary_text=summary_text,
-        summary_markdown=summary_markdown,
-        summary_json=summary_json,
-        generated_at=datetime.utcnow()
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    since = today - timedelta(days=min(max(days, 1), FLOW_STATS_RETENTION_DAYS) - 1)
+    
+    # Daily documents are summed per step; steps that only exist in older
+    # versions are listed after the current ones
+    totals: Dict[str, dict] = {}
+    for stats in db.flow_step_stats.find({"flow_id": flow_id, "day": {"$gte": since}}, {"_id": 0}):
+        total = totals.setdefault(stats["step_id"], {"reached": 0, "answered": 0, "options": {}, "answer_seconds": {}})
+        total["reached"] += stats.get("reached", 0)
+        total["answered"] += stats.get("answered", 0)
+        for field in ("options", "answer_seconds"):
+            for key, count in (stats.get(field) or {}).items():
+                total[field][key] = total[field].get(key, 0) + count
+    
+    graph = get_flow_graph(flow)
+    step_ids = [step_id for step_id in graph.order if step_id in totals]
+    step_ids += [step_id for step_id in totals if step_id not in graph.steps]
+    steps = []
+    for step_id in step_ids:
+        total = totals[step_id]
+        step = graph.steps.get(step_id, {})
+        drop_off = max(total["reached"] - total["answered"], 0)
+        steps.append(FlowStepAnalytics(
+            step_id=step_id,
+            question_text=step.get("question_text"),
+            step_order=step.get("step_order"),
+            reached=total["reached"],
+            answered=total["answered"],
+            drop_off=drop_off,
+            drop_off_rate=round(drop_off / total["reached"], 4) if total["reached"] else 0.0,
+            options=total["options"],
+            median_seconds_to_answer=median_seconds(total["answer_seconds"])
+        ))
+    
+    return FlowAnalyticsResponse(flow_id=flow_id, since=since, steps=steps)
+
+@app.get("/api/flows/{flow_id}/executions/export")
+async def export_flow_executions(
+    flow_id: str,
+    format: str = "csv",
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.FLOW_WRITE)
+    
+    flow = db.flows.find_one({"id": flow_id}, {"_id": 0, "id": 1})
+    if not flow:
+        raise HTTPException(status_code=404, detail="Flow not found")
+    
+    if format == "csv":
+        body, media_type = stream_executions_csv(flow_id, start, end), "text/csv"
+    elif format == "ndjson":
+        body, media_type = stream_executions_ndjson(flow_id, start, end), "application/x-ndjson"
+    else:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="flow-{flow_id}-executions.{format}"'}
     )
 
 # Admin and Analytics routes
@@ -1801,11 +6257,15 @@ async def get_analytics(current_user: dict = Depends(get_current_user)):
         "is_active": True
     })
     
-    # Execution analytics
-    total_flow_executions = db.flow_executions.count_documents({})
-    executions_last_30_days = db.flow_executions.count_documents({
-        "started_at": {"$gte": thirty_days_ago}
-    })
+    # Execution analytics; archived months are counted from the partition
+    # list and only opened when the range reaches into them
+    total_flow_executions = db.flow_executions.count_documents({}) + sum(
+        partition["count"] for partition in archive_partitions()
+    )
+    recent_collections = execution_collections(thirty_days_ago)
+    executions_last_30_days = sum(
+        collection.count_documents({"started_at": {"$gte": thirty_days_ago}}) for collection in recent_collections
+    )
     
     # Most popular articles (placeholder logic - can be enhanced)
     most_popular_articles = list(db.wiki_articles.find(
@@ -1813,14 +6273,20 @@ async def get_analytics(current_user: dict = Depends(get_current_user)):
     ).sort("created_at", -1).limit(5))
     
     # Most executed flows
+    # Counts are merged across partitions before taking the top five
     pipeline = [
         {"$match": {"started_at": {"$gte": thirty_days_ago}}},
-        {"$group": {"_id": "$flow_id", "execution_count": {"$sum": 1}}},
-        {"$sort": {"execution_count": -1}},
-        {"$limit": 5}
+        {"$group": {"_id": "$flow_id", "execution_count": {"$sum": 1}}}
     ]
     
-    most_executed_flows_data = list(db.flow_executions.aggregate(pipeline))
+    execution_counts: Dict[str, int] = {}
+    for collection in recent_collections:
+        for item in collection.aggregate(pipeline):
+            execution_counts[item["_id"]] = execution_counts.get(item["_id"], 0) + item["execution_count"]
+    most_executed_flows_data = [
+        {"_id": flow_id, "execution_count": count}
+        for flow_id, count in sorted(execution_counts.items(), key=lambda item: -item[1])[:5]
+    ]
     most_executed_flows = []
     
     for item in most_executed_flows_data:
@@ -1933,6 +6399,15 @@ async def get_recent_activity(
     recent_executions = list(db.flow_executions.find(
         {}, {"_id": 0, "flow_id": 1, "started_at": 1, "user_id": 1, "status": 1}
     ).sort("started_at", -1).limit(20))
+    # Archived months are read newest first until they cannot beat what
+    # is already collected
+    for partition in archive_partitions():
+        if len(recent_executions) >= 20 and partition["month_end"] <= recent_executions[-1]["started_at"]:
+            break
+        recent_executions += db[partition["_id"]].find(
+            {}, {"_id": 0, "flow_id": 1, "started_at": 1, "user_id": 1, "status": 1}
+        ).sort("started_at", -1).limit(20)
+        recent_executions = sorted(recent_executions, key=lambda execution: execution["started_at"], reverse=True)[:20]
     
     # Combine and format activities
     activities = []
@@ -1968,6 +6443,122 @@ async def get_recent_activity(
     activities.sort(key=lambda x: x["timestamp"], reverse=True)
     return activities[:limit]
 
+@app.get("/api/admin/search/queries", response_model=SearchQueryReport)
+async def get_search_query_report(
+    hours: int = 24,
+    source: Optional[str] = None,
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.ADMIN_ACCESS)
+    
+    hours = max(1, min(hours, SEARCH_STATS_RETENTION_DAYS * 24))
+    limit = max(1, min(limit, 100))
+    now = datetime.utcnow()
+    since = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+    match: Dict[str, Any] = {"hour": {"$gte": since}}
+    if source:
+        match["source"] = source
+    
+    project = {
+        "_id": 0,
+        "query": "$_id",
+        "searches": 1,
+        "zero_result_searches": "$zero_results",
+        "avg_results": {"$divide": ["$total_results", "$searches"]},
+        "avg_latency_ms": {"$divide": ["$total_latency_ms", "$searches"]},
+        "max_latency_ms": 1
+    }
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": "$query",
+            "searches": {"$sum": "$searches"},
+            "zero_results": {"$sum": "$zero_results"},
+            "total_results": {"$sum": "$total_results"},
+            "total_latency_ms": {"$sum": "$total_latency_ms"},
+            "max_latency_ms": {"$max": "$max_latency_ms"}
+        }},
+        {"$project": project},
+        {"$facet": {
+            "top_queries": [{"$sort": {"searches": -1}}, {"$limit": limit}],
+            "zero_result_queries": [{"$match": {"zero_result_searches": {"$gt": 0}}}, {"$sort": {"zero_result_searches": -1}}, {"$limit": limit}],
+            "slow_queries": [{"$sort": {"avg_latency_ms": -1}}, {"$limit": limit}]
+        }}
+    ]
+    report = next(db.search_query_stats.aggregate(pipeline, allowDiskUse=True), {})
+    return SearchQueryReport(
+        since=since,
+        top_queries=[SearchQueryStat(**row) for row in report.get("top_queries", [])],
+        zero_result_queries=[SearchQueryStat(**row) for row in report.get("zero_result_queries", [])],
+        slow_queries=[SearchQueryStat(**row) for row in report.get("slow_queries", [])]
+    )
+
+@app.post("/api/admin/tags/rebuild")
+async def rebuild_tags(current_user: dict = Depends(get_current_user)):
+    check_permission(current_user, AppPermission.ADMIN_ACCESS)
+    
+    counters = rebuild_tag_counts()
+    return {"message": "Tag counts rebuilt successfully", "counters": counters}
+
+@app.post("/api/admin/jobs/related-articles", status_code=202)
+async def run_related_articles(full: bool = False, current_user: dict = Depends(get_current_user)):
+    check_permission(current_user, AppPermission.ADMIN_ACCESS)
+    
+    if not start_background_job("related_articles", RELATED_ARTICLES_LEASE_SECONDS, run_related_articles_job, full):
+        raise HTTPException(status_code=409, detail="Related articles job is already running")
+    return {"message": "Related articles job started", "full": full}
+
+@app.post("/api/admin/jobs/flow-execution-sweep", status_code=202)
+async def run_flow_execution_sweep(current_user: dict = Depends(get_current_user)):
+    check_permission(current_user, AppPermission.ADMIN_ACCESS)
+    
+    if not start_background_job("flow_execution_sweep", FLOW_EXECUTION_SWEEP_LEASE_SECONDS, sweep_flow_executions):
+        raise HTTPException(status_code=409, detail="Flow execution sweep is already running")
+    return {"message": "Flow execution sweep started"}
+
+@app.get("/api/admin/duplicates", response_model=List[DuplicateCluster])
+async def get_duplicate_clusters(
+    wiki_id: Optional[str] = None,
+    min_size: int = 2,
+    limit: int = 50,
+    current_user: dict = Depends(get_current_user)
+):
+    check_permission(current_user, AppPermission.ADMIN_ACCESS)
+    
+    query: Dict[str, Any] = {"size": {"$gte": min_size}}
+    if wiki_id:
+        query["wiki_ids"] = wiki_id
+    clusters = list(db.article_duplicate_clusters.find(query, {"_id": 0}).sort("size", -1).limit(min(limit, 500)))
+    
+    article_ids = [article_id for cluster in clusters for article_id in cluster["article_ids"]]
+    articles = {
+        doc["id"]: doc
+        for doc in db.wiki_articles.find({"id": {"$in": article_ids}}, {"_id": 0, "id": 1, "title": 1, "wiki_id": 1})
+    }
+    
+    result = []
+    for cluster in clusters:
+        members = [
+            DuplicateCandidate(id=article_id, title=articles[article_id]["title"],
+                               wiki_id=articles[article_id]["wiki_id"], similarity=cluster["min_similarity"])
+            for article_id in cluster["article_ids"] if article_id in articles
+        ]
+        if len(members) >= 2:
+            result.append(DuplicateCluster(
+                id=cluster["id"], size=len(members), min_similarity=cluster["min_similarity"],
+                wiki_ids=cluster["wiki_ids"], articles=members
+            ))
+    return result
+
+@app.post("/api/admin/jobs/duplicates", status_code=202)
+async def run_duplicate_detection(current_user: dict = Depends(get_current_user)):
+    check_permission(current_user, AppPermission.ADMIN_ACCESS)
+    
+    if not start_background_job("duplicate_detection", DUPLICATE_LEASE_SECONDS, run_duplicate_detection_job):
+        raise HTTPException(status_code=409, detail="Duplicate detection job is already running")
+    return {"message": "Duplicate detection job started"}
+
 # Helper function to log user activity
 def log_user_activity(user_id: str, action: str, resource_type: str = None, resource_id: str = None, metadata: dict = None):
     activity_doc = {
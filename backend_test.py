@@ -866,7 +866,7 @@ class BackendTester:
                     articles = data["articles"]
                     if isinstance(articles, list):
                         article_found = any("getting" in article.get("title", "").lower() or 
-                                          "getting" in article.get("content", "").lower() for article in articles)
+                                          "getting" in article.get("snippet", "").lower() for article in articles)
                         if article_found:
                             self.log_test("Wiki Search", True, f"Search functionality working correctly", 
                                         {"articles_found": len(articles), "categories_found": len(data["categories"]), "subcategories_found": len(data["subcategories"])})
@@ -889,6 +889,87 @@ class BackendTester:
             self.log_test("Wiki Search", False, f"Wiki search failed with exception: {str(e)}")
             return False
 
+    def test_wiki_suggest(self):
+        """Test GET /api/wiki/suggest endpoint"""
+        if not self.auth_token:
+            self.log_test("Wiki Suggest", False, "No auth token available")
+            return False
+            
+        try:
+            headers = {"Authorization": f"Bearer {self.auth_token}"}
+            response = self.session.get(f"{self.base_url}/api/wiki/suggest?prefix=get st", headers=headers)
+            
+            if response.status_code == 200:
+                data = response.json()
+                if isinstance(data, list) and any(item.get("type") == "article" and item.get("text") == "How to Get Started" for item in data):
+                    self.log_test("Wiki Suggest", True, "Typeahead suggestions working correctly", {"suggestions": len(data)})
+                    return True
+                else:
+                    self.log_test("Wiki Suggest", False, "Expected article title not suggested", data)
+                    return False
+            else:
+                self.log_test("Wiki Suggest", False, f"Wiki suggest failed with status {response.status_code}", 
+                            {"status_code": response.status_code, "text": response.text})
+                return False
+                
+        except Exception as e:
+            self.log_test("Wiki Suggest", False, f"Wiki suggest failed with exception: {str(e)}")
+            return False
+
+    def test_related_articles(self):
+        """Test GET /api/wiki/articles/{article_id}/related endpoint"""
+        if not self.auth_token or not hasattr(self, 'article_id'):
+            self.log_test("Related Articles", False, "No auth token or article ID available")
+            return False
+            
+        try:
+            headers = {"Authorization": f"Bearer {self.auth_token}"}
+            response = self.session.get(f"{self.base_url}/api/wiki/articles/{self.article_id}/related", headers=headers)
+            
+            if response.status_code == 200:
+                data = response.json()
+                if isinstance(data, list) and all(item["id"] != self.article_id for item in data):
+                    self.log_test("Related Articles", True, "Related articles retrieved successfully", {"related": len(data)})
+                    return True
+                else:
+                    self.log_test("Related Articles", False, "Invalid related articles response", data)
+                    return False
+            else:
+                self.log_test("Related Articles", False, f"Related articles failed with status {response.status_code}", 
+                            {"status_code": response.status_code, "text": response.text})
+                return False
+                
+        except Exception as e:
+            self.log_test("Related Articles", False, f"Related articles failed with exception: {str(e)}")
+            return False
+
+    def test_unified_search(self):
+        """Test GET /api/search endpoint"""
+        if not self.auth_token:
+            self.log_test("Unified Search", False, "No auth token available")
+            return False
+            
+        try:
+            headers = {"Authorization": f"Bearer {self.auth_token}"}
+            response = self.session.get(f"{self.base_url}/api/search?q=started", headers=headers)
+            
+            if response.status_code == 200:
+                data = response.json()
+                if isinstance(data, list) and any(hit.get("type") == "article" and hit.get("title") == "How to Get Started" for hit in data):
+                    self.log_test("Unified Search", True, "Unified search working correctly", {"hits": len(data)})
+                    return True
+                else:
+                    self.log_test("Unified Search", False, "Expected article not found", data)
+                    return False
+            else:
+                self.log_test("Unified Search", False, f"Unified search failed with status {response.status_code}", 
+                            {"status_code": response.status_code, "text": response.text})
+                return False
+                
+        except Exception as e:
+            self.log_test("Unified Search", False, f"Unified search failed with exception: {str(e)}")
+            return False
+
     def test_role_based_permissions(self):
         """Test role-based permissions for Wiki operations"""
         # This test assumes we have proper admin permissions
@@ -1315,6 +1396,93 @@ class BackendTester:
             self.log_test("Update Flow Step", False, f"Update flow step failed with exception: {str(e)}")
             return False
 
+    def test_invalid_conditional_logic(self):
+        """Test that POST /api/flows/{flow_id}/steps rejects conditions that do not compile"""
+        if not self.auth_token or not hasattr(self, 'flow_id'):
+            self.log_test("Invalid Conditional Logic", False, "No auth token or flow ID available")
+            return False
+            
+        try:
+            headers = {
+                "Authorization": f"Bearer {self.auth_token}",
+                "Content-Type": "application/json"
+            }
+            
+            step_data = {
+                "flow_id": self.flow_id,
+                "step_order": 10,
+                "step_type": "conditional_branch",
+                "question_text": "Route by age",
+                "conditional_logic": {
+                    "conditions": [{"expression": "answer >= 18 and (session.plan ==", "next_step": None}],
+                    "default_next_step": None
+                },
+                "is_required": True
+            }
+            
+            response = self.session.post(
+                f"{self.base_url}/api/flows/{self.flow_id}/steps",
+                json=step_data,
+                headers=headers
+            )
+            
+            if response.status_code == 400:
+                self.log_test("Invalid Conditional Logic", True, "Invalid condition expression rejected at authoring time", 
+                            {"detail": response.json().get("detail")})
+                return True
+            else:
+                self.log_test("Invalid Conditional Logic", False, f"Expected 400, got {response.status_code}", 
+                            {"status_code": response.status_code, "text": response.text})
+                return False
+                
+        except Exception as e:
+            self.log_test("Invalid Conditional Logic", False, f"Invalid conditional logic test failed with exception: {str(e)}")
+            return False
+
+    def test_unsafe_regex_rejected(self):
+        """Test that POST /api/flows/{flow_id}/steps rejects validation patterns prone to catastrophic backtracking"""
+        if not self.auth_token or not hasattr(self, 'flow_id'):
+            self.log_test("Unsafe Regex Rejected", False, "No auth token or flow ID available")
+            return False
+            
+        try:
+            headers = {
+                "Authorization": f"Bearer {self.auth_token}",
+                "Content-Type": "application/json"
+            }
+            
+            accepted = []
+            for pattern in [r"^(a|aa)+$", r"^(.*a){20}$", r"^(a|a)*$", r"^(?:a?){25}a{25}$"]:
+                step_data = {
+                    "flow_id": self.flow_id,
+                    "step_order": 10,
+                    "step_type": "text_input",
+                    "question_text": "Enter a code",
+                    "validation_rules": {"pattern": pattern},
+                    "is_required": True
+                }
+                
+                response = self.session.post(
+                    f"{self.base_url}/api/flows/{self.flow_id}/steps",
+                    json=step_data,
+                    headers=headers
+                )
+                
+                if response.status_code != 400:
+                    accepted.append({"pattern": pattern, "status_code": response.status_code})
+            
+            if not accepted:
+                self.log_test("Unsafe Regex Rejected", True, "All backtracking-prone patterns rejected at authoring time")
+                return True
+            else:
+                self.log_test("Unsafe Regex Rejected", False, "Backtracking-prone patterns were accepted", 
+                            {"accepted": accepted})
+                return False
+                
+        except Exception as e:
+            self.log_test("Unsafe Regex Rejected", False, f"Unsafe regex test failed with exception: {str(e)}")
+            return False
+
     def test_start_flow_execution(self):
         """Test POST /api/flows/{flow_id}/execute endpoint"""
         if not self.auth_token or not hasattr(self, 'flow_id'):
@@ -1401,6 +1569,43 @@ class BackendTester:
             self.log_test("Get Flow Execution Status", False, f"Get flow execution status failed with exception: {str(e)}")
             return False
 
+    def test_answer_validation(self):
+        """Test that POST /api/flows/{flow_id}/execute/{session_id}/answer enforces validation_rules"""
+        if not self.auth_token or not hasattr(self, 'flow_id') or not hasattr(self, 'session_id'):
+            self.log_test("Answer Validation", False, "No auth token, flow ID, or session ID available")
+            return False
+            
+        try:
+            headers = {
+                "Authorization": f"Bearer {self.auth_token}",
+                "Content-Type": "application/json"
+            }
+            
+            # Step 3 requires at least 2 characters
+            answer_data = {
+                "step_id": self.step3_id,
+                "answer": "J"
+            }
+            
+            response = self.session.post(
+                f"{self.base_url}/api/flows/{self.flow_id}/execute/{self.session_id}/answer",
+                json=answer_data,
+                headers=headers
+            )
+            
+            if response.status_code == 400 and "Minimum length" in response.json().get("detail", ""):
+                self.log_test("Answer Validation", True, "Answer violating validation rules rejected", 
+                            {"detail": response.json().get("detail")})
+                return True
+            else:
+                self.log_test("Answer Validation", False, f"Expected 400 with a length error, got {response.status_code}", 
+                            {"status_code": response.status_code, "text": response.text})
+                return False
+                
+        except Exception as e:
+            self.log_test("Answer Validation", False, f"Answer validation test failed with exception: {str(e)}")
+            return False
+
     def test_submit_step_answers(self):
         """Test POST /api/flows/{flow_id}/execute/{session_id}/answer endpoint"""
         if not self.auth_token or not hasattr(self, 'flow_id') or not hasattr(self, 'session_id'):
@@ -1482,6 +1687,164 @@ class BackendTester:
             self.log_test("Submit Step Answers", False, f"Submit step answers failed with exception: {str(e)}")
             return False
 
+    def test_subflow_execution(self):
+        """Test entering and returning from a subflow during execution"""
+        if not self.auth_token:
+            self.log_test("Subflow Execution", False, "No auth token available")
+            return False
+            
+        try:
+            headers = {
+                "Authorization": f"Bearer {self.auth_token}",
+                "Content-Type": "application/json"
+            }
+            
+            def create(path, payload):
+                response = self.session.post(f"{self.base_url}{path}", json=payload, headers=headers)
+                response.raise_for_status()
+                return response.json()
+            
+            child = create("/api/flows", {"title": "Contact Details Subflow", "visibility": "internal"})
+            child_step = create(f"/api/flows/{child['id']}/steps", {
+                "flow_id": child["id"], "step_order": 1, "step_type": "text_input", "question_text": "Contact email?"
+            })
+            parent = create("/api/flows", {"title": "Subflow Parent Flow", "visibility": "internal"})
+            create(f"/api/flows/{parent['id']}/steps", {
+                "flow_id": parent["id"], "step_order": 1, "step_type": "subflow",
+                "question_text": "Collect contact details", "subflow_id": child["id"]
+            })
+            final_step = create(f"/api/flows/{parent['id']}/steps", {
+                "flow_id": parent["id"], "step_order": 2, "step_type": "information", "question_text": "All done"
+            })
+            
+            # A subflow pointing back at its parent is refused
+            cycle = self.session.post(f"{self.base_url}/api/flows/{child['id']}/steps", json={
+                "flow_id": child["id"], "step_order": 2, "step_type": "subflow",
+                "question_text": "Back to parent", "subflow_id": parent["id"]
+            }, headers=headers)
+            
+            execution = create(f"/api/flows/{parent['id']}/execute", {"session_data": {}})
+            if cycle.status_code != 400 or execution["current_step_id"] != child_step["id"] or execution["current_flow_id"] != child["id"]:
+                self.log_test("Subflow Execution", False, "Execution did not start inside the subflow or cycle was accepted", 
+                            {"cycle_status": cycle.status_code, "execution": execution})
+                return False
+            
+            result = create(f"/api/flows/{parent['id']}/execute/{execution['session_id']}/answer?include_next=true", {
+                "step_id": child_step["id"], "answer": "jane@example.com"
+            })
+            if result.get("next_step_id") == final_step["id"] and (result.get("next_step") or {}).get("question_text") == "All done":
+                self.subflow_parent_id = parent["id"]
+                self.log_test("Subflow Execution", True, "Subflow entered and returned to parent with the next step embedded", result)
+                return True
+            else:
+                self.log_test("Subflow Execution", False, "Did not return to the parent flow after the subflow", result)
+                return False
+                
+        except Exception as e:
+            self.log_test("Subflow Execution", False, f"Subflow execution failed with exception: {str(e)}")
+            return False
+
+    def test_flow_summary_formats(self):
+        """Test GET /api/flows/{flow_id}/execute/{session_id}/summary?format= renderings"""
+        if not self.auth_token or not hasattr(self, 'flow_id') or not hasattr(self, 'session_id'):
+            self.log_test("Flow Summary Formats", False, "No auth token, flow ID, or session ID available")
+            return False
+            
+        try:
+            headers = {"Authorization": f"Bearer {self.auth_token}"}
+            url = f"{self.base_url}/api/flows/{self.flow_id}/execute/{self.session_id}/summary"
+            
+            csv_response = self.session.get(f"{url}?format=csv", headers=headers)
+            html_response = self.session.get(f"{url}?format=html", headers=headers)
+            if (csv_response.status_code != 200 or not csv_response.text.startswith("step_order,question,answer") or
+                    html_response.status_code != 200 or "<h1>Flow Summary: Customer Onboarding Flow</h1>" not in html_response.text):
+                self.log_test("Flow Summary Formats", False, "Unexpected CSV or HTML summary", 
+                            {"csv_status": csv_response.status_code, "html_status": html_response.status_code})
+                return False
+            
+            # Completed summaries are immutable and revalidate with their ETag
+            etag = csv_response.headers.get("ETag")
+            cached = self.session.get(f"{url}?format=csv", headers={**headers, "If-None-Match": etag or ""})
+            if not etag or cached.status_code != 304:
+                self.log_test("Flow Summary Formats", False, f"Expected 304 for a cached summary, got {cached.status_code}", 
+                            {"etag": etag})
+                return False
+            
+            # Editing the flow bumps its version, which invalidates the ETag
+            flow = self.session.get(f"{self.base_url}/api/flows/{self.flow_id}", headers=headers).json()
+            self.session.put(
+                f"{self.base_url}/api/flows/{self.flow_id}",
+                json={key: flow[key] for key in ("title", "description", "visibility", "tags")},
+                headers=headers
+            )
+            revalidated = self.session.get(f"{url}?format=csv", headers={**headers, "If-None-Match": etag})
+            if revalidated.status_code == 200 and revalidated.headers.get("ETag") != etag:
+                self.log_test("Flow Summary Formats", True, "Summary rendered per format and cached per flow version", 
+                            {"etag": etag, "new_etag": revalidated.headers.get("ETag")})
+                return True
+            else:
+                self.log_test("Flow Summary Formats", False, f"Expected 200 with a new ETag after a flow edit, got {revalidated.status_code}", 
+                            {"etag": etag})
+                return False
+                
+        except Exception as e:
+            self.log_test("Flow Summary Formats", False, f"Flow summary formats failed with exception: {str(e)}")
+            return False
+
+    def test_submit_answer_batch(self):
+        """Test POST /api/flows/{flow_id}/execute/{session_id}/answers endpoint"""
+        if not self.auth_token or not hasattr(self, 'flow_id') or not hasattr(self, 'step3_id'):
+            self.log_test("Submit Answer Batch", False, "No auth token, flow ID, or steps available")
+            return False
+            
+        try:
+            headers = {
+                "Authorization": f"Bearer {self.auth_token}",
+                "Content-Type": "application/json"
+            }
+            
+            start = self.session.post(
+                f"{self.base_url}/api/flows/{self.flow_id}/execute",
+                json={"session_data": {}},
+                headers=headers
+            )
+            if start.status_code != 200:
+                self.log_test("Submit Answer Batch", False, f"Starting execution failed with status {start.status_code}", 
+                            {"status_code": start.status_code, "text": start.text})
+                return False
+            session_id = start.json()["session_id"]
+            
+            batch_data = {
+                "answers": [
+                    {"step_id": self.step1_id, "answer": "acknowledged"},
+                    {"step_id": self.step2_id, "answer": "business"},
+                    {"step_id": self.step3_id, "answer": "Jane Doe"}
+                ]
+            }
+            
+            response = self.session.post(
+                f"{self.base_url}/api/flows/{self.flow_id}/execute/{session_id}/answers",
+                json=batch_data,
+                headers=headers
+            )
+            
+            if response.status_code == 200:
+                data = response.json()
+                if data.get("answered") == 3 and data.get("is_completed") == True:
+                    self.log_test("Submit Answer Batch", True, "Answer batch walked the flow to completion", data)
+                    return True
+                else:
+                    self.log_test("Submit Answer Batch", False, "Answer batch did not complete the flow", data)
+                    return False
+            else:
+                self.log_test("Submit Answer Batch", False, f"Answer batch failed with status {response.status_code}", 
+                            {"status_code": response.status_code, "text": response.text})
+                return False
+                
+        except Exception as e:
+            self.log_test("Submit Answer Batch", False, f"Answer batch failed with exception: {str(e)}")
+            return False
+
     def test_get_flow_summary(self):
         """Test GET /api/flows/{flow_id}/execute/{session_id}/summary endpoint"""
         if not self.auth_token or not hasattr(self, 'flow_id') or not hasattr(self, 'session_id'):
@@ -1520,6 +1883,95 @@ class BackendTester:
             self.log_test("Get Flow Summary", False, f"Get flow summary failed with exception: {str(e)}")
             return False
 
+    def test_flow_step_analytics(self):
+        """Test GET /api/flows/{flow_id}/analytics endpoint"""
+        if not self.auth_token or not hasattr(self, 'flow_id'):
+            self.log_test("Flow Step Analytics", False, "No auth token or flow ID available")
+            return False
+            
+        try:
+            headers = {"Authorization": f"Bearer {self.auth_token}"}
+            response = self.session.get(f"{self.base_url}/api/flows/{self.flow_id}/analytics?days=7", headers=headers)
+            
+            if response.status_code == 200:
+                data = response.json()
+                # Counters are flushed in the background, so steps may still be empty
+                if data.get("flow_id") == self.flow_id and isinstance(data.get("steps"), list):
+                    self.log_test("Flow Step Analytics", True, "Flow funnel analytics returned", {"steps": len(data["steps"])})
+                    return True
+                else:
+                    self.log_test("Flow Step Analytics", False, "Unexpected analytics response", data)
+                    return False
+            else:
+                self.log_test("Flow Step Analytics", False, f"Flow analytics failed with status {response.status_code}", 
+                            {"status_code": response.status_code, "text": response.text})
+                return False
+                
+        except Exception as e:
+            self.log_test("Flow Step Analytics", False, f"Flow analytics failed with exception: {str(e)}")
+            return False
+
+    def test_export_flow_executions(self):
+        """Test GET /api/flows/{flow_id}/executions/export endpoint"""
+        if not self.auth_token or not hasattr(self, 'flow_id'):
+            self.log_test("Export Flow Executions", False, "No auth token or flow ID available")
+            return False
+            
+        try:
+            headers = {"Authorization": f"Bearer {self.auth_token}"}
+            response = self.session.get(
+                f"{self.base_url}/api/flows/{self.flow_id}/executions/export?format=csv",
+                headers=headers
+            )
+            
+            if response.status_code == 200:
+                lines = response.text.strip().splitlines()
+                if lines and lines[0].startswith("execution_id,") and "Please enter your full name" in lines[0] and len(lines) > 1:
+                    self.log_test("Export Flow Executions", True, "CSV export has one column per step", {"rows": len(lines) - 1})
+                    return True
+                else:
+                    self.log_test("Export Flow Executions", False, "Unexpected CSV export content", {"head": lines[:2]})
+                    return False
+            else:
+                self.log_test("Export Flow Executions", False, f"Export failed with status {response.status_code}", 
+                            {"status_code": response.status_code, "text": response.text})
+                return False
+                
+        except Exception as e:
+            self.log_test("Export Flow Executions", False, f"Export failed with exception: {str(e)}")
+            return False
+
+    def test_export_subflow_answers(self):
+        """Test that flow execution exports include answers given inside subflows"""
+        if not self.auth_token or not hasattr(self, 'subflow_parent_id'):
+            self.log_test("Export Subflow Answers", False, "No auth token or subflow parent flow available")
+            return False
+            
+        try:
+            headers = {"Authorization": f"Bearer {self.auth_token}"}
+            url = f"{self.base_url}/api/flows/{self.subflow_parent_id}/executions/export"
+            csv_response = self.session.get(f"{url}?format=csv", headers=headers)
+            ndjson_response = self.session.get(f"{url}?format=ndjson", headers=headers)
+            if csv_response.status_code != 200 or ndjson_response.status_code != 200:
+                self.log_test("Export Subflow Answers", False, "Export failed", 
+                            {"csv_status": csv_response.status_code, "ndjson_status": ndjson_response.status_code})
+                return False
+            
+            lines = csv_response.text.strip().splitlines()
+            answers = [answer for line in ndjson_response.text.strip().splitlines() for answer in json.loads(line)["answers"]]
+            if ("1.1. Contact email?" in lines[0] and any("jane@example.com" in line for line in lines[1:]) and
+                    any(answer["question"] == "Contact email?" and answer["answer"] == "jane@example.com" for answer in answers)):
+                self.log_test("Export Subflow Answers", True, "Subflow answers exported with their questions", {"header": lines[0]})
+                return True
+            else:
+                self.log_test("Export Subflow Answers", False, "Subflow answer missing from the export", 
+                            {"head": lines[:2], "answers": answers})
+                return False
+                
+        except Exception as e:
+            self.log_test("Export Subflow Answers", False, f"Export subflow answers failed with exception: {str(e)}")
+            return False
+
     def test_flow_search_and_filtering(self):
         """Test flow search and filtering functionality"""
         if not self.auth_token:
@@ -2060,6 +2512,9 @@ class BackendTester:
             ("Update Wiki Article", self.test_update_wiki_article),
             ("Get Article Versions", self.test_get_article_versions),
             ("Wiki Search", self.test_wiki_search),
+            ("Wiki Suggest", self.test_wiki_suggest),
+            ("Related Articles", self.test_related_articles),
+            ("Unified Search", self.test_unified_search),
             ("Role-Based Permissions", self.test_role_based_permissions),
             ("Validation Error Cases", self.test_validation_error_cases)
         ]
@@ -2073,10 +2528,19 @@ class BackendTester:
             ("Create Flow Steps", self.test_create_flow_steps),
             ("Get Flow Steps", self.test_get_flow_steps),
             ("Update Flow Step", self.test_update_flow_step),
+            ("Invalid Conditional Logic", self.test_invalid_conditional_logic),
+            ("Unsafe Regex Rejected", self.test_unsafe_regex_rejected),
             ("Start Flow Execution", self.test_start_flow_execution),
             ("Get Flow Execution Status", self.test_get_flow_execution_status),
+            ("Answer Validation", self.test_answer_validation),
             ("Submit Step Answers", self.test_submit_step_answers),
+            ("Submit Answer Batch", self.test_submit_answer_batch),
             ("Get Flow Summary", self.test_get_flow_summary),
+            ("Flow Summary Formats", self.test_flow_summary_formats),
+            ("Subflow Execution", self.test_subflow_execution),
+            ("Flow Step Analytics", self.test_flow_step_analytics),
+            ("Export Flow Executions", self.test_export_flow_executions),
+            ("Export Subflow Answers", self.test_export_subflow_answers),
             ("Flow Search and Filtering", self.test_flow_search_and_filtering),
             ("Flow Permissions Validation", self.test_flow_permissions_validation),
             ("Flow Error Handling", self.test_flow_error_handling)
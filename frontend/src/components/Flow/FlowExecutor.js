@@ -58,6 +58,10 @@ const FlowExecutor = () => {
           if (executionResult.success) {
             const execution = executionResult.data;
             setAnswers(execution.answers || {});
+            if (execution.flow_version) {
+              // Pinned executions follow the published version they started on
+              await fetchFlowSteps(flowId, execution.flow_version);
+            }
             
             if (execution.status === 'completed') {
               setIsCompleted(true);
@@ -309,9 +309,7 @@ const PublicWikiView = ({ customSettings = null }) => {
                         {article.title}
                       </h4>
                       <p className="text-gray-600 text-sm mb-2" 
-                         dangerouslySetInnerHTML={{ 
-                           __html: article.content.replace(/<[^>]*>/g, '').substring(0, 150) + '...' 
-                         }}
+                         dangerouslySetInnerHTML={{ __html: article.snippet }}
                       />
                       <div className="flex items-center space-x-4 text-xs text-gray-500">
                         <span>{new Date(article.updated_at).toLocaleDateString()}</span>
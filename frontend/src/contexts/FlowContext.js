@@ -147,10 +147,11 @@ export const FlowProvider = ({ children }) => {
   };
 
   // Fetch flow steps
-  const fetchFlowSteps = async (flowId) => {
+  const fetchFlowSteps = async (flowId, version = null) => {
     setLoading(true);
     try {
-      const response = await fetch(`${API_BASE_URL}/api/flows/${flowId}/steps`, {
+      const query = version ? `?version=${version}` : '';
+      const response = await fetch(`${API_BASE_URL}/api/flows/${flowId}/steps${query}`, {
         headers: {
           'Authorization': `Bearer ${token}`
         }
@@ -314,16 +315,19 @@ export const FlowProvider = ({ children }) => {
     }
   };
 
-  const generateFlowSummary = async (sessionId, format = 'text') => {
+  const generateFlowSummary = async (flowId, sessionId, format = null) => {
     try {
-      const response = await fetch(`${API_BASE_URL}/api/flow-sessions/${sessionId}/summary?format=${format}`, {
+      // Without a format the full summary object is returned; json, markdown,
+      // text, csv and html return just that rendering
+      const query = format ? `?format=${format}` : '';
+      const response = await fetch(`${API_BASE_URL}/api/flows/${flowId}/execute/${sessionId}/summary${query}`, {
         headers: {
           'Authorization': `Bearer ${token}`
         }
       });
       
       if (response.ok) {
-        const summary = await response.json();
+        const summary = format && format !== 'json' ? await response.text() : await response.json();
         return { success: true, data: summary };
       } else {
         const error = await response.json();
@@ -344,8 +348,8 @@ export const FlowProvider = ({ children }) => {
     return await submitStepResponse(sessionId, stepId, answer);
   };
 
-  const getFlowSummary = async (flowId, sessionId, format = 'text') => {
-    return await generateFlowSummary(sessionId, format);
+  const getFlowSummary = async (flowId, sessionId, format = null) => {
+    return await generateFlowSummary(flowId, sessionId, format);
   };
 
   // Auto-fetch flows on mount